@@ -16,9 +16,26 @@ export const dashboardAPI = {
 
   /**
    * Get recent activities for dashboard
+   * @param {number} limit - Max number of activities
+   * @param {string} since - Only return activities modified after this timestamp (incremental polling)
    */
-  getRecentActivities: async (limit = 10) => {
-    const res = await api.post('/method/xuanhoa_app.api.get_recent_activities', { limit })
+  getRecentActivities: async (limit = 10, since = null) => {
+    const params = { limit }
+    if (since) params.since = since
+    const res = await api.post('/method/xuanhoa_app.api.get_recent_activities', params)
+    return res.data.message
+  },
+
+  /**
+   * Get several dashboard sections in one request
+   * @param {Array} sections - kpi, recent_activities, stock, production, inventory, sales_purchase
+   * @param {number} activityLimit - Number of recent activities
+   */
+  getBundle: async (sections = ['kpi', 'recent_activities'], activityLimit = 10) => {
+    const res = await api.post('/method/xuanhoa_app.api.get_dashboard_bundle', {
+      sections: JSON.stringify(sections),
+      activity_limit: activityLimit
+    })
     return res.data.message
   }
 }
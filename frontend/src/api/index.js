@@ -10,6 +10,7 @@
  * - invoice.js: Purchase/Sales Invoice APIs
  * - master.js: Items, Item Groups, UOMs, Suppliers, Customers APIs
  * - dashboard.js: Dashboard KPIs, Activities APIs
+ * - search.js: Document search APIs
  * - resource.js: Generic CRUD operations
  */
 
@@ -35,5 +36,8 @@ export { itemAPI, itemGroupAPI, uomAPI, supplierAPI, customerAPI } from './maste
 // Dashboard
 export { dashboardAPI, paymentAPI } from './dashboard'
 
+// Search
+export { searchAPI } from './search'
+
 // Generic Resource
 export { resourceAPI, customAPI } from './resource'
@@ -41,21 +41,41 @@ export const workOrderAPI = {
 
   /**
    * Get BOM detail with items
+   * @param {string} bomNo - BOM ID
+   * @param {boolean} multiLevel - Also return exploded_items (leaf raw materials of sub-assemblies)
    */
-  getBOMDetail: async (bomNo) => {
-    const res = await api.post('/method/xuanhoa_app.api.get_bom_detail', { bom_no: bomNo })
+  getBOMDetail: async (bomNo, multiLevel = false) => {
+    const res = await api.post('/method/xuanhoa_app.api.get_bom_detail', {
+      bom_no: bomNo,
+      multi_level: multiLevel ? 1 : 0
+    })
     return res.data.message
   },
 
   /**
    * Create new work order (Draft)
-   * @param {Object} data - { bom_no, qty, planned_start_date, expected_delivery_date, source_warehouse, wip_warehouse, fg_warehouse }
+   * @param {Object} data - { bom_no, qty, planned_start_date, expected_delivery_date, source_warehouse, wip_warehouse, fg_warehouse, use_multi_level_bom }
    */
   create: async (data) => {
     const res = await api.post('/method/xuanhoa_app.api.create_work_order', data)
     return res.data.message
   },
 
+  /**
+   * Create many work orders in one request
+   * @param {Array} orders - [{ bom_no, qty, planned_start_date, expected_delivery_date, source_warehouse, wip_warehouse, fg_warehouse, use_multi_level_bom }]
+   * @param {Object} options - { submit, atomic }
+   * @returns {Object} { success, results, created, failed, message }
+   */
+  createBulk: async (orders, options = {}) => {
+    const res = await api.post('/method/xuanhoa_app.api.create_work_orders_bulk', {
+      orders: JSON.stringify(orders),
+      submit: options.submit ? 1 : 0,
+      atomic: options.atomic ? 1 : 0
+    })
+    return res.data.message
+  },
+
   /**
    * Submit/Approve work order (Draft -> Submitted)
    */
@@ -66,17 +86,38 @@ export const workOrderAPI = {
 
   /**
    * Start work order (transfer materials to WIP)
+   * @param {string} name - Work order ID
+   * @param {boolean} background - Run in a background job (returns job_id, progress via realtime "xuanhoa_work_order_job")
    */
-  start: async (name) => {
-    const res = await api.post('/method/xuanhoa_app.api.start_work_order', { work_order_name: name })
+  start: async (name, background = false) => {
+    const res = await api.post('/method/xuanhoa_app.api.start_work_order', {
+      work_order_name: name,
+      background: background ? 1 : 0
+    })
     return res.data.message
   },
 
   /**
    * Complete work order (manufacture finished goods)
+   * @param {string} name - Work order ID
+   * @param {number} qty - Completed quantity
+   * @param {boolean} background - Run in a background job (returns job_id, progress via realtime "xuanhoa_work_order_job")
+   */
+  complete: async (name, qty, background = false) => {
+    const res = await api.post('/method/xuanhoa_app.api.complete_work_order', {
+      work_order_name: name,
+      qty,
+      background: background ? 1 : 0
+    })
+    return res.data.message
+  },
+
+  /**
+   * Get status of a background start/complete job
+   * @returns {Object} { success, job_id, work_order, purpose, status, progress, stock_entry, message }
    */
-  complete: async (name, qty) => {
-    const res = await api.post('/method/xuanhoa_app.api.complete_work_order', { work_order_name: name, qty })
+  getJobStatus: async (jobId) => {
+    const res = await api.post('/method/xuanhoa_app.api.get_work_order_job_status', { job_id: jobId })
     return res.data.message
   },
 
@@ -88,6 +129,20 @@ export const workOrderAPI = {
     return res.data.message
   },
 
+  /**
+   * Material requirements planning for many planned work orders
+   * @param {Array} demands - [{ item_code | bom_no, qty, date, warehouse }]
+   * @param {Object} options - { warehouse, include_ordered, shortage_only }
+   * @returns {Object} { success, items, errors, summary }
+   */
+  planMaterials: async (demands, options = {}) => {
+    const res = await api.post('/method/xuanhoa_app.api.plan_material_requirements', {
+      ...options,
+      demands: JSON.stringify(demands)
+    })
+    return res.data.message
+  },
+
   /**
    * Cancel work order (only if not started)
    */
@@ -116,6 +171,17 @@ export const bomAPI = {
     return res.data.message
   },
 
+  /**
+   * Explode multi-level BOM to leaf raw materials
+   * @param {string} name - BOM ID
+   * @param {number} qty - Finished goods quantity
+   * @returns {Object} { success, bom_no, item, qty, items }
+   */
+  explode: async (name, qty = 1) => {
+    const res = await api.post('/method/xuanhoa_app.api.explode_bom', { bom_no: name, qty })
+    return res.data.message
+  },
+
   /**
    * Create new BOM
    * @param {Object} data - { item, quantity, uom, is_active, is_default, items }
@@ -0,0 +1,21 @@
+/**
+ * Search API Module
+ * Accent-insensitive search across documents
+ */
+
+import api from './client'
+
+export const searchAPI = {
+  /**
+   * Search stock entries, invoices, work orders, suppliers and customers
+   * @param {string} query - Search keywords (accents are ignored)
+   * @param {Array} doctypes - Optional list of doctypes to search in
+   * @param {number} limit - Max number of results
+   */
+  searchDocuments: async (query, doctypes = null, limit = 20) => {
+    const params = { query, limit }
+    if (doctypes) params.doctypes = JSON.stringify(doctypes)
+    const res = await api.post('/method/xuanhoa_app.api.search_documents', params)
+    return res.data.message
+  }
+}
@@ -29,6 +29,18 @@ export const stockAPI = {
     return res.data.message
   },
 
+  /**
+   * Check stock availability for many lines in one request
+   * @param {Array} lines - [{ item_code, warehouse, qty }]
+   * @returns {Object} { success, sufficient, lines, insufficient_items }
+   */
+  checkAvailability: async (lines) => {
+    const res = await api.post('/method/xuanhoa_app.api.check_availability', {
+      lines: JSON.stringify(lines)
+    })
+    return res.data.message
+  },
+
   /**
    * Get list of warehouses
    */
@@ -137,17 +149,29 @@ export const warehouseAPI = {
 export const warehouseStockAPI = {
   /**
    * Get stock grouped by warehouse (for "Theo kho" view)
-   * @param {Object} params - { search, item_group }
+   * @param {Object} params - { search, item_group, summary_only }
+   *   summary_only: 1 = only per-warehouse totals, load items on expand via getWarehouseStock
    */
   getByWarehouse: async (params = {}) => {
     const res = await api.post('/method/xuanhoa_app.api.get_stock_by_warehouse', params)
     return res.data.message
   },
 
+  /**
+   * Get URL for the full stock-by-warehouse dump as NDJSON (one warehouse per line, summary last)
+   * @param {Object} params - { search, item_group }
+   */
+  getByWarehouseStreamUrl: (params = {}) => {
+    const query = new URLSearchParams(
+      Object.entries({ ...params, stream: 1 }).filter(([, value]) => value !== null && value !== undefined && value !== '')
+    )
+    return `/api/method/xuanhoa_app.api.get_stock_by_warehouse?${query.toString()}`
+  },
+
   /**
    * Get stock for a specific warehouse
    * @param {string} warehouse - Warehouse name
-   * @param {Object} params - { search, page, page_size }
+   * @param {Object} params - { search, item_group, page, page_size }
    */
   getWarehouseStock: async (warehouse, params = {}) => {
     const res = await api.post('/method/xuanhoa_app.api.get_warehouse_stock', { warehouse, ...params })
@@ -179,5 +203,25 @@ export const warehouseStockAPI = {
   getLedger: async (params = {}) => {
     const res = await api.post('/method/xuanhoa_app.api.get_stock_ledger', params)
     return res.data.message
+  },
+
+  /**
+   * Get download URL for stock ledger export (streamed CSV/XLSX)
+   * @param {Object} params - { warehouse, item_code, from_date, to_date, file_format }
+   */
+  getLedgerExportUrl: (params = {}) => {
+    const query = new URLSearchParams(
+      Object.entries(params).filter(([, value]) => value !== null && value !== undefined && value !== '')
+    )
+    return `/api/method/xuanhoa_app.api.export_stock_ledger?${query.toString()}`
+  },
+
+  /**
+   * Export stock ledger in a background job (result via realtime event "xuanhoa_stock_ledger_export")
+   * @param {Object} params - { warehouse, item_code, from_date, to_date, file_format }
+   */
+  exportLedgerInBackground: async (params = {}) => {
+    const res = await api.post('/method/xuanhoa_app.api.export_stock_ledger', { ...params, background: 1 })
+    return res.data.message
   }
 }
@@ -10,6 +10,173 @@ Các API này wrap các chức năng phức tạp của ERPNext thành các endp
 import frappe
 from frappe import _
 
+from xuanhoa_app.cache import get_user_full_name, get_user_full_names
+
+# ============================================
+# HELPERS
+# ============================================
+
+def _encode_cursor(values):
+    """Mã hóa giá trị sort key của dòng cuối trang thành cursor (base64 JSON)"""
+    import base64
+    import json
+    
+    payload = json.dumps([str(v) if v is not None else None for v in values])
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def _decode_cursor(cursor, size):
+    """Giải mã cursor, kiểm tra đúng số lượng sort key"""
+    import base64
+    import json
+    
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except Exception:
+        values = None
+    
+    if not isinstance(values, list) or len(values) != size:
+        frappe.throw(_("Cursor phân trang không hợp lệ"))
+    
+    return values
+
+
+def _keyset_condition(sort_columns, values):
+    """
+    Tạo điều kiện seek sau dòng có sort key = values
+    
+    Với ORDER BY a DESC, b DESC sinh ra: (a < %s) OR (a = %s AND b < %s)
+    (viết tách thay vì so sánh tuple để MariaDB dùng được index)
+    """
+    clauses = []
+    params = []
+    
+    for i, (expression, direction) in enumerate(sort_columns):
+        operator = "<" if direction == "desc" else ">"
+        parts = [f"{prev} = %s" for prev, _direction in sort_columns[:i]]
+        parts.append(f"{expression} {operator} %s")
+        clauses.append("(" + " AND ".join(parts) + ")")
+        params.extend(values[:i])
+        params.append(values[i])
+    
+    return "(" + " OR ".join(clauses) + ")", params
+
+
+def _count_rows(from_clause, where_clause, params, count_mode="exact"):
+    """
+    Đếm số dòng theo chế độ:
+        exact: COUNT(*) chính xác
+        estimate: ước lượng từ EXPLAIN (không quét bảng)
+        none: bỏ qua đếm, trả về None
+    """
+    if count_mode == "none":
+        return None
+    
+    if count_mode == "estimate":
+        plan = frappe.db.sql(f"""
+            EXPLAIN SELECT 1
+            FROM {from_clause}
+            WHERE {where_clause}
+        """, params, as_dict=True)
+        return int(plan[0].get("rows") or 0) if plan else 0
+    
+    return frappe.db.sql(f"""
+        SELECT COUNT(*)
+        FROM {from_clause}
+        WHERE {where_clause}
+    """, params)[0][0]
+
+
+def _fetch_page(select_clause, from_clause, where_clause, params, sort_columns,
+                page_size=20, offset=0, cursor=None, count_mode="exact"):
+    """
+    Chạy query danh sách với phân trang OFFSET (mặc định) hoặc keyset (khi có cursor)
+    
+    Args:
+        select_clause, from_clause, where_clause, params: các phần của câu SQL
+        sort_columns: [(expression, "asc"|"desc"), ...] - cột cuối phải duy nhất (vd: name)
+        page_size: Số dòng mỗi trang
+        offset: Vị trí bắt đầu (chỉ dùng khi không có cursor)
+        cursor: None = dùng OFFSET; "" = trang đầu keyset; chuỗi = next_cursor của trang trước
+        count_mode: exact | estimate | none
+    
+    Returns:
+        tuple: (rows, total, next_cursor)
+    """
+    if count_mode not in ("exact", "estimate", "none"):
+        count_mode = "exact"
+    
+    order_by = ", ".join(f"{expression} {direction.upper()}" for expression, direction in sort_columns)
+    total = _count_rows(from_clause, where_clause, params, count_mode)
+    
+    if cursor is None:
+        rows = frappe.db.sql(f"""
+            SELECT {select_clause}
+            FROM {from_clause}
+            WHERE {where_clause}
+            ORDER BY {order_by}
+            LIMIT %s OFFSET %s
+        """, [*params, page_size, offset], as_dict=True)
+        return rows, total, None
+    
+    page_where = where_clause
+    page_params = list(params)
+    if cursor:
+        seek_condition, seek_params = _keyset_condition(
+            sort_columns, _decode_cursor(cursor, len(sort_columns))
+        )
+        page_where = f"{where_clause} AND {seek_condition}"
+        page_params.extend(seek_params)
+    
+    sort_select = ", ".join(
+        f"{expression} AS sort_key_{i}" for i, (expression, _direction) in enumerate(sort_columns)
+    )
+    
+    # Lấy dư 1 dòng để biết còn trang sau hay không
+    rows = frappe.db.sql(f"""
+        SELECT {select_clause}, {sort_select}
+        FROM {from_clause}
+        WHERE {page_where}
+        ORDER BY {order_by}
+        LIMIT %s
+    """, [*page_params, page_size + 1], as_dict=True)
+    
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    
+    last_sort_key = None
+    for row in rows:
+        last_sort_key = [row.pop(f"sort_key_{i}") for i in range(len(sort_columns))]
+    
+    next_cursor = _encode_cursor(last_sort_key) if has_more and last_sort_key else None
+    
+    return rows, total, next_cursor
+
+
+def _get_status_counts(doctype):
+    """
+    Đếm chứng từ theo (status, docstatus) trong 1 query GROUP BY
+    
+    Returns:
+        dict: {(status, docstatus): count}
+    """
+    rows = frappe.db.sql(f"""
+        SELECT status, docstatus, COUNT(*) as count
+        FROM `tab{doctype}`
+        GROUP BY status, docstatus
+    """, as_dict=True)
+    
+    return {(row.status, row.docstatus): row.count for row in rows}
+
+
+def _sum_status_counts(counts, status=None, docstatus=None):
+    """Cộng kết quả của _get_status_counts theo status và/hoặc docstatus (None = tất cả)"""
+    return sum(
+        count for (row_status, row_docstatus), count in counts.items()
+        if (status is None or row_status == status)
+        and (docstatus is None or row_docstatus == docstatus)
+    )
+
 
 # ============================================
 # MATERIAL RECEIPT APIs
@@ -114,7 +281,8 @@ def create_material_receipt(items=None, posting_date=None, remarks=None, item_co
 
 
 @frappe.whitelist()
-def get_stock_entries(purpose=None, stock_entry_type=None, limit=20, offset=0, search=None, from_date=None, to_date=None, warehouse=None, page=None, page_size=None):
+def get_stock_entries(purpose=None, stock_entry_type=None, limit=20, offset=0, search=None, from_date=None, to_date=None, warehouse=None, page=None, page_size=None,
+                      cursor=None, count_mode="exact"):
     """
     Lấy danh sách Stock Entry (phiếu nhập/xuất kho) với tìm kiếm, filter và phân trang
     
@@ -129,9 +297,11 @@ def get_stock_entries(purpose=None, stock_entry_type=None, limit=20, offset=0, s
         from_date: Ngày bắt đầu (YYYY-MM-DD)
         to_date: Ngày kết thúc (YYYY-MM-DD)
         warehouse: Lọc theo kho
+        cursor: Phân trang keyset - "" cho trang đầu, next_cursor cho các trang sau
+        count_mode: exact (mặc định) | estimate | none
     
     Returns:
-        dict: {data: list, total: int, page: int, page_size: int, total_pages: int}
+        dict: {data: list, total: int, page: int, page_size: int, total_pages: int, next_cursor: str}
     """
     # Hỗ trợ cả offset/limit và page/page_size
     if page is not None and page_size is not None:
@@ -145,50 +315,80 @@ def get_stock_entries(purpose=None, stock_entry_type=None, limit=20, offset=0, s
         page_size = limit
         page = (offset // limit) + 1 if limit > 0 else 1
     
-    filters = {}  # Lấy cả draft và submitted
+    # Build conditions - lấy cả draft và submitted
+    conditions = ["1=1"]
+    params = []
+    
     if purpose:
-        filters["purpose"] = purpose
+        conditions.append("se.purpose = %s")
+        params.append(purpose)
+    
     if stock_entry_type:
-        filters["stock_entry_type"] = stock_entry_type
+        conditions.append("se.stock_entry_type = %s")
+        params.append(stock_entry_type)
+    
     if from_date:
-        filters["posting_date"] = [">=", from_date]
+        conditions.append("se.posting_date >= %s")
+        params.append(from_date)
+    
     if to_date:
-        if "posting_date" in filters:
-            filters["posting_date"] = ["between", [from_date, to_date]]
-        else:
-            filters["posting_date"] = ["<=", to_date]
+        conditions.append("se.posting_date <= %s")
+        params.append(to_date)
     
     # Tìm kiếm theo mã phiếu
     if search:
-        filters["name"] = ["like", f"%{search}%"]
+        conditions.append("se.name LIKE %s")
+        params.append(f"%{search}%")
     
-    # Đếm tổng số bản ghi
-    total_count = frappe.db.count("Stock Entry", filters=filters)
-    
-    entries = frappe.get_all(
-        "Stock Entry",
-        filters=filters,
-        fields=[
-            "name", "purpose", "stock_entry_type", "posting_date",
-            "posting_time", "company", "docstatus", "creation",
-            "owner", "modified_by", "remarks", "total_outgoing_value",
-            "total_incoming_value", "total_amount"
-        ],
-        order_by="creation desc",
-        limit_start=offset,
-        limit_page_length=limit
+    # Lọc theo warehouse: khớp bất kỳ dòng nào có kho nguồn hoặc kho đích là warehouse
+    if warehouse:
+        conditions.append("""EXISTS (
+            SELECT 1 FROM `tabStock Entry Detail` sed
+            WHERE sed.parent = se.name
+            AND sed.parenttype = 'Stock Entry'
+            AND (sed.s_warehouse = %s OR sed.t_warehouse = %s)
+        )""")
+        params.extend([warehouse, warehouse])
+    
+    where_clause = " AND ".join(conditions)
+    
+    entries, total_count, next_cursor = _fetch_page(
+        """
+            se.name, se.purpose, se.stock_entry_type, se.posting_date,
+            se.posting_time, se.company, se.docstatus, se.creation,
+            se.owner, se.modified_by, se.remarks, se.total_outgoing_value,
+            se.total_incoming_value, se.total_amount
+        """,
+        "`tabStock Entry` se",
+        where_clause,
+        params,
+        sort_columns=[("se.creation", "desc"), ("se.name", "desc")],
+        page_size=limit,
+        offset=offset,
+        cursor=cursor,
+        count_mode=count_mode
     )
     
-    # Lấy thông tin items cho mỗi entry
-    for entry in entries:
-        items = frappe.get_all(
+    # Lấy items của tất cả entries trong trang bằng 1 query, rồi nhóm theo parent
+    items_by_parent = {}
+    if entries:
+        all_items = frappe.get_all(
             "Stock Entry Detail",
-            filters={"parent": entry.name},
+            filters={"parent": ["in", [e.name for e in entries]]},
             fields=[
-                "item_code", "item_name", "qty", "uom",
+                "parent", "item_code", "item_name", "qty", "uom",
                 "s_warehouse", "t_warehouse", "basic_rate", "amount"
-            ]
+            ],
+            order_by="parent, idx"
         )
+        for item in all_items:
+            items_by_parent.setdefault(item.pop("parent"), []).append(item)
+    
+    # Lấy tên người thực hiện cho cả trang bằng 1 query
+    owner_names = get_user_full_names(e.owner for e in entries)
+    
+    for entry in entries:
+        items = items_by_parent.get(entry.name, [])
         entry["items"] = items
         
         # Lấy warehouse đích (cho Material Receipt) hoặc nguồn (cho Material Issue)
@@ -197,27 +397,25 @@ def get_stock_entries(purpose=None, stock_entry_type=None, limit=20, offset=0, s
             entry["from_warehouse"] = items[0].get("s_warehouse")
         
         # Lấy tên người thực hiện
-        entry["owner_name"] = frappe.db.get_value("User", entry.owner, "full_name") or entry.owner
+        entry["owner_name"] = owner_names.get(entry.owner) or entry.owner
         
         # Tính tổng số lượng items
         entry["total_qty"] = sum(item.get("qty", 0) for item in items)
         entry["item_count"] = len(items)
     
-    # Lọc theo warehouse nếu có
-    if warehouse:
-        entries = [e for e in entries if e.get("to_warehouse") == warehouse or e.get("from_warehouse") == warehouse]
-        # Cập nhật total_count nếu có filter warehouse
-        total_count = len(entries)
-    
     # Tính tổng số trang
-    total_pages = (total_count + page_size - 1) // page_size if page_size > 0 else 1
+    if total_count is None:
+        total_pages = None
+    else:
+        total_pages = (total_count + page_size - 1) // page_size if page_size > 0 else 1
     
     return {
         "data": entries,
         "total": total_count,
         "page": page,
         "page_size": page_size,
-        "total_pages": total_pages
+        "total_pages": total_pages,
+        "next_cursor": next_cursor
     }
 
 
@@ -255,8 +453,9 @@ def get_stock_entry_detail(name):
         })
     
     # Lấy tên người thực hiện
-    owner_name = frappe.db.get_value("User", doc.owner, "full_name") or doc.owner
-    modified_by_name = frappe.db.get_value("User", doc.modified_by, "full_name") or doc.modified_by
+    user_names = get_user_full_names([doc.owner, doc.modified_by])
+    owner_name = user_names.get(doc.owner) or doc.owner
+    modified_by_name = user_names.get(doc.modified_by) or doc.modified_by
     
     return {
         "success": True,
@@ -385,7 +584,7 @@ def create_material_issue(items=None, posting_date=None, remarks=None, item_code
 # ============================================
 
 @frappe.whitelist()
-def get_work_orders(status=None, docstatus=None, limit=50, page=1):
+def get_work_orders(status=None, docstatus=None, limit=50, page=1, cursor=None, count_mode="exact"):
     """
     Lấy danh sách Work Order với filter và phân trang
     
@@ -394,48 +593,58 @@ def get_work_orders(status=None, docstatus=None, limit=50, page=1):
         docstatus: Lọc theo trạng thái duyệt (0=Draft, 1=Submitted)
         limit: Số lượng kết quả mỗi trang
         page: Số trang (bắt đầu từ 1)
+        cursor: Phân trang keyset - "" cho trang đầu, next_cursor cho các trang sau
+        count_mode: exact (mặc định) | estimate | none
     
     Returns:
-        dict: {data: list, total: int, page: int, total_pages: int}
+        dict: {data: list, total: int, page: int, total_pages: int, next_cursor: str}
     """
-    filters = {}
+    conditions = ["1=1"]
+    params = []
     
     # Lọc theo docstatus
-    if docstatus is not None:
-        filters["docstatus"] = int(docstatus)
+    docstatus_filter = int(docstatus) if docstatus is not None else None
     
     # Lọc theo status
     if status:
         if status == "Draft":
-            filters["docstatus"] = 0
+            docstatus_filter = 0
         else:
-            filters["status"] = status
-            if "docstatus" not in filters:
-                filters["docstatus"] = 1  # Submitted by default for non-draft
+            conditions.append("wo.status = %s")
+            params.append(status)
+            if docstatus_filter is None:
+                docstatus_filter = 1  # Submitted by default for non-draft
+    
+    if docstatus_filter is not None:
+        conditions.append("wo.docstatus = %s")
+        params.append(docstatus_filter)
     
     # Pagination
     limit = int(limit)
     page = int(page)
     offset = (page - 1) * limit
     
-    # Count total
-    total_count = frappe.db.count("Work Order", filters=filters)
-    
-    orders = frappe.get_all(
-        "Work Order",
-        filters=filters,
-        fields=[
-            "name", "production_item", "item_name", 
-            "qty", "produced_qty", "status", "docstatus",
-            "planned_start_date", "expected_delivery_date",
-            "wip_warehouse", "fg_warehouse", "source_warehouse",
-            "bom_no", "creation", "modified", "owner"
-        ],
-        order_by="modified desc",
-        limit_start=offset,
-        limit_page_length=limit
+    orders, total_count, next_cursor = _fetch_page(
+        """
+            wo.name, wo.production_item, wo.item_name,
+            wo.qty, wo.produced_qty, wo.status, wo.docstatus,
+            wo.planned_start_date, wo.expected_delivery_date,
+            wo.wip_warehouse, wo.fg_warehouse, wo.source_warehouse,
+            wo.bom_no, wo.creation, wo.modified, wo.owner
+        """,
+        "`tabWork Order` wo",
+        " AND ".join(conditions),
+        params,
+        sort_columns=[("wo.modified", "desc"), ("wo.name", "desc")],
+        page_size=limit,
+        offset=offset,
+        cursor=cursor,
+        count_mode=count_mode
     )
     
+    # Lấy tên người tạo của cả trang trong 1 query (có cache)
+    owner_names = get_user_full_names(order.owner for order in orders)
+    
     # Enhance data
     for order in orders:
         # Tính phần trăm hoàn thành
@@ -445,7 +654,7 @@ def get_work_orders(status=None, docstatus=None, limit=50, page=1):
             order["progress"] = 0
         
         # Lấy tên người tạo
-        order["owner_name"] = frappe.db.get_value("User", order.owner, "full_name") or order.owner
+        order["owner_name"] = owner_names.get(order.owner) or order.owner
         
         # Thêm status display
         if order.docstatus == 0:
@@ -467,14 +676,18 @@ def get_work_orders(status=None, docstatus=None, limit=50, page=1):
             order["status_display"] = order.status
             order["status_color"] = "gray"
     
-    total_pages = (total_count + limit - 1) // limit if limit > 0 else 1
+    if total_count is None:
+        total_pages = None
+    else:
+        total_pages = (total_count + limit - 1) // limit if limit > 0 else 1
     
     return {
         "data": orders,
         "total": total_count,
         "page": page,
         "page_size": limit,
-        "total_pages": total_pages
+        "total_pages": total_pages,
+        "next_cursor": next_cursor
     }
 
 
@@ -517,7 +730,7 @@ def get_work_order_detail(work_order_name):
         })
     
     # Lấy tên người tạo/duyệt
-    owner_name = frappe.db.get_value("User", doc.owner, "full_name") or doc.owner
+    owner_name = get_user_full_name(doc.owner)
     
     # Lấy Stock Entries liên quan
     stock_entries = frappe.get_all(
@@ -623,12 +836,13 @@ def get_boms(item_code=None, is_active=1, is_default=None):
 
 
 @frappe.whitelist()
-def get_bom_detail(bom_no):
+def get_bom_detail(bom_no, multi_level=0):
     """
     Lấy chi tiết BOM bao gồm danh sách nguyên liệu
     
     Args:
         bom_no: Mã BOM
+        multi_level: 1 = thêm exploded_items (NVL lá sau khi triển khai các BOM con, theo quantity của BOM)
     
     Returns:
         dict: Chi tiết BOM
@@ -651,7 +865,7 @@ def get_bom_detail(bom_no):
             "source_warehouse": item.source_warehouse
         })
     
-    return {
+    result = {
         "success": True,
         "name": doc.name,
         "item": doc.item,
@@ -664,11 +878,111 @@ def get_bom_detail(bom_no):
         "total_cost": doc.total_cost or 0,
         "items": items
     }
+    
+    if int(multi_level or 0):
+        from xuanhoa_app.bom_explosion import get_exploded_items
+        result["exploded_items"] = get_exploded_items(bom_no, doc.quantity)
+    
+    return result
+
+
+def _get_default_work_order_warehouses(company):
+    """
+    Kho mặc định cho Work Order của company (cache Redis theo company, xem cache.py)
+    
+    Returns:
+        dict: {source_warehouse, wip_warehouse, fg_warehouse}
+    """
+    from xuanhoa_app.cache import get_cached_work_order_warehouses
+    return get_cached_work_order_warehouses(company, _build_default_work_order_warehouses)
+
+
+def _build_default_work_order_warehouses(company):
+    """
+    Tính kho mặc định cho Work Order của company
+    
+    - Ưu tiên "Kho Chính - {abbr}" cho cả 3 kho
+    - Kho nguồn: Stock Settings default_warehouse -> kho đầu tiên không phải group
+    - Kho WIP / thành phẩm: kho theo warehouse_type (kho thành phẩm có thể None -> dùng kho nguồn)
+    
+    Returns:
+        dict: {source_warehouse, wip_warehouse, fg_warehouse}
+    """
+    company_abbr = frappe.db.get_value("Company", company, "abbr")
+    main_warehouse = f"Kho Chính - {company_abbr}"
+    if frappe.db.exists("Warehouse", main_warehouse):
+        return {
+            "source_warehouse": main_warehouse,
+            "wip_warehouse": main_warehouse,
+            "fg_warehouse": main_warehouse
+        }
+    
+    source_warehouse = (
+        frappe.db.get_single_value("Stock Settings", "default_warehouse")
+        or frappe.db.get_value("Warehouse", {"is_group": 0}, "name")
+    )
+    return {
+        "source_warehouse": source_warehouse,
+        "wip_warehouse": frappe.db.get_value("Warehouse", {"warehouse_type": "Work In Progress"}, "name"),
+        "fg_warehouse": frappe.db.get_value("Warehouse", {"warehouse_type": "Finished Goods"}, "name")
+    }
+
+
+def _get_work_order_company():
+    """Company dùng khi tạo Work Order"""
+    return frappe.defaults.get_user_default("Company") or frappe.db.get_single_value("Global Defaults", "default_company")
+
+
+def _make_work_order(bom_no, production_item, qty, company, default_warehouses, planned_start_date=None,
+                     expected_delivery_date=None, source_warehouse=None, wip_warehouse=None,
+                     fg_warehouse=None, use_multi_level_bom=None):
+    """
+    Tạo Work Order (chưa insert) với kho đã xác định
+    
+    NVL được sinh từ BOM và gán kho nguồn trước khi insert
+    (validate của Work Order chỉ tính lại số lượng cho các dòng đã có) nên chỉ cần 1 lần insert.
+    use_multi_level_bom = None: giữ mặc định của DocType Work Order (= 1)
+    """
+    source_warehouse = source_warehouse or default_warehouses["source_warehouse"]
+    wip_warehouse = wip_warehouse or default_warehouses["wip_warehouse"]
+    # Dùng kho nguồn làm kho đích nếu không có kho FG
+    fg_warehouse = fg_warehouse or default_warehouses["fg_warehouse"] or source_warehouse
+    
+    doc = frappe.new_doc("Work Order")
+    doc.production_item = production_item
+    doc.bom_no = bom_no
+    doc.qty = float(qty)
+    doc.company = company
+    if use_multi_level_bom is not None:
+        doc.use_multi_level_bom = int(use_multi_level_bom)
+    
+    if planned_start_date:
+        doc.planned_start_date = planned_start_date
+    
+    if expected_delivery_date:
+        doc.expected_delivery_date = expected_delivery_date
+    
+    if source_warehouse:
+        doc.source_warehouse = source_warehouse
+    
+    if wip_warehouse:
+        doc.wip_warehouse = wip_warehouse
+    
+    if fg_warehouse:
+        doc.fg_warehouse = fg_warehouse
+    
+    # CRITICAL FIX: ERPNext lấy kho NVL theo BOM/Item nên có thể sai -> gán lại theo kho nguồn
+    doc.set_required_items()
+    if source_warehouse:
+        for item in doc.required_items:
+            item.source_warehouse = source_warehouse
+    
+    return doc
 
 
 @frappe.whitelist()
 def create_work_order(bom_no, qty, planned_start_date=None, expected_delivery_date=None, 
-                      source_warehouse=None, wip_warehouse=None, fg_warehouse=None):
+                      source_warehouse=None, wip_warehouse=None, fg_warehouse=None, use_multi_level_bom=None):
     """
     Tạo Work Order mới (Draft - chờ duyệt)
     
@@ -680,21 +994,22 @@ def create_work_order(bom_no, qty, planned_start_date=None, expected_delivery_da
         source_warehouse: Kho nguồn nguyên liệu
         wip_warehouse: Kho sản xuất dở dang
         fg_warehouse: Kho thành phẩm
+        use_multi_level_bom: 1 = NVL cần cấp lấy theo BOM nhiều cấp (triển khai bán thành phẩm),
+                             0 = chỉ cấp 1; bỏ trống = giữ mặc định của Work Order (1)
     
     Returns:
         dict: {success: bool, name: str, message: str}
     """
     try:
         # Validate BOM
-        if not frappe.db.exists("BOM", bom_no):
+        bom = frappe.db.get_value("BOM", bom_no, ["item", "is_active"], as_dict=True)
+        if not bom:
             return {"success": False, "message": _("Định mức sản xuất (BOM) không tồn tại. Vui lòng chọn BOM khác.")}
         
-        bom = frappe.get_doc("BOM", bom_no)
-        
         if not bom.is_active:
             return {"success": False, "message": _("Định mức sản xuất (BOM) đã ngừng sử dụng. Vui lòng chọn BOM đang hoạt động.")}
         
-        company = frappe.defaults.get_user_default("Company") or frappe.db.get_single_value("Global Defaults", "default_company")
+        company = _get_work_order_company()
         
         if not company:
             return {"success": False, "message": _("Chưa thiết lập công ty mặc định. Vui lòng liên hệ quản trị viên.")}
@@ -703,70 +1018,22 @@ def create_work_order(bom_no, qty, planned_start_date=None, expected_delivery_da
         if not qty or float(qty) <= 0:
             return {"success": False, "message": _("Số lượng sản xuất phải lớn hơn 0.")}
         
-        # Tạo Work Order
-        doc = frappe.new_doc("Work Order")
-        doc.production_item = bom.item
-        doc.bom_no = bom_no
-        doc.qty = float(qty)
-        doc.company = company
-        
-        if planned_start_date:
-            doc.planned_start_date = planned_start_date
-        
-        if expected_delivery_date:
-            doc.expected_delivery_date = expected_delivery_date
-        
         # Warehouse settings - Tự động lấy warehouse mặc định nếu không truyền vào
-        if not source_warehouse:
-            # Ưu tiên lấy "Kho Chính - XHTB" trước
-            company_abbr = frappe.db.get_value("Company", company, "abbr")
-            source_warehouse = f"Kho Chính - {company_abbr}"
-            
-            # Nếu không tồn tại, lấy kho mặc định từ Stock Settings
-            if not frappe.db.exists("Warehouse", source_warehouse):
-                source_warehouse = frappe.db.get_single_value("Stock Settings", "default_warehouse")
-            
-            # Nếu vẫn không có, lấy warehouse đầu tiên không phải group
-            if not source_warehouse:
-                source_warehouse = frappe.db.get_value("Warehouse", {"is_group": 0}, "name")
-        
-        if source_warehouse:
-            doc.source_warehouse = source_warehouse
-            
-        if not wip_warehouse:
-            # Ưu tiên lấy "Kho Chính - XHTB"
-            company_abbr = frappe.db.get_value("Company", company, "abbr")
-            wip_warehouse = f"Kho Chính - {company_abbr}"
-            if not frappe.db.exists("Warehouse", wip_warehouse):
-                # Lấy kho WIP mặc định
-                wip_warehouse = frappe.db.get_value("Warehouse", {"warehouse_type": "Work In Progress"}, "name")
-            
-        if wip_warehouse:
-            doc.wip_warehouse = wip_warehouse
-            
-        if not fg_warehouse:
-            # Ưu tiên lấy "Kho Chính - XHTB"
-            company_abbr = frappe.db.get_value("Company", company, "abbr")
-            fg_warehouse = f"Kho Chính - {company_abbr}"
-            if not frappe.db.exists("Warehouse", fg_warehouse):
-                # Lấy kho thành phẩm mặc định
-                fg_warehouse = frappe.db.get_value("Warehouse", {"warehouse_type": "Finished Goods"}, "name")
-                if not fg_warehouse:
-                    fg_warehouse = source_warehouse  # Dùng kho nguồn làm kho đích nếu không có kho FG
-                
-        if fg_warehouse:
-            doc.fg_warehouse = fg_warehouse
-        
+        default_warehouses = {"source_warehouse": None, "wip_warehouse": None, "fg_warehouse": None}
+        if not (source_warehouse and wip_warehouse and fg_warehouse):
+            default_warehouses = _get_default_work_order_warehouses(company)
+        
+        doc = _make_work_order(
+            bom_no, bom.item, qty, company, default_warehouses,
+            planned_start_date=planned_start_date,
+            expected_delivery_date=expected_delivery_date,
+            source_warehouse=source_warehouse,
+            wip_warehouse=wip_warehouse,
+            fg_warehouse=fg_warehouse,
+            use_multi_level_bom=use_multi_level_bom
+        )
         doc.insert()
         
-        # CRITICAL FIX: Cập nhật warehouse cho tất cả Work Order Items
-        # ERPNext tự động tạo items từ BOM nhưng có thể dùng warehouse sai
-        if doc.required_items:
-            for item in doc.required_items:
-                if source_warehouse:
-                    item.source_warehouse = source_warehouse
-            doc.save()
-        
         return {
             "success": True,
             "name": doc.name,
@@ -793,6 +1060,125 @@ def create_work_order(bom_no, qty, planned_start_date=None, expected_delivery_da
         }
 
 
+@frappe.whitelist()
+def create_work_orders_bulk(orders, submit=0, atomic=0):
+    """
+    Tạo (và duyệt) nhiều Work Order trong 1 request
+    
+    Company, kho mặc định và BOM được đọc 1 lần cho cả lô.
+    Mỗi dòng chạy trong 1 savepoint: dòng lỗi được rollback riêng, các dòng khác vẫn được tạo.
+    
+    Args:
+        orders: list (hoặc JSON string) [{bom_no, qty, planned_start_date, expected_delivery_date,
+                source_warehouse, wip_warehouse, fg_warehouse, use_multi_level_bom}]
+                - bỏ trống use_multi_level_bom để giữ mặc định của Work Order
+        submit: 1 = duyệt luôn sau khi tạo
+        atomic: 1 = chỉ cần 1 dòng lỗi là rollback toàn bộ lô
+    
+    Returns:
+        dict: {success, results: [{idx, success, name, message}], created, failed, message}
+    """
+    import json
+    
+    try:
+        if isinstance(orders, str):
+            orders = json.loads(orders)
+        
+        orders = orders or []
+        if not orders:
+            return {"success": False, "message": _("Vui lòng nhập ít nhất 1 lệnh sản xuất")}
+        
+        submit = int(submit or 0)
+        atomic = int(atomic or 0)
+        
+        company = _get_work_order_company()
+        if not company:
+            return {"success": False, "message": _("Chưa thiết lập công ty mặc định. Vui lòng liên hệ quản trị viên.")}
+        
+        default_warehouses = _get_default_work_order_warehouses(company)
+        
+        bom_nos = list({order.get("bom_no") for order in orders if order.get("bom_no")})
+        boms = {}
+        if bom_nos:
+            boms = {
+                row.name: row
+                for row in frappe.db.sql("""
+                    SELECT name, item, is_active
+                    FROM `tabBOM`
+                    WHERE name IN %(boms)s AND docstatus = 1
+                """, {"boms": bom_nos}, as_dict=True)
+            }
+        
+        results = []
+        for idx, order in enumerate(orders):
+            bom = boms.get(order.get("bom_no"))
+            qty = order.get("qty")
+            
+            if not bom:
+                results.append({"idx": idx, "success": False, "message": _("Định mức sản xuất (BOM) không tồn tại.")})
+                continue
+            if not bom.is_active:
+                results.append({"idx": idx, "success": False, "message": _("Định mức sản xuất (BOM) đã ngừng sử dụng.")})
+                continue
+            if not qty or float(qty) <= 0:
+                results.append({"idx": idx, "success": False, "message": _("Số lượng sản xuất phải lớn hơn 0.")})
+                continue
+            
+            savepoint = f"xh_work_order_bulk_{idx}"
+            frappe.db.savepoint(savepoint)
+            try:
+                doc = _make_work_order(
+                    bom.name, bom.item, qty, company, default_warehouses,
+                    planned_start_date=order.get("planned_start_date"),
+                    expected_delivery_date=order.get("expected_delivery_date"),
+                    source_warehouse=order.get("source_warehouse"),
+                    wip_warehouse=order.get("wip_warehouse"),
+                    fg_warehouse=order.get("fg_warehouse"),
+                    use_multi_level_bom=order.get("use_multi_level_bom")
+                )
+                doc.insert()
+                if submit:
+                    doc.submit()
+                
+                results.append({
+                    "idx": idx,
+                    "success": True,
+                    "name": doc.name,
+                    "docstatus": doc.docstatus
+                })
+            except Exception as e:
+                frappe.db.rollback(save_point=savepoint)
+                frappe.clear_messages()
+                results.append({"idx": idx, "success": False, "message": _parse_friendly_error(str(e))})
+        
+        failed = sum(1 for row in results if not row["success"])
+        
+        if atomic and failed:
+            frappe.db.rollback()
+            for row in results:
+                if row["success"]:
+                    row.update({"success": False, "name": None, "message": _("Đã hủy do lô có dòng lỗi")})
+            return {
+                "success": False,
+                "results": results,
+                "created": 0,
+                "failed": len(results),
+                "message": _("Có {0} dòng lỗi, không tạo lệnh sản xuất nào").format(failed)
+            }
+        
+        created = len(results) - failed
+        return {
+            "success": failed == 0,
+            "results": results,
+            "created": created,
+            "failed": failed,
+            "message": _("Đã tạo {0}/{1} lệnh sản xuất").format(created, len(results))
+        }
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "create_work_orders_bulk Error")
+        return {"success": False, "message": _parse_friendly_error(str(e))}
+
+
 # Helper function để parse lỗi thân thiện
 def _parse_friendly_error(error_msg):
     """Parse error message thành thông báo thân thiện với người dùng"""
@@ -844,10 +1230,7 @@ def submit_work_order(work_order_name):
         source_warehouse = doc.source_warehouse
         if not source_warehouse:
             # Lấy warehouse mặc định
-            company_abbr = frappe.db.get_value("Company", doc.company, "abbr")
-            source_warehouse = f"Kho Chính - {company_abbr}"
-            if not frappe.db.exists("Warehouse", source_warehouse):
-                source_warehouse = frappe.db.get_single_value("Stock Settings", "default_warehouse")
+            source_warehouse = _get_default_work_order_warehouses(doc.company)["source_warehouse"]
             if source_warehouse:
                 doc.source_warehouse = source_warehouse
         
@@ -872,15 +1255,17 @@ def submit_work_order(work_order_name):
 
 
 @frappe.whitelist()
-def start_work_order(work_order_name):
+def start_work_order(work_order_name, background=0):
     """
     Bắt đầu sản xuất - Chuyển vật tư từ Stores -> WIP
     
     Tạo Stock Entry loại "Material Transfer for Manufacture"
+    
+    Args:
+        work_order_name: Mã lệnh sản xuất
+        background: 1 = tạo Stock Entry trong background job (trả về job_id, xem get_work_order_job_status)
     """
     try:
-        from erpnext.manufacturing.doctype.work_order.work_order import make_stock_entry
-        
         if not frappe.db.exists("Work Order", work_order_name):
             return {"success": False, "message": _("Không tìm thấy lệnh sản xuất. Có thể đã bị xóa.")}
         
@@ -906,15 +1291,9 @@ def start_work_order(work_order_name):
         insufficient_items = []
         source_warehouse = work_order.source_warehouse
         
-        # Nếu chưa có source warehouse, lấy kho "Kho Chính - XHTB" mặc định
+        # Nếu chưa có source warehouse, lấy kho mặc định ("Kho Chính - XHTB" -> Stock Settings -> kho đầu tiên)
         if not source_warehouse:
-            # Ưu tiên lấy "Kho Chính - XHTB"
-            company_abbr = frappe.db.get_value("Company", work_order.company, "abbr")
-            source_warehouse = f"Kho Chính - {company_abbr}"
-            
-            # Nếu không tồn tại, lấy kho từ Stock Settings
-            if not frappe.db.exists("Warehouse", source_warehouse):
-                source_warehouse = frappe.db.get_single_value("Stock Settings", "default_warehouse")
+            source_warehouse = _get_default_work_order_warehouses(work_order.company)["source_warehouse"]
             
             # Cập nhật lại Work Order
             if source_warehouse:
@@ -923,16 +1302,6 @@ def start_work_order(work_order_name):
                 for item in work_order.required_items:
                     item.source_warehouse = source_warehouse
                 work_order.save()
-            else:
-                # Lấy warehouse đầu tiên trong hệ thống
-                warehouse = frappe.db.get_value("Warehouse", {"is_group": 0}, "name")
-                if warehouse:
-                    source_warehouse = warehouse
-                    work_order.source_warehouse = source_warehouse
-                    # CRITICAL FIX: Cập nhật warehouse cho tất cả Work Order Items
-                    for item in work_order.required_items:
-                        item.source_warehouse = source_warehouse
-                    work_order.save()
         
         if not source_warehouse:
             return {
@@ -940,25 +1309,24 @@ def start_work_order(work_order_name):
                 "message": _("Chưa thiết lập kho nguồn nguyên liệu. Vui lòng cập nhật lệnh sản xuất và chọn kho nguồn.")
             }
         
-        for item in work_order.required_items:
-            required_qty = item.required_qty - item.transferred_qty
-            if required_qty <= 0:
-                continue
-                
-            # Lấy tồn kho từ source warehouse
-            available_qty = frappe.db.get_value("Bin", 
-                {"item_code": item.item_code, "warehouse": source_warehouse},
-                "actual_qty"
-            ) or 0
-            
-            if available_qty < required_qty:
-                item_name = frappe.db.get_value("Item", item.item_code, "item_name") or item.item_code
+        # Kiểm tra tồn kho tại source warehouse cho tất cả NVL còn phải cấp (1 lần)
+        availability = _check_availability([
+            {
+                "item_code": item.item_code,
+                "warehouse": source_warehouse,
+                "qty": item.required_qty - item.transferred_qty
+            }
+            for item in work_order.required_items
+            if item.required_qty - item.transferred_qty > 0
+        ])
+        for line in availability:
+            if not line["sufficient"]:
                 insufficient_items.append({
-                    "item_code": item.item_code,
-                    "item_name": item_name,
-                    "required": required_qty,
-                    "available": available_qty,
-                    "shortage": required_qty - available_qty
+                    "item_code": line["item_code"],
+                    "item_name": line["item_name"],
+                    "required": line["required"],
+                    "available": line["available"],
+                    "shortage": line["shortage"]
                 })
         
         if insufficient_items:
@@ -974,12 +1342,15 @@ def start_work_order(work_order_name):
                 "insufficient_items": insufficient_items
             }
         
+        if int(background or 0):
+            return _enqueue_work_order_stock_entry(
+                work_order_name, "Material Transfer for Manufacture", work_order.qty
+            )
+        
         # Tạo Stock Entry loại "Material Transfer for Manufacture"
-        # make_stock_entry returns a dict, so we need to create a doc from it
-        stock_entry_dict = make_stock_entry(work_order_name, "Material Transfer for Manufacture", work_order.qty)
-        stock_entry = frappe.get_doc(stock_entry_dict)
-        stock_entry.insert()
-        stock_entry.submit()
+        stock_entry = _make_work_order_stock_entry(
+            work_order_name, "Material Transfer for Manufacture", work_order.qty
+        )
         
         return {
             "success": True,
@@ -995,15 +1366,18 @@ def start_work_order(work_order_name):
 
 
 @frappe.whitelist()
-def complete_work_order(work_order_name, qty):
+def complete_work_order(work_order_name, qty, background=0):
     """
     Hoàn thành sản xuất - Tiêu hao NVL từ WIP, nhập thành phẩm vào FG
     
     Tạo Stock Entry loại "Manufacture"
+    
+    Args:
+        work_order_name: Mã lệnh sản xuất
+        qty: Số lượng hoàn thành
+        background: 1 = tạo Stock Entry trong background job (trả về job_id, xem get_work_order_job_status)
     """
     try:
-        from erpnext.manufacturing.doctype.work_order.work_order import make_stock_entry
-        
         if not frappe.db.exists("Work Order", work_order_name):
             return {"success": False, "message": _("Không tìm thấy lệnh sản xuất. Có thể đã bị xóa.")}
         
@@ -1048,12 +1422,11 @@ def complete_work_order(work_order_name, qty):
                 "message": _("Số lượng hoàn thành ({0}) vượt quá số lượng còn lại ({1}).").format(int(qty), int(remaining))
             }
         
+        if int(background or 0):
+            return _enqueue_work_order_stock_entry(work_order_name, "Manufacture", float(qty))
+        
         # Tạo Stock Entry loại "Manufacture"
-        # make_stock_entry returns a dict, so we need to create a doc from it
-        stock_entry_dict = make_stock_entry(work_order_name, "Manufacture", float(qty))
-        stock_entry = frappe.get_doc(stock_entry_dict)
-        stock_entry.insert()
-        stock_entry.submit()
+        stock_entry = _make_work_order_stock_entry(work_order_name, "Manufacture", float(qty))
         
         return {
             "success": True,
@@ -1069,6 +1442,245 @@ def complete_work_order(work_order_name, qty):
         }
 
 
+WORK_ORDER_JOB_PREFIX = "xuanhoa_work_order_job"
+WORK_ORDER_JOB_STATUS_TTL = 24 * 60 * 60
+# Bằng timeout của job: worker chết giữa chừng thì slot tự hết hạn
+WORK_ORDER_JOB_LOCK_TTL = 3600
+# Queue riêng để job kho của Work Order không chờ sau các job dài khác (backup, báo cáo...) trong queue long
+WORK_ORDER_JOB_QUEUE = "xuanhoa_work_order"
+
+
+def _make_work_order_stock_entry(work_order_name, purpose, qty, progress=None):
+    """
+    Tạo và submit Stock Entry cho Work Order (dùng chung cho chạy trực tiếp và background job)
+    
+    Args:
+        purpose: "Material Transfer for Manufacture" | "Manufacture"
+        progress: Hàm progress(percent, message) để báo tiến độ (tùy chọn)
+    """
+    from erpnext.manufacturing.doctype.work_order.work_order import make_stock_entry
+    
+    # make_stock_entry returns a dict, so we need to create a doc from it
+    stock_entry = frappe.get_doc(make_stock_entry(work_order_name, purpose, qty))
+    stock_entry.insert()
+    if progress:
+        progress(50, _("Đã tạo phiếu kho {0}, đang ghi sổ").format(stock_entry.name))
+    
+    stock_entry.submit()
+    return stock_entry
+
+
+def _get_work_order_queue():
+    """
+    Queue chạy job kho của Work Order (mặc định xuanhoa_work_order, đổi qua site_config "xuanhoa_work_order_queue")
+    
+    Queue riêng phải được khai báo trong common_site_config.json và có worker chạy:
+        "workers": {"xuanhoa_work_order": {"timeout": 3600}}
+        bench worker --queue xuanhoa_work_order
+    """
+    from frappe.utils.background_jobs import get_queues_timeout
+    
+    queue = frappe.conf.get("xuanhoa_work_order_queue") or WORK_ORDER_JOB_QUEUE
+    if queue not in get_queues_timeout():
+        frappe.throw(
+            _("Queue {0} chưa được cấu hình. Thêm \"workers\": {{\"{0}\": {{\"timeout\": 3600}}}} vào "
+              "common_site_config.json và chạy worker cho queue này (bench worker --queue {0}), "
+              "hoặc tắt chạy nền.").format(queue),
+            title=_("Chưa cấu hình background worker")
+        )
+    return queue
+
+
+def _get_work_order_job_id(work_order_name, purpose):
+    return f"{WORK_ORDER_JOB_PREFIX}|{work_order_name}|{purpose}"
+
+
+def _set_work_order_job_status(job_id, **status):
+    """Ghi trạng thái job vào Redis và gửi realtime event "xuanhoa_work_order_job" cho user"""
+    data = frappe.cache().get_value(job_id) or {"job_id": job_id}
+    data.update(status)
+    frappe.cache().set_value(job_id, data, expires_in_sec=WORK_ORDER_JOB_STATUS_TTL)
+    
+    if data.get("user"):
+        frappe.publish_realtime("xuanhoa_work_order_job", data, user=data["user"])
+    
+    return data
+
+
+def _get_work_order_job_lock_key(job_id):
+    return frappe.cache().make_key(f"{job_id}|lock")
+
+
+def _acquire_work_order_job(job_id):
+    """Giữ slot chạy job bằng SET NX (atomic) - chỉ request giữ được slot mới được enqueue"""
+    return bool(frappe.cache().set(
+        _get_work_order_job_lock_key(job_id), frappe.session.user, nx=True, ex=WORK_ORDER_JOB_LOCK_TTL
+    ))
+
+
+def _release_work_order_job(job_id):
+    frappe.cache().delete(_get_work_order_job_lock_key(job_id))
+
+
+def _discard_work_order_job(job_id):
+    """Request bị rollback: job không được đưa vào queue -> bỏ trạng thái "queued" và trả slot"""
+    frappe.cache().delete_value(job_id)
+    _release_work_order_job(job_id)
+
+
+def _validate_work_order_for_stock_entry(work_order_name, purpose, qty):
+    """
+    Kiểm tra lại Work Order ngay trước khi tạo phiếu kho trong job (khóa dòng Work Order
+    đến hết transaction để 2 job không cùng dựa trên số liệu cũ)
+    
+    Returns:
+        str | None: Thông báo lỗi, None nếu hợp lệ
+    """
+    from frappe.utils import flt
+    
+    work_order = frappe.db.get_value(
+        "Work Order", work_order_name,
+        ["docstatus", "status", "qty", "produced_qty", "material_transferred_for_manufacturing"],
+        as_dict=True, for_update=True
+    )
+    if not work_order:
+        return _("Không tìm thấy lệnh sản xuất. Có thể đã bị xóa.")
+    if work_order.docstatus != 1:
+        return _("Lệnh sản xuất chưa được duyệt hoặc đã bị hủy.")
+    if work_order.status == "Completed":
+        return _("Lệnh sản xuất đã hoàn thành trước đó.")
+    if work_order.status == "Stopped":
+        return _("Lệnh sản xuất đã dừng.")
+    
+    if purpose == "Manufacture":
+        remaining = flt(work_order.qty) - flt(work_order.produced_qty)
+        if flt(qty) > remaining:
+            return _("Số lượng hoàn thành ({0}) vượt quá số lượng còn lại ({1}).").format(qty, remaining)
+    elif flt(work_order.material_transferred_for_manufacturing) >= flt(work_order.qty):
+        return _("Lệnh sản xuất đã được cấp phát đủ nguyên vật liệu.")
+    
+    return None
+
+
+def _enqueue_work_order_stock_entry(work_order_name, purpose, qty):
+    """
+    Đưa việc tạo Stock Entry của Work Order vào background job
+    
+    Job id cố định theo (Work Order, purpose): chỉ request giữ được slot (SET NX) mới enqueue,
+    job cùng loại đang chờ/chạy thì trả về job đó, nên bấm nhiều lần không sinh phiếu trùng.
+    """
+    from functools import partial
+    
+    # Kiểm tra queue trước khi giữ slot để cấu hình thiếu không khóa Work Order
+    queue = _get_work_order_queue()
+    job_id = _get_work_order_job_id(work_order_name, purpose)
+    if not _acquire_work_order_job(job_id):
+        current = frappe.cache().get_value(job_id) or {}
+        return {
+            "success": True,
+            "job_id": job_id,
+            "status": current.get("status") or "queued",
+            "message": _("Lệnh sản xuất {0} đang được xử lý, vui lòng chờ.").format(work_order_name)
+        }
+    
+    _set_work_order_job_status(
+        job_id,
+        work_order=work_order_name,
+        purpose=purpose,
+        qty=qty,
+        user=frappe.session.user,
+        status="queued",
+        progress=0,
+        stock_entry=None,
+        message=None
+    )
+    frappe.db.after_rollback.add(partial(_discard_work_order_job, job_id))
+    
+    # Đưa vào queue sau commit để job đọc được các thay đổi của request (vd: kho nguồn vừa cập nhật)
+    frappe.enqueue(
+        "xuanhoa_app.api._run_work_order_stock_entry",
+        queue=queue,
+        timeout=3600,
+        job_id=job_id,
+        deduplicate=True,
+        enqueue_after_commit=True,
+        work_order_name=work_order_name,
+        purpose=purpose,
+        qty=qty
+    )
+    
+    return {
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "message": _("Đang xử lý lệnh sản xuất {0}, hệ thống sẽ thông báo khi hoàn tất.").format(work_order_name)
+    }
+
+
+def _run_work_order_stock_entry(work_order_name, purpose, qty):
+    """
+    Background job: tạo và submit Stock Entry cho Work Order, cập nhật trạng thái + realtime progress
+    """
+    job_id = _get_work_order_job_id(work_order_name, purpose)
+    
+    def progress(percent, message):
+        _set_work_order_job_status(job_id, status="running", progress=percent, message=message)
+    
+    try:
+        progress(10, _("Đang kiểm tra lệnh sản xuất"))
+        # Dữ liệu lúc enqueue có thể đã cũ (vd: job trước vừa ghi nhận hoàn thành) -> kiểm tra lại
+        error = _validate_work_order_for_stock_entry(work_order_name, purpose, qty)
+        if error:
+            frappe.db.rollback()
+            _set_work_order_job_status(job_id, status="failed", message=error)
+            return
+        
+        progress(20, _("Đang tạo phiếu kho"))
+        stock_entry = _make_work_order_stock_entry(work_order_name, purpose, qty, progress=progress)
+        frappe.db.commit()
+        
+        _set_work_order_job_status(
+            job_id,
+            status="finished",
+            progress=100,
+            stock_entry=stock_entry.name,
+            message=_("Đã tạo phiếu kho {0} cho lệnh sản xuất {1}").format(stock_entry.name, work_order_name)
+        )
+    except Exception as e:
+        frappe.db.rollback()
+        frappe.log_error(frappe.get_traceback(), "_run_work_order_stock_entry Error")
+        # Giữ progress của bước cuối cùng đã chạy
+        _set_work_order_job_status(
+            job_id,
+            status="failed",
+            message=_parse_friendly_error(str(e))
+        )
+    finally:
+        _release_work_order_job(job_id)
+
+
+@frappe.whitelist()
+def get_work_order_job_status(job_id):
+    """
+    Trạng thái background job của start/complete Work Order
+    
+    Returns:
+        dict: {success, job_id, work_order, purpose, qty, status (queued|running|finished|failed),
+               progress, stock_entry, message}
+    """
+    if not (job_id or "").startswith(WORK_ORDER_JOB_PREFIX + "|"):
+        return {"success": False, "message": _("Mã job không hợp lệ")}
+    
+    data = frappe.cache().get_value(job_id)
+    if not data:
+        return {"success": False, "message": _("Không tìm thấy job {0} (có thể đã hết hạn)").format(job_id)}
+    
+    if not frappe.has_permission("Work Order", "read", doc=data.get("work_order")):
+        return {"success": False, "message": _("Bạn không có quyền xem lệnh sản xuất này.")}
+    
+    return dict(data, success=True)
+
+
 @frappe.whitelist()
 def stop_work_order(work_order_name):
     """
@@ -1205,12 +1817,12 @@ def get_dashboard_kpi():
     """
     company = frappe.defaults.get_user_default("Company") or "XUÂN HÒA THÁI BÌNH"
     
-    # Đếm Work Orders theo trạng thái
+    # Đếm Work Orders theo trạng thái (1 query GROUP BY)
+    wo_counts = _get_status_counts("Work Order")
     wo_stats = {}
     statuses = ["Not Started", "In Process", "Completed", "Stopped"]
     for status in statuses:
-        count = frappe.db.count("Work Order", {"status": status, "docstatus": 1})
-        wo_stats[status] = count
+        wo_stats[status] = _sum_status_counts(wo_counts, status=status, docstatus=1)
     
     # Tổng giá trị tồn kho
     stock_value = frappe.db.sql("""
@@ -1218,18 +1830,18 @@ def get_dashboard_kpi():
         FROM `tabBin`
     """, as_dict=True)[0].get("total", 0)
     
-    # Số lượng phiếu nhập/xuất hôm nay
+    # Số lượng phiếu nhập/xuất hôm nay (1 query GROUP BY purpose)
     today = frappe.utils.today()
-    receipts_today = frappe.db.count("Stock Entry", {
-        "purpose": "Material Receipt",
-        "posting_date": today,
-        "docstatus": 1
-    })
-    issues_today = frappe.db.count("Stock Entry", {
-        "purpose": "Material Issue", 
-        "posting_date": today,
-        "docstatus": 1
-    })
+    entries_today = dict(frappe.db.sql("""
+        SELECT purpose, COUNT(*)
+        FROM `tabStock Entry`
+        WHERE docstatus = 1
+        AND posting_date = %s
+        AND purpose IN ('Material Receipt', 'Material Issue')
+        GROUP BY purpose
+    """, (today,)))
+    receipts_today = entries_today.get("Material Receipt", 0)
+    issues_today = entries_today.get("Material Issue", 0)
     
     return {
         "work_orders": wo_stats,
@@ -1240,7 +1852,7 @@ def get_dashboard_kpi():
 
 
 @frappe.whitelist()
-def get_recent_activities(limit=10):
+def get_recent_activities(limit=10, since=None):
     """
     Lấy hoạt động gần đây cho Dashboard
     
@@ -1249,17 +1861,23 @@ def get_recent_activities(limit=10):
     - Work Order hoàn thành
     - Các giao dịch Stock Entry
     
+    Args:
+        limit: Số hoạt động tối đa
+        since: Chỉ lấy hoạt động có modified > since (timestamp của lần poll trước)
+    
     Returns:
         list: Danh sách hoạt động gần đây
     """
-    from frappe.utils import time_diff_in_seconds, now_datetime
-    
     activities = []
     
+    filters = {"docstatus": 1}
+    if since:
+        filters["modified"] = (">", since)
+    
     # Lấy Stock Entry gần đây (nhập/xuất kho)
     stock_entries = frappe.get_all(
         "Stock Entry",
-        filters={"docstatus": 1},
+        filters=filters,
         fields=[
             "name", "purpose", "stock_entry_type", "posting_date", "posting_time",
             "creation", "owner", "modified_by", "modified"
@@ -1267,19 +1885,38 @@ def get_recent_activities(limit=10):
         order_by="modified desc",
         limit=int(limit)
     )
+    if not stock_entries:
+        return activities
+    
+    # Lấy dòng item đầu tiên + tổng số dòng của mỗi phiếu trong 1 query
+    first_items = {
+        row.parent: row
+        for row in frappe.db.sql("""
+            SELECT parent, item_code, item_name, qty, uom, t_warehouse, s_warehouse, item_count
+            FROM (
+                SELECT
+                    parent, item_code, item_name, qty, uom, t_warehouse, s_warehouse,
+                    ROW_NUMBER() OVER (PARTITION BY parent ORDER BY idx) as row_num,
+                    COUNT(*) OVER (PARTITION BY parent) as item_count
+                FROM `tabStock Entry Detail`
+                WHERE parenttype = 'Stock Entry'
+                AND parent IN %(parents)s
+            ) ranked
+            WHERE row_num = 1
+        """, {"parents": [entry.name for entry in stock_entries]}, as_dict=True)
+    }
+    
+    # Lấy tên người thực hiện + người duyệt trong 1 query
+    user_names = get_user_full_names(
+        [entry.owner for entry in stock_entries] + [entry.modified_by for entry in stock_entries]
+    )
     
     for entry in stock_entries:
-        # Lấy thông tin items
-        items = frappe.get_all(
-            "Stock Entry Detail",
-            filters={"parent": entry.name},
-            fields=["item_code", "item_name", "qty", "uom", "t_warehouse", "s_warehouse"]
-        )
+        first_item = first_items.get(entry.name)
         
         # Xây dựng description
-        if items:
-            first_item = items[0]
-            item_count = len(items)
+        if first_item:
+            item_count = first_item.item_count
             if entry.purpose == "Material Receipt":
                 desc = f"{first_item.item_name} - {first_item.qty} {first_item.uom}"
                 if first_item.t_warehouse:
@@ -1300,13 +1937,13 @@ def get_recent_activities(limit=10):
             desc = entry.purpose
         
         # Lấy tên người thực hiện
-        owner_name = frappe.db.get_value("User", entry.owner, "full_name") or entry.owner
+        owner_name = user_names.get(entry.owner) or entry.owner
         owner_initial = owner_name[0].upper() if owner_name else "?"
         
         # Lấy tên người duyệt (modified_by nếu khác owner)
         approver = None
         if entry.modified_by and entry.modified_by != entry.owner:
-            approver = frappe.db.get_value("User", entry.modified_by, "full_name") or entry.modified_by
+            approver = user_names.get(entry.modified_by) or entry.modified_by
         
         # Tính thời gian
         time_ago = get_time_ago(entry.modified)
@@ -1393,71 +2030,114 @@ def search_items(query, item_group=None, warehouse=None, limit=10):
             - warehouse_qty: Tồn kho của kho được chọn (nếu có)
             - standard_selling_rate: Giá bán tiêu chuẩn
     """
+    from xuanhoa_app.search import search_item_codes
+    
+    limit = int(limit)
     filters = {"is_stock_item": 1, "disabled": 0}
     if item_group:
         filters["item_group"] = item_group
     
-    items = frappe.get_all(
-        "Item",
-        filters=filters,
-        or_filters={
-            "item_code": ["like", f"%{query}%"],
-            "item_name": ["like", f"%{query}%"]
-        },
-        fields=["item_code", "item_name", "stock_uom", "item_group", "image", "standard_rate", "valuation_rate"],
-        limit=int(limit)
-    )
+    fields = ["item_code", "item_name", "stock_uom", "item_group", "image", "standard_rate", "valuation_rate"]
+    
+    # Lấy ứng viên từ index tìm kiếm (không dấu), fallback LIKE nếu index không dùng được
+    candidates = search_item_codes(query)
+    if candidates is None:
+        items = frappe.get_all(
+            "Item",
+            filters=filters,
+            or_filters={
+                "item_code": ["like", f"%{query}%"],
+                "item_name": ["like", f"%{query}%"]
+            },
+            fields=fields,
+            limit=limit
+        )
+    elif not candidates:
+        items = []
+    else:
+        # Giữ thứ tự xếp hạng của index: lọc theo từng khối ứng viên (theo thứ tự hạng)
+        # cho đến khi đủ limit dòng qua được bộ lọc DB (disabled, non-stock, item_group)
+        items = []
+        chunk_size = max(limit * 20, 200)
+        for start in range(0, len(candidates), chunk_size):
+            chunk = candidates[start:start + chunk_size]
+            rank = {code: i for i, code in enumerate(chunk)}
+            rows = frappe.get_all("Item", filters=dict(filters, name=["in", chunk]), fields=fields)
+            rows.sort(key=lambda item: rank[item.item_code])
+            items.extend(rows)
+            if len(items) >= limit:
+                break
+        items = items[:limit]
+    
+    if not items:
+        return items
+    
+    item_codes = [item.item_code for item in items]
+    
+    # Tồn kho tất cả kho đọc trực tiếp từ Bin (chỉ các item của trang kết quả, 1 query)
+    # - không dùng bảng tổng hợp vì số liệu hiển thị khi lập chứng từ phải luôn khớp tồn kho thực
+    summary_map = {
+        row.item_code: row
+        for row in frappe.db.sql("""
+            SELECT item_code, SUM(actual_qty) as total_qty, MAX(valuation_rate) as max_valuation_rate
+            FROM `tabBin`
+            WHERE item_code IN %(item_codes)s
+            GROUP BY item_code
+        """, {"item_codes": item_codes}, as_dict=True)
+    }
+    
+    # Tồn kho của kho được chọn (1 query theo item_code + warehouse)
+    warehouse_bins = {}
+    if warehouse:
+        warehouse_bins = {
+            row.item_code: row
+            for row in frappe.db.sql("""
+                SELECT item_code, actual_qty, valuation_rate
+                FROM `tabBin`
+                WHERE item_code IN %(item_codes)s AND warehouse = %(warehouse)s
+            """, {"item_codes": item_codes, "warehouse": warehouse}, as_dict=True)
+        }
+    
+    # Giá bán hiện hành từ Item Price (Selling) - mỗi item lấy dòng valid_from mới nhất (1 query)
+    selling_prices = {
+        row.item_code: row.price_list_rate
+        for row in frappe.db.sql("""
+            SELECT item_code, price_list_rate
+            FROM (
+                SELECT
+                    item_code, price_list_rate,
+                    ROW_NUMBER() OVER (PARTITION BY item_code ORDER BY valid_from DESC) as row_num
+                FROM `tabItem Price`
+                WHERE item_code IN %(item_codes)s
+                  AND selling = 1
+                  AND (valid_from IS NULL OR valid_from <= CURDATE())
+                  AND (valid_upto IS NULL OR valid_upto >= CURDATE())
+            ) ranked
+            WHERE row_num = 1
+        """, {"item_codes": item_codes}, as_dict=True)
+    }
     
-    # Thêm thông tin tồn kho từ Bin và giá bán từ Item Price
     for item in items:
-        # Lấy tổng tồn kho từ tất cả kho
-        bin_data = frappe.db.sql("""
-            SELECT SUM(actual_qty) as total_qty, 
-                   MAX(valuation_rate) as bin_valuation_rate
-            FROM `tabBin` 
-            WHERE item_code = %s
-        """, item.item_code, as_dict=True)
-        
-        if bin_data and bin_data[0]:
-            item["actual_qty"] = bin_data[0].get("total_qty") or 0
-            # Ưu tiên valuation_rate từ Bin, rồi đến standard_rate từ Item
-            if bin_data[0].get("bin_valuation_rate"):
-                item["valuation_rate"] = bin_data[0].get("bin_valuation_rate")
-        else:
-            item["actual_qty"] = 0
+        summary = summary_map.get(item.item_code)
+        
+        # Tổng tồn kho từ tất cả kho
+        item["actual_qty"] = (summary.total_qty if summary else 0) or 0
+        # Ưu tiên valuation_rate từ Bin, rồi đến standard_rate từ Item
+        if summary and summary.max_valuation_rate:
+            item["valuation_rate"] = summary.max_valuation_rate
         
         # Nếu có warehouse, lấy thêm tồn kho của kho đó
         if warehouse:
-            wh_bin = frappe.db.sql("""
-                SELECT actual_qty, valuation_rate
-                FROM `tabBin` 
-                WHERE item_code = %s AND warehouse = %s
-            """, (item.item_code, warehouse), as_dict=True)
-            
-            if wh_bin and wh_bin[0]:
-                item["warehouse_qty"] = wh_bin[0].get("actual_qty") or 0
-                # Cập nhật valuation_rate từ kho được chọn
-                if wh_bin[0].get("valuation_rate"):
-                    item["valuation_rate"] = wh_bin[0].get("valuation_rate")
-            else:
-                item["warehouse_qty"] = 0
+            wh_bin = warehouse_bins.get(item.item_code)
+            item["warehouse_qty"] = (wh_bin.actual_qty if wh_bin else 0) or 0
+            # Cập nhật valuation_rate từ kho được chọn
+            if wh_bin and wh_bin.valuation_rate:
+                item["valuation_rate"] = wh_bin.valuation_rate
         else:
             item["warehouse_qty"] = None  # Chưa chọn kho
         
-        # Lấy giá bán tiêu chuẩn từ Item Price (Selling)
-        selling_price = frappe.db.sql("""
-            SELECT price_list_rate 
-            FROM `tabItem Price` 
-            WHERE item_code = %s 
-              AND selling = 1 
-              AND (valid_from IS NULL OR valid_from <= CURDATE())
-              AND (valid_upto IS NULL OR valid_upto >= CURDATE())
-            ORDER BY valid_from DESC
-            LIMIT 1
-        """, item.item_code, as_dict=True)
-        
-        if selling_price and selling_price[0]:
-            item["standard_selling_rate"] = selling_price[0].get("price_list_rate") or 0
+        if item.item_code in selling_prices:
+            item["standard_selling_rate"] = selling_prices[item.item_code] or 0
         else:
             # Fallback: dùng standard_rate hoặc valuation_rate
             item["standard_selling_rate"] = item.get("standard_rate") or item.get("valuation_rate") or 0
@@ -1525,6 +2205,95 @@ def get_item_stock(item_code, warehouse=None):
     }
 
 
+def _check_availability(lines):
+    """
+    Kiểm tra tồn kho cho nhiều dòng (1 query Bin + 1 query Item)
+    
+    Các dòng cùng item_code + warehouse được cộng dồn nhu cầu trước khi so với tồn kho.
+    
+    Args:
+        lines: list dict {item_code, warehouse, qty}
+    
+    Returns:
+        list: Kết quả theo từng dòng (cùng thứ tự), mỗi dòng gồm
+            item_code, item_name, warehouse, required, total_required, available, shortage, sufficient
+    """
+    from frappe.utils import flt
+    
+    lines = [line for line in lines if line.get("item_code")]
+    if not lines:
+        return []
+    
+    item_codes = list({line["item_code"] for line in lines})
+    warehouses = list({line.get("warehouse") or "" for line in lines})
+    
+    bins = {
+        (row.item_code, row.warehouse): flt(row.actual_qty)
+        for row in frappe.db.sql("""
+            SELECT item_code, warehouse, actual_qty
+            FROM `tabBin`
+            WHERE item_code IN %(item_codes)s AND warehouse IN %(warehouses)s
+        """, {"item_codes": item_codes, "warehouses": warehouses}, as_dict=True)
+    }
+    item_names = dict(frappe.db.sql("""
+        SELECT name, item_name FROM `tabItem` WHERE name IN %(item_codes)s
+    """, {"item_codes": item_codes}))
+    
+    total_required = {}
+    for line in lines:
+        key = (line["item_code"], line.get("warehouse") or "")
+        total_required[key] = total_required.get(key, 0) + flt(line.get("qty"))
+    
+    results = []
+    for line in lines:
+        key = (line["item_code"], line.get("warehouse") or "")
+        available = bins.get(key, 0)
+        shortage = max(total_required[key] - available, 0)
+        results.append({
+            "item_code": line["item_code"],
+            "item_name": item_names.get(line["item_code"]) or line["item_code"],
+            "warehouse": line.get("warehouse"),
+            "required": flt(line.get("qty")),
+            "total_required": total_required[key],
+            "available": available,
+            "shortage": shortage,
+            "sufficient": shortage <= 0
+        })
+    
+    return results
+
+
+@frappe.whitelist()
+def check_availability(lines):
+    """
+    Kiểm tra tồn kho cho nhiều dòng trong 1 lần gọi (dùng trước khi submit chứng từ nhiều dòng)
+    
+    Args:
+        lines: list (hoặc JSON string) [{item_code, warehouse, qty}]
+    
+    Returns:
+        dict: {success, sufficient, lines, insufficient_items}
+    """
+    import json
+    
+    try:
+        if isinstance(lines, str):
+            lines = json.loads(lines)
+        
+        results = _check_availability(lines or [])
+        insufficient_items = [line for line in results if not line["sufficient"]]
+        
+        return {
+            "success": True,
+            "sufficient": not insufficient_items,
+            "lines": results,
+            "insufficient_items": insufficient_items
+        }
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "check_availability Error")
+        return {"success": False, "message": str(e)}
+
+
 # ============================================
 # WAREHOUSE APIs
 # ============================================
@@ -1569,10 +2338,30 @@ def get_warehouses(is_group=None, company=None):
 # ============================================
 
 @frappe.whitelist()
-def get_bom_items(bom_no):
+def get_bom_items(bom_no, multi_level=0):
     """
     Lấy danh sách nguyên liệu trong BOM
-    """
+    
+    Args:
+        bom_no: Mã BOM
+        multi_level: 1 = triển khai các BOM con xuống NVL lá
+    """
+    if int(multi_level or 0):
+        from xuanhoa_app.bom_explosion import get_exploded_items
+        
+        quantity = frappe.db.get_value("BOM", bom_no, "quantity") or 1
+        return [
+            {
+                "item_code": item["item_code"],
+                "item_name": item["item_name"],
+                "qty": item["qty"],
+                "qty_required": item["qty"],
+                "uom": item["stock_uom"],
+                "source_warehouse": item["source_warehouse"]
+            }
+            for item in get_exploded_items(bom_no, quantity)
+        ]
+    
     bom = frappe.get_doc("BOM", bom_no)
     
     items = []
@@ -1591,6 +2380,41 @@ def get_bom_items(bom_no):
     return items  # Trả về list thay vì dict cho frontend đơn giản hơn
 
 
+@frappe.whitelist()
+def explode_bom(bom_no, qty=1):
+    """
+    Triển khai BOM nhiều cấp: tổng NVL lá cần để sản xuất qty thành phẩm
+    
+    Như ERPNext, chỉ triển khai tiếp dòng BOM Item có bom_no (không tự lấy BOM mặc định của bán thành phẩm)
+    
+    Args:
+        bom_no: Mã BOM
+        qty: Số lượng thành phẩm (theo stock_uom của sản phẩm)
+    
+    Returns:
+        dict: {success, bom_no, item, qty, items: [{item_code, item_name, stock_uom, source_warehouse, qty}]}
+    """
+    from xuanhoa_app.bom_explosion import get_exploded_items
+    
+    try:
+        item = frappe.db.get_value("BOM", bom_no, "item")
+        if not item:
+            return {"success": False, "message": _("Không tìm thấy BOM {0}").format(bom_no)}
+        
+        return {
+            "success": True,
+            "bom_no": bom_no,
+            "item": item,
+            "qty": float(qty),
+            "items": get_exploded_items(bom_no, qty)
+        }
+    except frappe.ValidationError as e:
+        return {"success": False, "message": str(e)}
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "explode_bom Error")
+        return {"success": False, "message": str(e)}
+
+
 @frappe.whitelist()
 def get_items():
     """
@@ -1605,6 +2429,284 @@ def get_items():
     )
 
 
+# ============================================
+# MRP APIs
+# ============================================
+
+@frappe.whitelist()
+def plan_material_requirements(demands, warehouse=None, include_ordered=1, shortage_only=0):
+    """
+    Hoạch định nhu cầu NVL (MRP) cho nhiều lệnh sản xuất dự kiến cùng lúc
+    
+    - Mỗi dòng nhu cầu được triển khai theo BOM (bom_no hoặc BOM mặc định của item_code),
+      mã hàng không có BOM được tính là nhu cầu trực tiếp; bản thân thành phẩm của dòng nhu cầu không bị đối trừ tồn
+    - Đối trừ tồn theo từng cấp (low-level code = cấp sâu nhất của mã hàng trong các cây BOM):
+      nhu cầu được cộng dồn theo (mã hàng, kho); bán thành phẩm (dòng BOM Item có bom_no) được đối trừ tồn trước,
+      chỉ phần thiếu (to_manufacture_qty) mới được triển khai tiếp xuống cấp dưới
+    - Tồn kho đọc từ `tabBin` trong 1 query:
+      khả dụng = tồn thực tế - đã giữ cho đơn bán - đã giữ cho sản xuất (+ đang đặt mua nếu include_ordered)
+    
+    Args:
+        demands: list (hoặc JSON string) [{item_code | bom_no, qty, date, warehouse}]
+            - warehouse: kho cấp NVL cho dòng nhu cầu (tùy chọn)
+        warehouse: Kho cấp NVL mặc định (mặc định: kho nguồn trên BOM Item, rồi kho nguồn mặc định của Work Order)
+        include_ordered: 1 = tính cả số lượng đang đặt mua (ordered_qty) vào khả dụng
+        shortage_only: 1 = chỉ trả về các dòng bị thiếu
+    
+    Returns:
+        dict: {success, items: [...], errors: [{idx, message}], summary: {...}}
+            - items: [{item_code, warehouse, required_qty, ..., shortage_qty, is_sub_assembly, bom_no,
+                       to_manufacture_qty (phần thiếu cần sản xuất), suggested_qty (phần thiếu cần mua)}]
+    """
+    import json
+
+    from frappe.utils import flt, getdate
+
+    from xuanhoa_app.bom_explosion import explode_boms, load_bom_graph
+    
+    try:
+        if isinstance(demands, str):
+            demands = json.loads(demands)
+        
+        demands = demands or []
+        if not demands:
+            return {"success": False, "message": _("Vui lòng nhập ít nhất 1 dòng nhu cầu")}
+        
+        company = _get_work_order_company()
+        default_warehouse = warehouse or (
+            _get_default_work_order_warehouses(company)["source_warehouse"] if company
+            else frappe.db.get_single_value("Stock Settings", "default_warehouse")
+        )
+        
+        # Xác định BOM cho từng dòng nhu cầu (1 query BOM theo mã, 1 query BOM mặc định theo item)
+        bom_nos = list({d.get("bom_no") for d in demands if d.get("bom_no")})
+        valid_boms = set()
+        if bom_nos:
+            valid_boms = {row[0] for row in frappe.db.sql("""
+                SELECT name FROM `tabBOM`
+                WHERE name IN %(boms)s AND docstatus = 1
+            """, {"boms": bom_nos})}
+        
+        direct_items = list({d.get("item_code") for d in demands if d.get("item_code") and not d.get("bom_no")})
+        default_boms = {}
+        if direct_items:
+            default_boms = dict(frappe.db.sql("""
+                SELECT item, name FROM `tabBOM`
+                WHERE item IN %(items)s
+                AND is_default = 1 AND is_active = 1 AND docstatus = 1
+            """, {"items": direct_items}))
+        
+        errors = []
+        resolved = []
+        for idx, demand in enumerate(demands):
+            qty = flt(demand.get("qty"))
+            bom_no = demand.get("bom_no") or default_boms.get(demand.get("item_code"))
+            
+            if qty <= 0:
+                errors.append({"idx": idx, "message": _("Số lượng phải lớn hơn 0")})
+            elif demand.get("bom_no") and demand["bom_no"] not in valid_boms:
+                errors.append({"idx": idx, "message": _("Không tìm thấy BOM {0}").format(demand["bom_no"])})
+            elif not bom_no and not demand.get("item_code"):
+                errors.append({"idx": idx, "message": _("Thiếu mã hàng hoặc BOM")})
+            else:
+                resolved.append((idx, bom_no, demand.get("item_code"), qty, demand.get("date"), demand.get("warehouse")))
+        
+        # Kiểm tra BOM (vd: BOM lặp vòng) bằng triển khai chung 1 lượt (có cache); nếu lỗi thì kiểm tra riêng từng BOM
+        # để chỉ các dòng dùng BOM lỗi bị báo lỗi
+        bom_nos = list(dict.fromkeys(row[1] for row in resolved if row[1]))
+        bom_errors = {}
+        try:
+            explode_boms(bom_nos)
+        except frappe.ValidationError:
+            frappe.clear_messages()
+            for bom_no in bom_nos:
+                try:
+                    explode_boms([bom_no])
+                except frappe.ValidationError as e:
+                    frappe.clear_messages()
+                    bom_errors[bom_no] = str(e)
+        
+        # Cây BOM của các BOM hợp lệ (đã kiểm tra lặp vòng ở bước trên) để đối trừ theo từng cấp
+        graph = load_bom_graph([bom_no for bom_no in bom_nos if bom_no not in bom_errors])
+        
+        # Low-level code: cấp sâu nhất của mã hàng trong các cây BOM (thành phần trực tiếp của BOM nhu cầu = 1)
+        low_level_codes = {}
+        bom_depths = {}
+        
+        def assign_low_level_codes(bom_no, depth):
+            if bom_depths.get(bom_no, -1) >= depth:
+                return
+            bom_depths[bom_no] = depth
+            for row in graph[bom_no]["items"]:
+                low_level_codes[row.item_code] = max(low_level_codes.get(row.item_code, 0), depth + 1)
+                if row.child_bom in graph:
+                    assign_low_level_codes(row.child_bom, depth + 1)
+        
+        for bom_no in bom_nos:
+            if bom_no in graph:
+                assign_low_level_codes(bom_no, 0)
+        
+        # Thông tin mã hàng (1 query cho mã nhu cầu trực tiếp + toàn bộ mã trong cây BOM)
+        item_codes = {row[2] for row in resolved if not row[1]}
+        for bom in graph.values():
+            item_codes.update(row.item_code for row in bom["items"])
+        
+        items = {}
+        if item_codes:
+            items = {
+                row.name: row
+                for row in frappe.db.sql("""
+                    SELECT name, item_name, stock_uom, min_order_qty
+                    FROM `tabItem`
+                    WHERE name IN %(items)s
+                """, {"items": list(item_codes)}, as_dict=True)
+            }
+        
+        # Nhu cầu cộng dồn theo (mã hàng, kho); sources giữ phần nhu cầu theo (BOM con, kho chỉ định của dòng nhu cầu)
+        # để triển khai phần thiếu của bán thành phẩm xuống cấp dưới
+        requirements = {}
+        
+        def add_requirement(item_code, child_bom, override_warehouse, qty, required_date, source_warehouse=None):
+            line_warehouse = override_warehouse or source_warehouse or default_warehouse
+            key = (item_code, line_warehouse)
+            requirement = requirements.get(key)
+            if requirement is None:
+                requirement = requirements[key] = {
+                    "item_code": item_code,
+                    "warehouse": line_warehouse,
+                    "required_qty": 0,
+                    "required_date": None,
+                    "sources": {}
+                }
+            requirement["required_qty"] += qty
+            source_key = (child_bom if child_bom in graph else None, override_warehouse)
+            requirement["sources"][source_key] = requirement["sources"].get(source_key, 0) + qty
+            if required_date and (not requirement["required_date"] or required_date < requirement["required_date"]):
+                requirement["required_date"] = required_date
+        
+        def add_bom_components(bom_no, override_warehouse, qty, required_date):
+            bom = graph[bom_no]
+            for row in bom["items"]:
+                add_requirement(
+                    row.item_code, row.child_bom, override_warehouse,
+                    flt(row.stock_qty) / bom["quantity"] * qty, required_date, row.source_warehouse
+                )
+        
+        planned_lines = 0
+        for idx, bom_no, item_code, qty, date, demand_warehouse in resolved:
+            if bom_no in bom_errors:
+                errors.append({"idx": idx, "message": bom_errors[bom_no]})
+                continue
+            elif not bom_no and item_code not in items:
+                errors.append({"idx": idx, "message": _("Sản phẩm {0} không tồn tại").format(item_code)})
+                continue
+            
+            planned_lines += 1
+            required_date = getdate(date) if date else None
+            override_warehouse = demand_warehouse or warehouse
+            if bom_no:
+                add_bom_components(bom_no, override_warehouse, qty, required_date)
+            else:
+                add_requirement(item_code, None, override_warehouse, qty, required_date)
+        
+        # Tồn kho (1 query Bin cho mọi mã hàng / kho có thể phát sinh nhu cầu)
+        candidate_warehouses = {default_warehouse, warehouse}
+        candidate_warehouses.update(row[5] for row in resolved)
+        for bom in graph.values():
+            candidate_warehouses.update(row.source_warehouse for row in bom["items"])
+        candidate_warehouses.discard(None)
+        
+        bins = {}
+        if item_codes and candidate_warehouses:
+            bins = {
+                (row.item_code, row.warehouse): row
+                for row in frappe.db.sql("""
+                    SELECT item_code, warehouse, actual_qty, reserved_qty, reserved_qty_for_production, ordered_qty
+                    FROM `tabBin`
+                    WHERE item_code IN %(items)s AND warehouse IN %(warehouses)s
+                """, {
+                    "items": list(item_codes),
+                    "warehouses": list(candidate_warehouses)
+                }, as_dict=True)
+            }
+        
+        # Đối trừ theo thứ tự low-level code: khi xử lý 1 cấp thì nhu cầu từ mọi cấp trên đã được cộng đủ
+        include_ordered = int(include_ordered or 0)
+        shortage_only = int(shortage_only or 0)
+        max_level = max(low_level_codes.values(), default=0)
+        for level in range(max_level + 1):
+            for key, requirement in list(requirements.items()):
+                if low_level_codes.get(key[0], 0) != level:
+                    continue
+                
+                bin_row = bins.get(key) or {}
+                actual_qty = flt(bin_row.get("actual_qty"))
+                reserved_qty = flt(bin_row.get("reserved_qty")) + flt(bin_row.get("reserved_qty_for_production"))
+                ordered_qty = flt(bin_row.get("ordered_qty"))
+                available_qty = actual_qty - reserved_qty + (ordered_qty if include_ordered else 0)
+                shortage_qty = max(requirement["required_qty"] - max(available_qty, 0), 0)
+                
+                # Phần thiếu chia theo tỉ lệ nhu cầu của từng nguồn; nguồn có BOM con được sản xuất (triển khai tiếp),
+                # nguồn không có BOM con được đề xuất mua
+                ratio = shortage_qty / requirement["required_qty"] if requirement["required_qty"] else 0
+                to_manufacture_qty = 0
+                child_boms = []
+                for (child_bom, override_warehouse), qty in requirement["sources"].items():
+                    if not child_bom:
+                        continue
+                    child_boms.append(child_bom)
+                    to_manufacture_qty += qty * ratio
+                    if qty * ratio > 0:
+                        add_bom_components(child_bom, override_warehouse, qty * ratio, requirement["required_date"])
+                
+                requirement.update({
+                    "actual_qty": actual_qty,
+                    "reserved_qty": reserved_qty,
+                    "ordered_qty": ordered_qty,
+                    "available_qty": available_qty,
+                    "shortage_qty": shortage_qty,
+                    "is_sub_assembly": bool(child_boms),
+                    "bom_no": child_boms[0] if child_boms else None,
+                    "to_manufacture_qty": to_manufacture_qty,
+                    "purchase_qty": max(shortage_qty - to_manufacture_qty, 0)
+                })
+        
+        result = []
+        for key, requirement in sorted(requirements.items(), key=lambda entry: (entry[0][0], entry[0][1] or "")):
+            if shortage_only and requirement["shortage_qty"] <= 0:
+                continue
+            
+            item = items.get(key[0]) or {}
+            purchase_qty = requirement.pop("purchase_qty")
+            requirement.pop("sources")
+            min_order_qty = flt(item.get("min_order_qty"))
+            requirement.update({
+                "item_name": item.get("item_name") or key[0],
+                "stock_uom": item.get("stock_uom"),
+                "min_order_qty": min_order_qty,
+                "suggested_qty": max(purchase_qty, min_order_qty) if purchase_qty > 0 else 0
+            })
+            result.append(requirement)
+        
+        return {
+            "success": True,
+            "items": result,
+            "errors": sorted(errors, key=lambda error: error["idx"]),
+            "summary": {
+                "demand_lines": len(demands),
+                "planned_lines": planned_lines,
+                "material_lines": len(requirements),
+                "sub_assembly_lines": sum(1 for row in requirements.values() if row["is_sub_assembly"]),
+                "shortage_lines": sum(1 for row in result if row["shortage_qty"] > 0)
+            }
+        }
+    except frappe.ValidationError as e:
+        return {"success": False, "message": str(e)}
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "plan_material_requirements Error")
+        return {"success": False, "message": str(e)}
+
+
 # ============================================
 # SUPPLIER APIs
 # ============================================
@@ -1679,13 +2781,54 @@ def get_customers(query=None, limit=20):
     return customers
 
 
+# ============================================
+# SEARCH APIs
+# ============================================
+
+@frappe.whitelist()
+def search_documents(query, doctypes=None, limit=20):
+    """
+    Tìm kiếm chứng từ không dấu trên nhiều loại chứng từ trong 1 query
+    (Stock Entry, Purchase/Sales Invoice, Work Order, Supplier, Customer)
+    
+    Args:
+        query: Từ khóa (mã chứng từ, tên đối tác, tên hàng, ghi chú)
+        doctypes: Giới hạn loại chứng từ (list hoặc JSON string), mặc định tất cả
+        limit: Số kết quả tối đa
+    
+    Returns:
+        list: [{doctype, name, title, score}] xếp theo độ liên quan
+    """
+    import json
+
+    from xuanhoa_app.search import DOCUMENT_SEARCH_SOURCES
+    from xuanhoa_app.search import search_documents as _search_documents
+    
+    if doctypes and isinstance(doctypes, str):
+        doctypes = json.loads(doctypes)
+    
+    # Chỉ tìm trong các loại chứng từ user có quyền đọc
+    allowed = [
+        d for d in (doctypes or DOCUMENT_SEARCH_SOURCES)
+        if d in DOCUMENT_SEARCH_SOURCES and frappe.has_permission(d, "read")
+    ]
+    if not allowed:
+        return []
+    
+    try:
+        return _search_documents(query, allowed, limit=limit)
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "search_documents Error")
+        return []
+
+
 # ============================================
 # PURCHASE INVOICE APIs
 # ============================================
 
 @frappe.whitelist()
 def get_purchase_invoices(status=None, supplier=None, from_date=None, to_date=None, 
-                          search=None, limit=20, page=1):
+                          search=None, limit=20, page=1, cursor=None, count_mode="exact"):
     """
     Lấy danh sách hóa đơn mua hàng
     
@@ -1697,71 +2840,75 @@ def get_purchase_invoices(status=None, supplier=None, from_date=None, to_date=No
         search: Tìm kiếm theo mã hóa đơn
         limit: Số bản ghi mỗi trang
         page: Số trang
+        cursor: Phân trang keyset - "" cho trang đầu, next_cursor cho các trang sau
+        count_mode: exact (mặc định) | estimate | none
     
     Returns:
-        dict: {data: list, total: int, page: int, total_pages: int}
+        dict: {data: list, total: int, page: int, total_pages: int, next_cursor: str}
     """
-    filters = {}
+    conditions = ["1=1"]
+    params = []
     
     # Lọc theo status
     if status:
         if status == "Draft":
-            filters["docstatus"] = 0
+            conditions.append("pi.docstatus = 0")
         elif status == "Cancelled":
-            filters["docstatus"] = 2
+            conditions.append("pi.docstatus = 2")
         elif status == "Unpaid":
-            filters["docstatus"] = 1
-            filters["outstanding_amount"] = [">", 0]
+            conditions.append("pi.docstatus = 1 AND pi.outstanding_amount > 0")
         elif status == "Paid":
-            filters["docstatus"] = 1
-            filters["outstanding_amount"] = 0
+            conditions.append("pi.docstatus = 1 AND pi.outstanding_amount = 0")
         elif status == "Overdue":
-            filters["docstatus"] = 1
-            filters["outstanding_amount"] = [">", 0]
-            filters["due_date"] = ["<", frappe.utils.today()]
+            conditions.append("pi.docstatus = 1 AND pi.outstanding_amount > 0 AND pi.due_date < %s")
+            params.append(frappe.utils.today())
     
     if supplier:
-        filters["supplier"] = supplier
+        conditions.append("pi.supplier = %s")
+        params.append(supplier)
     
     if from_date:
-        filters["posting_date"] = [">=", from_date]
+        conditions.append("pi.posting_date >= %s")
+        params.append(from_date)
     if to_date:
-        if "posting_date" in filters:
-            filters["posting_date"] = ["between", [from_date, to_date]]
-        else:
-            filters["posting_date"] = ["<=", to_date]
+        conditions.append("pi.posting_date <= %s")
+        params.append(to_date)
     
     if search:
-        filters["name"] = ["like", f"%{search}%"]
+        conditions.append("pi.name LIKE %s")
+        params.append(f"%{search}%")
     
     # Pagination
     limit = int(limit)
     page = int(page)
     offset = (page - 1) * limit
     
-    # Count total
-    total_count = frappe.db.count("Purchase Invoice", filters=filters)
-    
-    invoices = frappe.get_all(
-        "Purchase Invoice",
-        filters=filters,
-        fields=[
-            "name", "supplier", "supplier_name", "posting_date", "due_date",
-            "grand_total", "outstanding_amount", "currency", "docstatus",
-            "is_paid", "status", "creation", "owner"
-        ],
-        order_by="creation desc",
-        limit_start=offset,
-        limit_page_length=limit
+    invoices, total_count, next_cursor = _fetch_page(
+        """
+            pi.name, pi.supplier, pi.supplier_name, pi.posting_date, pi.due_date,
+            pi.grand_total, pi.outstanding_amount, pi.currency, pi.docstatus,
+            pi.is_paid, pi.status, pi.creation, pi.owner
+        """,
+        "`tabPurchase Invoice` pi",
+        " AND ".join(conditions),
+        params,
+        sort_columns=[("pi.creation", "desc"), ("pi.name", "desc")],
+        page_size=limit,
+        offset=offset,
+        cursor=cursor,
+        count_mode=count_mode
     )
     
+    # Lấy tên người tạo của cả trang trong 1 query (có cache)
+    owner_names = get_user_full_names(inv.owner for inv in invoices)
+    
     # Enhance data
     for inv in invoices:
         # Lấy số lượng items
         inv["item_count"] = frappe.db.count("Purchase Invoice Item", {"parent": inv.name})
         
         # Lấy tên người tạo
-        inv["owner_name"] = frappe.db.get_value("User", inv.owner, "full_name") or inv.owner
+        inv["owner_name"] = owner_names.get(inv.owner) or inv.owner
         
         # Status display
         if inv.docstatus == 0:
@@ -1786,14 +2933,18 @@ def get_purchase_invoices(status=None, supplier=None, from_date=None, to_date=No
             "docstatus": ["!=", 2]
         }) or False
     
-    total_pages = (total_count + limit - 1) // limit if limit > 0 else 1
+    if total_count is None:
+        total_pages = None
+    else:
+        total_pages = (total_count + limit - 1) // limit if limit > 0 else 1
     
     return {
         "data": invoices,
         "total": total_count,
         "page": page,
         "page_size": limit,
-        "total_pages": total_pages
+        "total_pages": total_pages,
+        "next_cursor": next_cursor
     }
 
 
@@ -1829,7 +2980,7 @@ def get_purchase_invoice_detail(name):
         })
     
     # Lấy tên người thực hiện
-    owner_name = frappe.db.get_value("User", doc.owner, "full_name") or doc.owner
+    owner_name = get_user_full_name(doc.owner)
     
     # Lấy Stock Entries liên quan (tìm qua remarks vì Stock Entry không có trường purchase_invoice)
     # Khi tạo Stock Entry từ Purchase Invoice, ta sẽ lưu reference trong remarks
@@ -2262,7 +3413,7 @@ def get_mode_of_payments():
 
 @frappe.whitelist()
 def get_sales_invoices(status=None, customer=None, from_date=None, to_date=None,
-                       search=None, limit=20, page=1):
+                       search=None, limit=20, page=1, cursor=None, count_mode="exact"):
     """
     Lấy danh sách hóa đơn bán hàng
     
@@ -2274,71 +3425,75 @@ def get_sales_invoices(status=None, customer=None, from_date=None, to_date=None,
         search: Tìm kiếm theo mã hóa đơn
         limit: Số bản ghi mỗi trang
         page: Số trang
+        cursor: Phân trang keyset - "" cho trang đầu, next_cursor cho các trang sau
+        count_mode: exact (mặc định) | estimate | none
     
     Returns:
-        dict: {data: list, total: int, page: int, total_pages: int}
+        dict: {data: list, total: int, page: int, total_pages: int, next_cursor: str}
     """
-    filters = {}
+    conditions = ["1=1"]
+    params = []
     
     # Lọc theo status
     if status:
         if status == "Draft":
-            filters["docstatus"] = 0
+            conditions.append("si.docstatus = 0")
         elif status == "Cancelled":
-            filters["docstatus"] = 2
+            conditions.append("si.docstatus = 2")
         elif status == "Unpaid":
-            filters["docstatus"] = 1
-            filters["outstanding_amount"] = [">", 0]
+            conditions.append("si.docstatus = 1 AND si.outstanding_amount > 0")
         elif status == "Paid":
-            filters["docstatus"] = 1
-            filters["outstanding_amount"] = 0
+            conditions.append("si.docstatus = 1 AND si.outstanding_amount = 0")
         elif status == "Overdue":
-            filters["docstatus"] = 1
-            filters["outstanding_amount"] = [">", 0]
-            filters["due_date"] = ["<", frappe.utils.today()]
+            conditions.append("si.docstatus = 1 AND si.outstanding_amount > 0 AND si.due_date < %s")
+            params.append(frappe.utils.today())
     
     if customer:
-        filters["customer"] = customer
+        conditions.append("si.customer = %s")
+        params.append(customer)
     
     if from_date:
-        filters["posting_date"] = [">=", from_date]
+        conditions.append("si.posting_date >= %s")
+        params.append(from_date)
     if to_date:
-        if "posting_date" in filters:
-            filters["posting_date"] = ["between", [from_date, to_date]]
-        else:
-            filters["posting_date"] = ["<=", to_date]
+        conditions.append("si.posting_date <= %s")
+        params.append(to_date)
     
     if search:
-        filters["name"] = ["like", f"%{search}%"]
+        conditions.append("si.name LIKE %s")
+        params.append(f"%{search}%")
     
     # Pagination
     limit = int(limit)
     page = int(page)
     offset = (page - 1) * limit
     
-    # Count total
-    total_count = frappe.db.count("Sales Invoice", filters=filters)
-    
-    invoices = frappe.get_all(
-        "Sales Invoice",
-        filters=filters,
-        fields=[
-            "name", "customer", "customer_name", "posting_date", "due_date",
-            "grand_total", "outstanding_amount", "currency", "docstatus",
-            "status", "creation", "owner"
-        ],
-        order_by="creation desc",
-        limit_start=offset,
-        limit_page_length=limit
+    invoices, total_count, next_cursor = _fetch_page(
+        """
+            si.name, si.customer, si.customer_name, si.posting_date, si.due_date,
+            si.grand_total, si.outstanding_amount, si.currency, si.docstatus,
+            si.status, si.creation, si.owner
+        """,
+        "`tabSales Invoice` si",
+        " AND ".join(conditions),
+        params,
+        sort_columns=[("si.creation", "desc"), ("si.name", "desc")],
+        page_size=limit,
+        offset=offset,
+        cursor=cursor,
+        count_mode=count_mode
     )
     
+    # Lấy tên người tạo của cả trang trong 1 query (có cache)
+    owner_names = get_user_full_names(inv.owner for inv in invoices)
+    
     # Enhance data
     for inv in invoices:
         # Lấy số lượng items
         inv["item_count"] = frappe.db.count("Sales Invoice Item", {"parent": inv.name})
         
         # Lấy tên người tạo
-        inv["owner_name"] = frappe.db.get_value("User", inv.owner, "full_name") or inv.owner
+        inv["owner_name"] = owner_names.get(inv.owner) or inv.owner
         
         # Status display
         if inv.docstatus == 0:
@@ -2363,7 +3518,10 @@ def get_sales_invoices(status=None, customer=None, from_date=None, to_date=None,
             "docstatus": ["!=", 2]
         }) or False
     
-    total_pages = (total_count + limit - 1) // limit if limit > 0 else 1
+    if total_count is None:
+        total_pages = None
+    else:
+        total_pages = (total_count + limit - 1) // limit if limit > 0 else 1
     
     return {
         "success": True,
@@ -2371,7 +3529,8 @@ def get_sales_invoices(status=None, customer=None, from_date=None, to_date=None,
         "total": total_count,
         "page": page,
         "page_size": limit,
-        "total_pages": total_pages
+        "total_pages": total_pages,
+        "next_cursor": next_cursor
     }
 
 
@@ -2416,7 +3575,7 @@ def get_sales_invoice_detail(name):
         })
     
     # Lấy tên người thực hiện
-    owner_name = frappe.db.get_value("User", doc.owner, "full_name") or doc.owner
+    owner_name = get_user_full_name(doc.owner)
     
     # Lấy Stock Entries liên quan (dùng sales_invoice_no)
     stock_entries = frappe.get_all(
@@ -2678,21 +3837,18 @@ def create_stock_entry_from_sales_invoice(sales_invoice, warehouse=None):
         source_warehouse = warehouse or si.set_warehouse
         insufficient_items = []
         
-        for item in si.items:
-            item_warehouse = item.warehouse or source_warehouse
-            actual_qty = frappe.db.get_value("Bin", {
-                "item_code": item.item_code,
-                "warehouse": item_warehouse
-            }, "actual_qty") or 0
-            
-            if actual_qty < item.qty:
-                item_name = frappe.db.get_value("Item", item.item_code, "item_name") or item.item_code
+        availability = _check_availability([
+            {"item_code": item.item_code, "warehouse": item.warehouse or source_warehouse, "qty": item.qty}
+            for item in si.items
+        ])
+        for line in availability:
+            if not line["sufficient"]:
                 insufficient_items.append({
-                    "item_code": item.item_code,
-                    "item_name": item_name,
-                    "required": item.qty,
-                    "available": actual_qty,
-                    "warehouse": item_warehouse
+                    "item_code": line["item_code"],
+                    "item_name": line["item_name"],
+                    "required": line["required"],
+                    "available": line["available"],
+                    "warehouse": line["warehouse"]
                 })
         
         if insufficient_items:
@@ -2985,6 +4141,9 @@ def create_bom(item, items, quantity=1, is_active=1, is_default=0, remarks=None)
         # Update cost after submit to calculate raw_material_cost
         doc.update_cost(update_parent=True, from_child_bom=False, save=True)
         
+        from xuanhoa_app.bom_explosion import clear_bom_explosion_cache
+        clear_bom_explosion_cache()
+        
         return {
             "success": True,
             "name": doc.name,
@@ -3011,6 +4170,9 @@ def toggle_bom_active(bom_no):
         doc.is_active = 0 if doc.is_active else 1
         doc.save()
         
+        from xuanhoa_app.bom_explosion import clear_bom_explosion_cache
+        clear_bom_explosion_cache()
+        
         status = "kích hoạt" if doc.is_active else "vô hiệu hóa"
         return {
             "success": True,
@@ -3045,6 +4207,9 @@ def set_default_bom(bom_no):
         doc.is_default = 1
         doc.save()
         
+        from xuanhoa_app.bom_explosion import clear_bom_explosion_cache
+        clear_bom_explosion_cache()
+        
         return {
             "success": True,
             "message": _("Đã đặt {0} làm BOM mặc định cho {1}").format(bom_no, doc.item)
@@ -3059,7 +4224,7 @@ def set_default_bom(bom_no):
 # ============================================
 
 @frappe.whitelist()
-def get_warehouse_list(search=None, is_group=None, company=None):
+def get_warehouse_list(search=None, is_group=None, company=None, rollup=1):
     """
     Lấy danh sách kho với thông tin tồn kho
     
@@ -3067,6 +4232,7 @@ def get_warehouse_list(search=None, is_group=None, company=None):
         search: Tìm kiếm theo tên kho
         is_group: Lọc theo loại (0=kho thực, 1=kho nhóm)
         company: Lọc theo công ty
+        rollup: 1 = kho nhóm hiển thị tổng của tất cả kho con (theo lft/rgt), 0 = kho nhóm để 0
     
     Returns:
         dict: {success, data}
@@ -3099,26 +4265,42 @@ def get_warehouse_list(search=None, is_group=None, company=None):
             order_by="warehouse_name"
         )
         
-        # Thêm thống kê tồn kho cho mỗi kho
-        for wh in warehouses:
-            if not wh.is_group:
-                # Đếm số item có tồn kho
+        # Thống kê tồn kho cho tất cả kho trong 1 query
+        stats_map = {}
+        warehouse_names = [wh.name for wh in warehouses]
+        if warehouse_names:
+            if int(rollup):
+                # Gộp theo nested set: mỗi kho (kể cả kho nhóm) lấy tổng Bin của chính nó và các kho con
                 stock_stats = frappe.db.sql("""
                     SELECT 
+                        g.name as warehouse,
+                        COUNT(DISTINCT b.item_code) as item_count,
+                        SUM(b.actual_qty) as total_qty,
+                        SUM(b.stock_value) as total_value
+                    FROM `tabWarehouse` g
+                    INNER JOIN `tabWarehouse` w ON w.lft >= g.lft AND w.rgt <= g.rgt
+                    INNER JOIN `tabBin` b ON b.warehouse = w.name AND b.actual_qty > 0
+                    WHERE g.name IN %(warehouses)s
+                    GROUP BY g.name
+                """, {"warehouses": warehouse_names}, as_dict=True)
+            else:
+                stock_stats = frappe.db.sql("""
+                    SELECT 
+                        warehouse,
                         COUNT(DISTINCT item_code) as item_count,
                         SUM(actual_qty) as total_qty,
                         SUM(stock_value) as total_value
                     FROM `tabBin`
-                    WHERE warehouse = %s AND actual_qty > 0
-                """, wh.name, as_dict=True)[0]
-                
-                wh["item_count"] = stock_stats.get("item_count") or 0
-                wh["total_qty"] = stock_stats.get("total_qty") or 0
-                wh["total_value"] = stock_stats.get("total_value") or 0
-            else:
-                wh["item_count"] = 0
-                wh["total_qty"] = 0
-                wh["total_value"] = 0
+                    WHERE warehouse IN %(warehouses)s AND actual_qty > 0
+                    GROUP BY warehouse
+                """, {"warehouses": warehouse_names}, as_dict=True)
+            stats_map = {row.warehouse: row for row in stock_stats}
+        
+        for wh in warehouses:
+            stats = stats_map.get(wh.name) if (int(rollup) or not wh.is_group) else None
+            wh["item_count"] = (stats.item_count if stats else 0) or 0
+            wh["total_qty"] = (stats.total_qty if stats else 0) or 0
+            wh["total_value"] = (stats.total_value if stats else 0) or 0
         
         return {"success": True, "data": warehouses}
     except Exception as e:
@@ -3126,75 +4308,161 @@ def get_warehouse_list(search=None, is_group=None, company=None):
         return {"success": False, "message": str(e)}
 
 
+def _get_bin_item_conditions(search=None, item_group=None):
+    """
+    Build điều kiện lọc Bin ⨝ Item theo từ khóa và nhóm hàng (alias b, i)
+    
+    Returns:
+        tuple: (list điều kiện, list params)
+    """
+    conditions = []
+    params = []
+    
+    if search:
+        from xuanhoa_app.search import MAX_ITEM_CANDIDATES, search_item_codes
+        
+        # Ưu tiên index tìm kiếm (không dấu), fallback LIKE nếu index không dùng được
+        candidates = search_item_codes(search, max_results=MAX_ITEM_CANDIDATES)
+        if candidates is None:
+            conditions.append("(b.item_code LIKE %s OR i.item_name LIKE %s)")
+            params.extend([f"%{search}%", f"%{search}%"])
+        else:
+            conditions.append("b.item_code IN %s")
+            params.append(candidates or [""])
+    
+    if item_group:
+        conditions.append("i.item_group = %s")
+        params.append(item_group)
+    
+    return conditions, params
+
+
+def _get_stock_by_warehouse_query(search=None, item_group=None):
+    """
+    Query tồn kho của tất cả kho thực (1 query, sắp theo kho rồi tên hàng)
+    
+    Returns:
+        tuple: (query, params)
+    """
+    company = frappe.defaults.get_user_default("Company") or "Xuân Hòa Thái Bình"
+    
+    conditions = ["b.actual_qty != 0", "w.company = %s", "w.is_group = 0"]
+    params = [company]
+    
+    item_conditions, item_params = _get_bin_item_conditions(search, item_group)
+    conditions.extend(item_conditions)
+    params.extend(item_params)
+    
+    query = f"""
+        SELECT 
+            b.warehouse,
+            w.warehouse_name,
+            b.item_code,
+            i.item_name,
+            i.item_group,
+            i.stock_uom,
+            b.actual_qty,
+            b.valuation_rate,
+            b.stock_value
+        FROM `tabBin` b
+        INNER JOIN `tabWarehouse` w ON b.warehouse = w.name
+        LEFT JOIN `tabItem` i ON b.item_code = i.name
+        WHERE {" AND ".join(conditions)}
+        ORDER BY w.warehouse_name, b.warehouse, i.item_name
+    """
+    return query, params
+
+
+def _group_stock_by_warehouse(rows):
+    """
+    Gom các dòng (đã sắp theo kho) thành từng kho, trả về lần lượt từng kho
+    
+    Yields:
+        dict: {warehouse, warehouse_name, total_qty, total_value, items}
+    """
+    current = None
+    for row in rows:
+        if current is None or current["warehouse"] != row.warehouse:
+            if current:
+                yield current
+            current = {
+                "warehouse": row.warehouse,
+                "warehouse_name": row.warehouse_name,
+                "total_qty": 0,
+                "total_value": 0,
+                "items": []
+            }
+        
+        current["total_qty"] += row.actual_qty or 0
+        current["total_value"] += row.stock_value or 0
+        current["items"].append({
+            "item_code": row.item_code,
+            "item_name": row.item_name,
+            "item_group": row.item_group,
+            "stock_uom": row.stock_uom,
+            "actual_qty": row.actual_qty,
+            "valuation_rate": row.valuation_rate,
+            "stock_value": row.stock_value
+        })
+    
+    if current:
+        yield current
+
+
 @frappe.whitelist()
-def get_stock_by_warehouse(search=None, item_group=None):
+def get_stock_by_warehouse(search=None, item_group=None, summary_only=0, stream=0):
     """
     Lấy tồn kho nhóm theo kho (cho chế độ "Theo kho")
     
+    Args:
+        search: Tìm kiếm theo mã/tên SP
+        item_group: Lọc theo nhóm hàng
+        summary_only: 1 = chỉ trả tổng theo kho (items rỗng, có item_count);
+            danh sách hàng của từng kho lấy khi mở rộng qua get_warehouse_stock
+        stream: 1 = trả toàn bộ dữ liệu dạng NDJSON (mỗi dòng 1 kho, dòng cuối là summary)
+    
     Returns:
         list: [{warehouse, warehouse_name, total_qty, total_value, items: [...]}, ...]
     """
+    empty_summary = {"totalItems": 0, "totalQty": 0, "totalValue": 0}
+    
+    if int(stream):
+        return _stream_stock_by_warehouse(search, item_group)
+    
     try:
-        company = frappe.defaults.get_user_default("Company") or "Xuân Hòa Thái Bình"
-        
-        # Get all warehouses with stock
-        warehouses = frappe.db.sql("""
-            SELECT DISTINCT 
-                b.warehouse,
-                w.warehouse_name
-            FROM `tabBin` b
-            LEFT JOIN `tabWarehouse` w ON b.warehouse = w.name
-            WHERE b.actual_qty != 0 AND w.company = %s AND w.is_group = 0
-            ORDER BY w.warehouse_name
-        """, company, as_dict=True)
-        
-        result = []
-        total_summary = {"totalItems": 0, "totalQty": 0, "totalValue": 0}
-        
-        for wh in warehouses:
-            # Build item conditions
-            item_conditions = "b.warehouse = %s AND b.actual_qty != 0"
-            params = [wh.warehouse]
-            
-            if search:
-                item_conditions += " AND (b.item_code LIKE %s OR i.item_name LIKE %s)"
-                params.extend([f"%{search}%", f"%{search}%"])
-            
-            if item_group:
-                item_conditions += " AND i.item_group = %s"
-                params.append(item_group)
-            
-            # Get items in this warehouse
-            items = frappe.db.sql(f"""
-                SELECT 
-                    b.item_code,
-                    i.item_name,
-                    i.item_group,
-                    i.stock_uom,
-                    b.actual_qty,
-                    b.valuation_rate,
-                    b.stock_value
-                FROM `tabBin` b
-                LEFT JOIN `tabItem` i ON b.item_code = i.name
-                WHERE {item_conditions}
-                ORDER BY i.item_name
+        total_summary = dict(empty_summary)
+        
+        if int(summary_only):
+            query, params = _get_stock_by_warehouse_query(search, item_group)
+            result = frappe.db.sql(f"""
+                SELECT
+                    warehouse,
+                    warehouse_name,
+                    COUNT(*) as item_count,
+                    SUM(actual_qty) as total_qty,
+                    SUM(stock_value) as total_value
+                FROM ({query}) stock
+                GROUP BY warehouse, warehouse_name
+                ORDER BY warehouse_name, warehouse
             """, params, as_dict=True)
             
-            if items:  # Only include warehouses with items (after filter)
-                total_qty = sum(item.actual_qty or 0 for item in items)
-                total_value = sum(item.stock_value or 0 for item in items)
-                
-                result.append({
-                    "warehouse": wh.warehouse,
-                    "warehouse_name": wh.warehouse_name,
-                    "total_qty": total_qty,
-                    "total_value": total_value,
-                    "items": items
-                })
-                
-                total_summary["totalItems"] += len(items)
-                total_summary["totalQty"] += total_qty
-                total_summary["totalValue"] += total_value
+            for wh in result:
+                wh["total_qty"] = wh.total_qty or 0
+                wh["total_value"] = wh.total_value or 0
+                wh["items"] = []
+                total_summary["totalItems"] += wh.item_count
+                total_summary["totalQty"] += wh.total_qty
+                total_summary["totalValue"] += wh.total_value
+            
+            return {"data": result, "summary": total_summary}
+        
+        query, params = _get_stock_by_warehouse_query(search, item_group)
+        result = list(_group_stock_by_warehouse(frappe.db.sql(query, params, as_dict=True)))
+        
+        for wh in result:
+            total_summary["totalItems"] += len(wh["items"])
+            total_summary["totalQty"] += wh["total_qty"]
+            total_summary["totalValue"] += wh["total_value"]
         
         return {
             "data": result,
@@ -3202,11 +4470,49 @@ def get_stock_by_warehouse(search=None, item_group=None):
         }
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "get_stock_by_warehouse Error")
-        return {"data": [], "summary": {"totalItems": 0, "totalQty": 0, "totalValue": 0}}
+        return {"data": [], "summary": empty_summary}
+
+
+def _stream_stock_by_warehouse(search=None, item_group=None):
+    """
+    Xuất tồn kho theo kho dạng NDJSON: đọc bằng unbuffered cursor, ghi từng kho ra file tạm
+    rồi stream file (kết nối DB được đóng khi handler trả về nên không stream trực tiếp từ cursor)
+    """
+    import json
+    import tempfile
+    
+    from frappe.utils.response import json_handler
+    from werkzeug.wrappers import Response
+    from werkzeug.wsgi import wrap_file
+    
+    try:
+        fileobj = tempfile.TemporaryFile()
+        summary = {"totalItems": 0, "totalQty": 0, "totalValue": 0}
+        query, params = _get_stock_by_warehouse_query(search, item_group)
+        
+        with frappe.db.unbuffered_cursor():
+            rows = frappe.db.sql(query, params, as_dict=True, as_iterator=True)
+            for wh in _group_stock_by_warehouse(rows):
+                summary["totalItems"] += len(wh["items"])
+                summary["totalQty"] += wh["total_qty"]
+                summary["totalValue"] += wh["total_value"]
+                fileobj.write(json.dumps(wh, default=json_handler, ensure_ascii=False).encode("utf-8") + b"\n")
+        
+        fileobj.write(json.dumps({"summary": summary}, default=json_handler).encode("utf-8") + b"\n")
+        fileobj.seek(0)
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "get_stock_by_warehouse Error")
+        return {"success": False, "message": str(e)}
+    
+    return Response(
+        wrap_file(frappe.local.request.environ, fileobj),
+        content_type="application/x-ndjson; charset=utf-8",
+        direct_passthrough=True
+    )
 
 
 @frappe.whitelist()
-def get_warehouse_stock(warehouse, search=None, page=1, page_size=20):
+def get_warehouse_stock(warehouse, search=None, page=1, page_size=20, item_group=None):
     """
     Lấy danh sách hàng hóa trong kho
     
@@ -3215,6 +4521,7 @@ def get_warehouse_stock(warehouse, search=None, page=1, page_size=20):
         search: Tìm kiếm theo item code hoặc tên
         page: Trang
         page_size: Số items/trang
+        item_group: Lọc theo nhóm hàng
     
     Returns:
         dict: {success, data, total, warehouse_info}
@@ -3225,12 +4532,9 @@ def get_warehouse_stock(warehouse, search=None, page=1, page_size=20):
         offset = (page - 1) * page_size
         
         # Build query
-        conditions = "b.warehouse = %s AND b.actual_qty != 0"
-        params = [warehouse]
-        
-        if search:
-            conditions += " AND (b.item_code LIKE %s OR i.item_name LIKE %s)"
-            params.extend([f"%{search}%", f"%{search}%"])
+        item_conditions, item_params = _get_bin_item_conditions(search, item_group)
+        conditions = " AND ".join(["b.warehouse = %s", "b.actual_qty != 0", *item_conditions])
+        params = [warehouse, *item_params]
         
         # Get total
         total = frappe.db.sql(f"""
@@ -3559,6 +4863,9 @@ def update_bom(bom_name, is_active=None, is_default=None, quantity=None, items=N
                     WHERE item = %s AND name != %s AND docstatus = 1
                 """, (new_doc.item, new_doc.name))
             
+            from xuanhoa_app.bom_explosion import clear_bom_explosion_cache
+            clear_bom_explosion_cache()
+            
             return {
                 "success": True,
                 "name": new_doc.name,
@@ -3581,6 +4888,9 @@ def update_bom(bom_name, is_active=None, is_default=None, quantity=None, items=N
             
             old_doc.save()
             
+            from xuanhoa_app.bom_explosion import clear_bom_explosion_cache
+            clear_bom_explosion_cache()
+            
             return {
                 "success": True,
                 "name": bom_name,
@@ -3622,6 +4932,9 @@ def delete_bom(bom_name):
         # Delete
         frappe.delete_doc("BOM", bom_name, force=1)
         
+        from xuanhoa_app.bom_explosion import clear_bom_explosion_cache
+        clear_bom_explosion_cache()
+        
         return {
             "success": True,
             "message": _("Đã xóa BOM {0}").format(bom_name)
@@ -3632,7 +4945,8 @@ def delete_bom(bom_name):
 
 
 @frappe.whitelist()
-def get_all_stock(warehouse=None, item_code=None, item_group=None, search=None, page=1, page_size=50):
+def get_all_stock(warehouse=None, item_code=None, item_group=None, search=None, page=1, page_size=50,
+                  cursor=None, count_mode="exact"):
     """
     Lấy toàn bộ tồn kho theo sản phẩm (flat list)
     
@@ -3643,6 +4957,8 @@ def get_all_stock(warehouse=None, item_code=None, item_group=None, search=None,
         search: Tìm kiếm theo mã/tên SP
         page: Trang
         page_size: Số items/trang
+        cursor: Phân trang keyset - "" cho trang đầu, next_cursor cho các trang sau
+        count_mode: exact (mặc định) | estimate | none
     
     Returns:
         list: Danh sách tồn kho theo sản phẩm
@@ -3669,22 +4985,21 @@ def get_all_stock(warehouse=None, item_code=None, item_group=None, search=None,
             params.append(item_group)
         
         if search:
-            conditions.append("(b.item_code LIKE %s OR i.item_name LIKE %s)")
-            params.extend([f"%{search}%", f"%{search}%"])
+            from xuanhoa_app.search import MAX_ITEM_CANDIDATES, search_item_codes
+            
+            # Ưu tiên index tìm kiếm (không dấu), fallback LIKE nếu index không dùng được
+            candidates = search_item_codes(search, max_results=MAX_ITEM_CANDIDATES)
+            if candidates is None:
+                conditions.append("(b.item_code LIKE %s OR i.item_name LIKE %s)")
+                params.extend([f"%{search}%", f"%{search}%"])
+            else:
+                conditions.append("b.item_code IN %s")
+                params.append(candidates or [""])
         
         where_clause = " AND ".join(conditions)
         
-        # Get total
-        total = frappe.db.sql(f"""
-            SELECT COUNT(*)
-            FROM `tabBin` b
-            LEFT JOIN `tabItem` i ON b.item_code = i.name
-            WHERE {where_clause}
-        """, params)[0][0]
-        
-        # Get data
-        stocks = frappe.db.sql(f"""
-            SELECT 
+        stocks, total, next_cursor = _fetch_page(
+            """
                 b.item_code,
                 i.item_name,
                 i.item_group,
@@ -3697,28 +5012,69 @@ def get_all_stock(warehouse=None, item_code=None, item_group=None, search=None,
                 b.projected_qty,
                 b.valuation_rate,
                 b.stock_value
-            FROM `tabBin` b
+            """,
+            """`tabBin` b
             LEFT JOIN `tabItem` i ON b.item_code = i.name
-            LEFT JOIN `tabWarehouse` w ON b.warehouse = w.name
-            WHERE {where_clause}
-            ORDER BY i.item_name, b.warehouse
-            LIMIT %s OFFSET %s
-        """, params + [page_size, offset], as_dict=True)
+            LEFT JOIN `tabWarehouse` w ON b.warehouse = w.name""",
+            where_clause,
+            params,
+            sort_columns=[("IFNULL(i.item_name, '')", "asc"), ("b.warehouse", "asc"), ("b.name", "asc")],
+            page_size=page_size,
+            offset=offset,
+            cursor=cursor,
+            count_mode=count_mode
+        )
+        
+        if total is None:
+            total_pages = None
+        else:
+            total_pages = (total + page_size - 1) // page_size if total > 0 else 1
         
         return {
             "data": stocks,
             "total": total,
             "page": page,
             "page_size": page_size,
-            "total_pages": (total + page_size - 1) // page_size if total > 0 else 1
+            "total_pages": total_pages,
+            "next_cursor": next_cursor
         }
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "get_all_stock Error")
         return []
 
 
+def _get_stock_ledger_conditions(warehouse=None, item_code=None, from_date=None, to_date=None):
+    """
+    Build điều kiện WHERE cho Stock Ledger Entry (dùng chung cho xem và xuất file)
+    
+    Returns:
+        tuple: (where_clause, params)
+    """
+    conditions = ["1=1"]
+    params = []
+    
+    if warehouse:
+        conditions.append("sle.warehouse = %s")
+        params.append(warehouse)
+    
+    if item_code:
+        conditions.append("sle.item_code = %s")
+        params.append(item_code)
+    
+    if from_date:
+        conditions.append("sle.posting_date >= %s")
+        params.append(from_date)
+    
+    if to_date:
+        conditions.append("sle.posting_date <= %s")
+        params.append(to_date)
+    
+    return " AND ".join(conditions), params
+
+
 @frappe.whitelist()
-def get_stock_ledger(warehouse=None, item_code=None, from_date=None, to_date=None, page=1, page_size=50):
+def get_stock_ledger(warehouse=None, item_code=None, from_date=None, to_date=None, page=1, page_size=50,
+                     cursor=None, count_mode="exact"):
     """
     Lấy lịch sử xuất nhập kho (Stock Ledger Entry)
     
@@ -3729,6 +5085,9 @@ def get_stock_ledger(warehouse=None, item_code=None, from_date=None, to_date=Non
         to_date: Đến ngày
         page: Trang
         page_size: Số items/trang
+        cursor: Phân trang keyset - "" cho trang đầu, next_cursor cho các trang sau
+            (trang sâu nhanh như trang đầu)
+        count_mode: exact (mặc định) | estimate | none
     
     Returns:
         list: Danh sách giao dịch kho
@@ -3738,38 +5097,10 @@ def get_stock_ledger(warehouse=None, item_code=None, from_date=None, to_date=Non
         page_size = int(page_size)
         offset = (page - 1) * page_size
         
-        # Build conditions
-        conditions = ["1=1"]
-        params = []
-        
-        if warehouse:
-            conditions.append("sle.warehouse = %s")
-            params.append(warehouse)
-        
-        if item_code:
-            conditions.append("sle.item_code = %s")
-            params.append(item_code)
-        
-        if from_date:
-            conditions.append("sle.posting_date >= %s")
-            params.append(from_date)
-        
-        if to_date:
-            conditions.append("sle.posting_date <= %s")
-            params.append(to_date)
-        
-        where_clause = " AND ".join(conditions)
-        
-        # Get total
-        total = frappe.db.sql(f"""
-            SELECT COUNT(*)
-            FROM `tabStock Ledger Entry` sle
-            WHERE {where_clause}
-        """, params)[0][0]
+        where_clause, params = _get_stock_ledger_conditions(warehouse, item_code, from_date, to_date)
         
-        # Get data
-        entries = frappe.db.sql(f"""
-            SELECT 
+        entries, total, next_cursor = _fetch_page(
+            """
                 sle.name,
                 sle.posting_date,
                 sle.posting_time,
@@ -3783,25 +5114,246 @@ def get_stock_ledger(warehouse=None, item_code=None, from_date=None, to_date=Non
                 sle.stock_value_difference,
                 sle.voucher_type,
                 sle.voucher_no
-            FROM `tabStock Ledger Entry` sle
-            LEFT JOIN `tabItem` i ON sle.item_code = i.name
-            WHERE {where_clause}
-            ORDER BY sle.posting_date DESC, sle.posting_time DESC, sle.creation DESC
-            LIMIT %s OFFSET %s
-        """, params + [page_size, offset], as_dict=True)
+            """,
+            """`tabStock Ledger Entry` sle
+            LEFT JOIN `tabItem` i ON sle.item_code = i.name""",
+            where_clause,
+            params,
+            sort_columns=[
+                ("sle.posting_date", "desc"),
+                ("sle.posting_time", "desc"),
+                ("sle.creation", "desc"),
+                ("sle.name", "desc")
+            ],
+            page_size=page_size,
+            offset=offset,
+            cursor=cursor,
+            count_mode=count_mode
+        )
+        
+        if total is None:
+            total_pages = None
+        else:
+            total_pages = (total + page_size - 1) // page_size if total > 0 else 1
         
         return {
             "data": entries,
             "total": total,
             "page": page,
             "page_size": page_size,
-            "total_pages": (total + page_size - 1) // page_size if total > 0 else 1
+            "total_pages": total_pages,
+            "next_cursor": next_cursor
         }
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "get_stock_ledger Error")
         return []
 
 
+# Cột xuất file sổ kho: (biểu thức SQL, tiêu đề cột)
+STOCK_LEDGER_EXPORT_COLUMNS = [
+    ("sle.posting_date", "Ngày"),
+    ("sle.posting_time", "Giờ"),
+    ("sle.item_code", "Mã hàng"),
+    ("i.item_name", "Tên hàng"),
+    ("sle.warehouse", "Kho"),
+    ("sle.actual_qty", "SL thay đổi"),
+    ("sle.qty_after_transaction", "SL sau giao dịch"),
+    ("sle.valuation_rate", "Đơn giá"),
+    ("sle.stock_value", "Giá trị tồn"),
+    ("sle.stock_value_difference", "Chênh lệch giá trị"),
+    ("sle.voucher_type", "Loại chứng từ"),
+    ("sle.voucher_no", "Số chứng từ"),
+]
+
+
+def _write_stock_ledger_export(fileobj, file_format="csv", warehouse=None, item_code=None,
+                               from_date=None, to_date=None):
+    """
+    Ghi sổ kho ra file theo từng dòng bằng unbuffered cursor
+    
+    Dữ liệu được đọc tuần tự từ MariaDB (không nạp toàn bộ kết quả vào bộ nhớ)
+    và ghi thẳng ra fileobj, nên bộ nhớ không phụ thuộc số dòng xuất.
+    
+    Args:
+        fileobj: File nhị phân để ghi (mở ở chế độ "w+b")
+        file_format: csv | xlsx
+        warehouse, item_code, from_date, to_date: Bộ lọc giống get_stock_ledger
+    
+    Returns:
+        int: Số dòng đã ghi
+    """
+    import csv
+    import io
+    
+    where_clause, params = _get_stock_ledger_conditions(warehouse, item_code, from_date, to_date)
+    select_clause = ", ".join(expression for expression, _label in STOCK_LEDGER_EXPORT_COLUMNS)
+    headers = [label for _expression, label in STOCK_LEDGER_EXPORT_COLUMNS]
+    
+    query = f"""
+        SELECT {select_clause}
+        FROM `tabStock Ledger Entry` sle
+        LEFT JOIN `tabItem` i ON sle.item_code = i.name
+        WHERE {where_clause}
+        ORDER BY sle.posting_date, sle.posting_time, sle.creation, sle.name
+    """
+    
+    row_count = 0
+    
+    if file_format == "xlsx":
+        from openpyxl import Workbook
+        
+        # write_only workbook ghi từng dòng ra file tạm, không giữ cả sheet trong RAM
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet("So kho")
+        sheet.append(headers)
+        
+        with frappe.db.unbuffered_cursor():
+            for row in frappe.db.sql(query, params, as_iterator=True):
+                sheet.append(list(row))
+                row_count += 1
+        
+        workbook.save(fileobj)
+    else:
+        text_stream = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="", write_through=True)
+        writer = csv.writer(text_stream)
+        writer.writerow(headers)
+        
+        chunk = []
+        with frappe.db.unbuffered_cursor():
+            for row in frappe.db.sql(query, params, as_iterator=True):
+                chunk.append(row)
+                if len(chunk) >= 1000:
+                    writer.writerows(chunk)
+                    row_count += len(chunk)
+                    chunk = []
+        
+        writer.writerows(chunk)
+        row_count += len(chunk)
+        text_stream.flush()
+        # Tách wrapper để không đóng fileobj khi wrapper bị thu hồi
+        text_stream.detach()
+    
+    fileobj.seek(0)
+    return row_count
+
+
+def _export_stock_ledger_to_file(file_format="csv", warehouse=None, item_code=None,
+                                 from_date=None, to_date=None, user=None):
+    """
+    Background job: xuất sổ kho ra File (private) và báo cho user qua realtime
+    """
+    import os
+    
+    file_name = "so-kho-{0}-{1}.{2}".format(
+        frappe.utils.now_datetime().strftime("%Y%m%d-%H%M%S"), frappe.generate_hash(length=8), file_format
+    )
+    file_path = frappe.get_site_path("private", "files", file_name)
+    
+    try:
+        with open(file_path, "w+b") as fileobj:
+            row_count = _write_stock_ledger_export(
+                fileobj, file_format, warehouse, item_code, from_date, to_date
+            )
+        
+        # File đã nằm trên đĩa, chỉ tạo bản ghi File trỏ tới (không nạp nội dung)
+        file_doc = frappe.get_doc({
+            "doctype": "File",
+            "file_name": file_name,
+            "file_url": f"/private/files/{file_name}",
+            "is_private": 1,
+            "file_size": os.path.getsize(file_path)
+        })
+        file_doc.flags.ignore_permissions = True
+        file_doc.insert()
+        frappe.db.commit()
+        
+        frappe.publish_realtime(
+            "xuanhoa_stock_ledger_export",
+            {"success": True, "file_url": file_doc.file_url, "rows": row_count},
+            user=user
+        )
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "export_stock_ledger Error")
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        frappe.publish_realtime(
+            "xuanhoa_stock_ledger_export",
+            {"success": False, "message": str(e)},
+            user=user
+        )
+
+
+@frappe.whitelist()
+def export_stock_ledger(warehouse=None, item_code=None, from_date=None, to_date=None,
+                        file_format="csv", background=0):
+    """
+    Xuất sổ kho (Stock Ledger Entry) ra CSV/XLSX với cùng bộ lọc như get_stock_ledger
+    
+    Args:
+        warehouse: Lọc theo kho
+        item_code: Lọc theo mã SP
+        from_date: Từ ngày
+        to_date: Đến ngày
+        file_format: csv (mặc định) | xlsx
+        background: 1 = tạo file trong background job (cho dữ liệu rất lớn),
+            kết quả gửi qua realtime event "xuanhoa_stock_ledger_export"
+    
+    Returns:
+        - background=0: File tải về (stream từng khối)
+        - background=1: dict {success, job_id, message}
+    """
+    import tempfile
+    
+    from werkzeug.wrappers import Response
+    from werkzeug.wsgi import wrap_file
+    
+    if file_format not in ("csv", "xlsx"):
+        return {"success": False, "message": _("Định dạng file không hỗ trợ: {0}").format(file_format)}
+    
+    if int(background):
+        job = frappe.enqueue(
+            "xuanhoa_app.api._export_stock_ledger_to_file",
+            queue="long",
+            timeout=3600,
+            file_format=file_format,
+            warehouse=warehouse,
+            item_code=item_code,
+            from_date=from_date,
+            to_date=to_date,
+            user=frappe.session.user
+        )
+        return {
+            "success": True,
+            "job_id": job.id if job else None,
+            "message": _("Đang tạo file sổ kho, hệ thống sẽ thông báo khi hoàn tất.")
+        }
+    
+    try:
+        # File tạm trên đĩa, tự xóa khi response đóng file
+        fileobj = tempfile.TemporaryFile()
+        try:
+            _write_stock_ledger_export(fileobj, file_format, warehouse, item_code, from_date, to_date)
+        except Exception:
+            fileobj.close()
+            raise
+    except Exception as e:
+        frappe.log_error(frappe.get_traceback(), "export_stock_ledger Error")
+        return {"success": False, "message": str(e)}
+    
+    content_types = {
+        "csv": "text/csv; charset=utf-8",
+        "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    }
+    file_name = "so-kho-{0}.{1}".format(frappe.utils.nowdate(), file_format)
+    
+    return Response(
+        wrap_file(frappe.local.request.environ, fileobj),
+        content_type=content_types[file_format],
+        direct_passthrough=True,
+        headers={"Content-Disposition": f'attachment; filename="{file_name}"'}
+    )
+
+
 @frappe.whitelist()
 def get_warehouse_details(warehouse):
     """
@@ -3885,17 +5437,10 @@ def get_item_list(search=None, item_group=None, is_stock_item=None, disabled=Non
         # Build filters
         filters = {}
         
-        # Filter theo item_group bao gồm cả sub-groups
+        # Filter theo item_group bao gồm cả sub-groups (tra từ cache cây Item Group)
         if item_group:
-            # Lấy lft/rgt của group được chọn
-            group_doc = frappe.db.get_value("Item Group", item_group, ["lft", "rgt"], as_dict=True)
-            if group_doc:
-                # Lấy tất cả sub-groups
-                sub_groups = frappe.get_all(
-                    "Item Group",
-                    filters={"lft": [">=", group_doc.lft], "rgt": ["<=", group_doc.rgt]},
-                    pluck="name"
-                )
+            sub_groups = _get_item_group_descendants(item_group)
+            if sub_groups:
                 filters["item_group"] = ["in", sub_groups]
             else:
                 filters["item_group"] = item_group
@@ -3908,17 +5453,30 @@ def get_item_list(search=None, item_group=None, is_stock_item=None, disabled=Non
         else:
             filters["disabled"] = 0  # Default: chỉ lấy active
         
-        # Search - sử dụng SQL trực tiếp cho or_filters vì db.count không hỗ trợ or_filters
+        # Search - ưu tiên index tìm kiếm (không dấu), fallback LIKE nếu index không dùng được
         or_filters = None
         if search:
-            or_filters = [
-                ["item_code", "like", f"%{search}%"],
-                ["item_name", "like", f"%{search}%"]
-            ]
+            from xuanhoa_app.search import MAX_ITEM_CANDIDATES, search_item_codes
+            
+            candidates = search_item_codes(search, max_results=MAX_ITEM_CANDIDATES)
+            if candidates is None:
+                or_filters = [
+                    ["item_code", "like", f"%{search}%"],
+                    ["item_name", "like", f"%{search}%"]
+                ]
+            elif not candidates:
+                return {"data": [], "total": 0, "page": page, "page_size": page_size, "total_pages": 1}
+            else:
+                filters["name"] = ["in", candidates]
         
-        # Get total count - dùng get_all với count
+        # Get total count - COUNT(*) trên DB (hỗ trợ cả or_filters)
         if or_filters:
-            total = len(frappe.get_all("Item", filters=filters, or_filters=or_filters, pluck="name"))
+            total = frappe.get_all(
+                "Item",
+                filters=filters,
+                or_filters=or_filters,
+                fields=["count(name) as total"]
+            )[0].total or 0
         else:
             total = frappe.db.count("Item", filters=filters)
         
@@ -3938,18 +5496,30 @@ def get_item_list(search=None, item_group=None, is_stock_item=None, disabled=Non
             page_length=page_size
         )
         
-        # Add additional info
+        # Add additional info - tồn kho (bảng tổng hợp XH Item Stock Summary) và BOM của cả trang
+        from xuanhoa_app.stock_summary import get_item_stock_summaries
+        
+        item_codes = [item.item_code for item in items]
+        stock_map = get_item_stock_summaries(item_codes)
+        bom_map = {}
+        if item_codes:
+            bom_map = dict(frappe.db.sql("""
+                SELECT item, MIN(name)
+                FROM `tabBOM`
+                WHERE item IN %(item_codes)s
+                AND docstatus = 1
+                AND is_active = 1
+                GROUP BY item
+            """, {"item_codes": item_codes}))
+        
         for item in items:
             # Lấy số lượng tồn kho
-            stock = frappe.db.sql("""
-                SELECT SUM(actual_qty) as qty, SUM(stock_value) as value
-                FROM `tabBin` WHERE item_code = %s
-            """, item.item_code, as_dict=True)
-            item["total_qty"] = stock[0].qty or 0 if stock else 0
-            item["total_value"] = stock[0].value or 0 if stock else 0
+            stock = stock_map.get(item.item_code)
+            item["total_qty"] = (stock.total_qty if stock else 0) or 0
+            item["total_value"] = (stock.total_value if stock else 0) or 0
             
             # Kiểm tra có BOM không
-            item["has_bom"] = frappe.db.exists("BOM", {"item": item.item_code, "docstatus": 1, "is_active": 1})
+            item["has_bom"] = bom_map.get(item.item_code)
         
         return {
             "data": items,
@@ -4145,6 +5715,66 @@ def toggle_item_status(item_code):
 # ITEM GROUP MANAGEMENT APIs
 # ============================================
 
+def _build_item_group_tree():
+    """
+    Lấy toàn bộ Item Group (theo lft) kèm số item, trong 1 query
+    
+    - direct_count: số item active thuộc trực tiếp group
+    - item_count: số item active của group và tất cả sub-groups
+      (cộng dồn từ dưới lên theo thứ tự lft giảm dần - con luôn có lft lớn hơn cha)
+    - subgroup_count: số subgroup trực tiếp
+    - descendants: group và tất cả sub-groups (đoạn liên tiếp theo lft trong khoảng [lft, rgt])
+    
+    Returns:
+        dict: {"nodes": danh sách group sắp xếp theo lft, "descendants": {group: [tên group]}}
+    """
+    groups = frappe.db.sql("""
+        SELECT
+            ig.name, ig.item_group_name, ig.parent_item_group, ig.is_group, ig.image, ig.lft, ig.rgt,
+            COUNT(i.name) as direct_count
+        FROM `tabItem Group` ig
+        LEFT JOIN `tabItem` i ON i.item_group = ig.name AND i.disabled = 0
+        GROUP BY ig.name, ig.item_group_name, ig.parent_item_group, ig.is_group, ig.image, ig.lft, ig.rgt
+        ORDER BY ig.lft
+    """, as_dict=True)
+    
+    by_name = {}
+    for group in groups:
+        group["item_count"] = group.direct_count
+        group["subgroup_count"] = 0
+        by_name[group.name] = group
+    
+    for group in reversed(groups):
+        parent = by_name.get(group.parent_item_group)
+        if parent:
+            parent["item_count"] += group.item_count
+            parent["subgroup_count"] += 1
+    
+    descendants = {}
+    for i, group in enumerate(groups):
+        names = [group.name]
+        if group.lft and group.rgt:
+            for child in groups[i + 1:]:
+                if child.lft > group.rgt:
+                    break
+                names.append(child.name)
+        descendants[group.name] = names
+    
+    return {"nodes": groups, "descendants": descendants}
+
+
+def _get_item_group_nodes():
+    """Danh sách Item Group kèm số item (từ cache Redis, xem _build_item_group_tree)"""
+    from xuanhoa_app.cache import get_cached_item_group_tree
+    return get_cached_item_group_tree(_build_item_group_tree)["nodes"]
+
+
+def _get_item_group_descendants(item_group):
+    """Group và tất cả sub-groups (từ cache Redis); None nếu group không tồn tại"""
+    from xuanhoa_app.cache import get_cached_item_group_tree
+    return get_cached_item_group_tree(_build_item_group_tree)["descendants"].get(item_group)
+
+
 @frappe.whitelist()
 def get_item_group_list(search=None, parent=None):
     """
@@ -4158,41 +5788,24 @@ def get_item_group_list(search=None, parent=None):
         list: Danh sách item groups
     """
     try:
-        filters = {}
+        groups = _get_item_group_nodes()
         
         if parent:
-            filters["parent_item_group"] = parent
+            groups = [g for g in groups if g.parent_item_group == parent]
         
-        or_filters = None
         if search:
-            or_filters = [
-                ["item_group_name", "like", f"%{search}%"],
-                ["name", "like", f"%{search}%"]
+            from xuanhoa_app.search import fold_text
+            
+            # So khớp không phân biệt dấu như tìm kiếm SQL trước đây (collation utf8mb4)
+            keyword = fold_text(search)
+            groups = [
+                g for g in groups
+                if keyword in fold_text(g.item_group_name) or keyword in fold_text(g.name)
             ]
         
-        groups = frappe.get_all(
-            "Item Group",
-            filters=filters,
-            or_filters=or_filters,
-            fields=["name", "item_group_name", "parent_item_group", "is_group", "image", "lft", "rgt"],
-            order_by="lft"
-        )
-        
-        # Đếm số item trong mỗi group (bao gồm cả sub-groups)
-        for group in groups:
-            # Sử dụng lft/rgt để đếm items trong group và tất cả sub-groups
-            group["item_count"] = frappe.db.count("Item", {
-                "item_group": ["in", frappe.get_all(
-                    "Item Group",
-                    filters={"lft": [">=", group.lft], "rgt": ["<=", group.rgt]},
-                    pluck="name"
-                )],
-                "disabled": 0
-            }) if group.lft and group.rgt else frappe.db.count("Item", {"item_group": group.name, "disabled": 0})
-            # Đếm số subgroup trực tiếp
-            group["subgroup_count"] = frappe.db.count("Item Group", {"parent_item_group": group.name})
-        
-        return groups
+        fields = ["name", "item_group_name", "parent_item_group", "is_group", "image", "lft", "rgt",
+                  "item_count", "subgroup_count"]
+        return [frappe._dict({field: g.get(field) for field in fields}) for g in groups]
     except Exception as e:
         frappe.log_error(frappe.get_traceback(), "get_item_group_list Error")
         return []
@@ -4207,33 +5820,25 @@ def get_item_group_tree():
         list: Cây item groups
     """
     try:
-        # Lấy tất cả groups với lft/rgt để đếm items trong sub-groups
-        groups = frappe.get_all(
-            "Item Group",
-            fields=["name", "item_group_name", "parent_item_group", "is_group", "lft", "rgt"],
-            order_by="lft"
-        )
+        groups = _get_item_group_nodes()
         
-        # Đếm items cho mỗi group (bao gồm cả sub-groups)
+        # Map parent -> children (giữ thứ tự lft)
+        children_map = {}
         for group in groups:
-            # Lấy tất cả sub-groups dựa trên lft/rgt
-            sub_groups = [g.name for g in groups if g.lft >= group.lft and g.rgt <= group.rgt]
-            group["item_count"] = frappe.db.count("Item", {"item_group": ["in", sub_groups], "disabled": 0}) if sub_groups else 0
+            children_map.setdefault(group.parent_item_group, []).append(group)
         
         # Build tree
         def build_tree(parent=None):
-            children = []
-            for group in groups:
-                if group.parent_item_group == parent:
-                    node = {
-                        "name": group.name,
-                        "item_group_name": group.item_group_name,
-                        "is_group": group.is_group,
-                        "item_count": group.item_count,
-                        "children": build_tree(group.name)
-                    }
-                    children.append(node)
-            return children
+            return [
+                {
+                    "name": group.name,
+                    "item_group_name": group.item_group_name,
+                    "is_group": group.is_group,
+                    "item_count": group.item_count,
+                    "children": build_tree(group.name)
+                }
+                for group in children_map.get(parent, [])
+            ]
         
         return build_tree("All Item Groups")
     except Exception as e:
@@ -4265,6 +5870,9 @@ def create_item_group(item_group_name, parent_item_group="All Item Groups", is_g
         
         doc.insert()
         
+        from xuanhoa_app.cache import clear_item_group_cache
+        clear_item_group_cache()
+        
         return {
             "success": True,
             "name": doc.name,
@@ -4300,6 +5908,9 @@ def update_item_group(name, item_group_name=None, parent_item_group=None):
             doc.save()
             frappe.db.commit()
         
+        from xuanhoa_app.cache import clear_item_group_cache
+        clear_item_group_cache()
+        
         return {
             "success": True,
             "new_name": new_name,
@@ -4337,6 +5948,9 @@ def delete_item_group(name):
         
         frappe.delete_doc("Item Group", name)
         
+        from xuanhoa_app.cache import clear_item_group_cache
+        clear_item_group_cache()
+        
         return {
             "success": True,
             "message": _("Đã xóa nhóm hàng {0}").format(name)
@@ -4369,6 +5983,14 @@ def get_uom_list():
 
 @frappe.whitelist()
 def get_stock_dashboard():
+    """
+    Lấy thống kê tổng quan cho Stock Dashboard (có cache, xem xuanhoa_app.cache)
+    """
+    from xuanhoa_app.cache import get_cached_dashboard
+    return get_cached_dashboard("stock", _compute_stock_dashboard)
+
+
+def _compute_stock_dashboard():
     """
     Lấy thống kê tổng quan cho Stock Dashboard
     
@@ -4381,15 +6003,14 @@ def get_stock_dashboard():
         week_ago = today - timedelta(days=7)
         month_ago = today - timedelta(days=30)
         
-        # Tổng giá trị tồn kho
-        stock_value = frappe.db.sql("""
-            SELECT IFNULL(SUM(stock_value), 0) as total_value
+        # Tổng giá trị tồn kho + số lượng sản phẩm đang tồn (1 query)
+        bin_totals = frappe.db.sql("""
+            SELECT IFNULL(SUM(stock_value), 0) as total_value, COUNT(*) as total_items
             FROM `tabBin`
             WHERE actual_qty > 0
-        """, as_dict=1)[0].total_value or 0
-        
-        # Số lượng sản phẩm đang tồn
-        total_items = frappe.db.count("Bin", {"actual_qty": (">", 0)})
+        """, as_dict=1)[0]
+        stock_value = bin_totals.total_value or 0
+        total_items = bin_totals.total_items or 0
         
         # Sản phẩm sắp hết (dưới reorder level)
         low_stock_items = frappe.db.sql("""
@@ -4401,40 +6022,42 @@ def get_stock_dashboard():
             AND b.warehouse = ir.warehouse
         """, as_dict=1)[0].count or 0
         
-        # Phiếu nhập kho tháng này
-        receipts_month = frappe.db.count("Stock Entry", {
-            "purpose": "Material Receipt",
-            "docstatus": 1,
-            "posting_date": (">=", month_ago)
-        })
-        
-        # Phiếu xuất kho tháng này
-        issues_month = frappe.db.count("Stock Entry", {
-            "purpose": "Material Issue",
-            "docstatus": 1,
-            "posting_date": (">=", month_ago)
-        })
+        # Phiếu nhập/xuất kho tháng này (1 query GROUP BY purpose)
+        entries_month = dict(frappe.db.sql("""
+            SELECT purpose, COUNT(*)
+            FROM `tabStock Entry`
+            WHERE docstatus = 1
+            AND posting_date >= %s
+            AND purpose IN ('Material Receipt', 'Material Issue')
+            GROUP BY purpose
+        """, (month_ago,)))
+        receipts_month = entries_month.get("Material Receipt", 0)
+        issues_month = entries_month.get("Material Issue", 0)
         
-        # Top 5 sản phẩm tồn kho nhiều nhất theo giá trị
+        # Top 5 sản phẩm tồn kho nhiều nhất theo giá trị (đọc từ bảng tổng hợp XH Item Stock Summary)
         top_items_by_value = frappe.db.sql("""
             SELECT 
-                b.item_code,
+                s.item_code,
                 i.item_name,
-                SUM(b.actual_qty) as total_qty,
+                s.total_qty,
                 i.stock_uom as uom,
-                SUM(b.stock_value) as total_value
-            FROM `tabBin` b
-            INNER JOIN `tabItem` i ON b.item_code = i.name
-            WHERE b.actual_qty > 0
-            GROUP BY b.item_code, i.item_name, i.stock_uom
-            ORDER BY total_value DESC
+                s.total_value
+            FROM `tabXH Item Stock Summary` s
+            INNER JOIN `tabItem` i ON s.item_code = i.name
+            WHERE s.total_qty > 0
+            ORDER BY s.total_value DESC
             LIMIT 5
         """, as_dict=1)
         
-        # Biến động kho 6 tháng gần đây
+        # Biến động kho 6 tháng gần đây (đọc từ bảng tổng hợp XH Monthly Movement)
         from dateutil.relativedelta import relativedelta
+
+        from xuanhoa_app.monthly_movement import get_monthly_movement
         stock_movement = []
         
+        first_month = (today - relativedelta(months=5)).replace(day=1)
+        movement = get_monthly_movement(["Stock Entry"], first_month)
+        
         # Lấy 6 tháng gần nhất
         for i in range(6):
             month_date = today - relativedelta(months=i)
@@ -4443,17 +6066,8 @@ def get_stock_dashboard():
             next_month = month_start + relativedelta(months=1)
             month_end = next_month - timedelta(days=1)
             
-            receipts = frappe.db.count("Stock Entry", {
-                "purpose": "Material Receipt",
-                "docstatus": 1,
-                "posting_date": ("between", [month_start, month_end])
-            })
-            
-            issues = frappe.db.count("Stock Entry", {
-                "purpose": "Material Issue",
-                "docstatus": 1,
-                "posting_date": ("between", [month_start, month_end])
-            })
+            receipts = movement.get((month_start, "Stock Entry", "Material Receipt", 1), {}).get("doc_count", 0)
+            issues = movement.get((month_start, "Stock Entry", "Material Issue", 1), {}).get("doc_count", 0)
             
             month_label = f"T{month_date.month}/{month_date.year}"
             stock_movement.insert(0, {
@@ -4505,6 +6119,14 @@ def get_stock_dashboard():
 
 @frappe.whitelist()
 def get_production_dashboard():
+    """
+    Lấy thống kê tổng quan cho Production Dashboard (có cache, xem xuanhoa_app.cache)
+    """
+    from xuanhoa_app.cache import get_cached_dashboard
+    return get_cached_dashboard("production", _compute_production_dashboard)
+
+
+def _compute_production_dashboard():
     """
     Lấy thống kê tổng quan cho Production Dashboard
     
@@ -4517,32 +6139,26 @@ def get_production_dashboard():
         week_ago = today - timedelta(days=7)
         month_ago = today - timedelta(days=30)
         
-        # Tổng số lệnh sản xuất
-        total_work_orders = frappe.db.count("Work Order")
-        
-        # Lệnh theo trạng thái
-        wo_not_started = frappe.db.count("Work Order", {"status": "Not Started"})
-        wo_in_progress = frappe.db.count("Work Order", {"status": "In Process"})
-        wo_completed = frappe.db.count("Work Order", {"status": "Completed"})
-        wo_stopped = frappe.db.count("Work Order", {"status": "Stopped"})
-        
-        # Lệnh tạo trong tuần
-        wo_this_week = frappe.db.count("Work Order", {
-            "creation": (">=", week_ago)
-        })
-        
-        # Lệnh hoàn thành tuần này
-        wo_completed_week = frappe.db.count("Work Order", {
-            "status": "Completed",
-            "modified": (">=", week_ago)
-        })
-        
-        # Tổng số lượng sản phẩm đã sản xuất tháng này
-        qty_produced_month = frappe.db.sql("""
-            SELECT IFNULL(SUM(produced_qty), 0) as total
+        # Tổng số lệnh sản xuất + lệnh theo trạng thái (1 query GROUP BY)
+        wo_counts = _get_status_counts("Work Order")
+        total_work_orders = _sum_status_counts(wo_counts)
+        wo_not_started = _sum_status_counts(wo_counts, status="Not Started")
+        wo_in_progress = _sum_status_counts(wo_counts, status="In Process")
+        wo_completed = _sum_status_counts(wo_counts, status="Completed")
+        wo_stopped = _sum_status_counts(wo_counts, status="Stopped")
+        
+        # Lệnh tạo trong tuần, lệnh hoàn thành tuần này và tổng số lượng
+        # đã sản xuất tháng này (1 query với điều kiện gộp)
+        recent_stats = frappe.db.sql("""
+            SELECT
+                IFNULL(SUM(creation >= %(week_ago)s), 0) as wo_this_week,
+                IFNULL(SUM(status = 'Completed' AND modified >= %(week_ago)s), 0) as wo_completed_week,
+                IFNULL(SUM(CASE WHEN modified >= %(month_ago)s THEN produced_qty ELSE 0 END), 0) as qty_produced_month
             FROM `tabWork Order`
-            WHERE modified >= %s
-        """, (month_ago,), as_dict=1)[0].total or 0
+        """, {"week_ago": week_ago, "month_ago": month_ago}, as_dict=1)[0]
+        wo_this_week = int(recent_stats.wo_this_week)
+        wo_completed_week = int(recent_stats.wo_completed_week)
+        qty_produced_month = recent_stats.qty_produced_month or 0
         
         # Top 5 sản phẩm sản xuất nhiều nhất
         top_products = frappe.db.sql("""
@@ -4561,22 +6177,38 @@ def get_production_dashboard():
         """, as_dict=1)
         
         # Hiệu suất sản xuất 6 tháng gần đây
+        # - Số lệnh tạo: đọc từ bảng tổng hợp XH Monthly Movement
+        # - Số lệnh hoàn thành: trạng thái Completed không đi qua submit/cancel nên gom 1 truy vấn GROUP BY
         from dateutil.relativedelta import relativedelta
+        from frappe.utils import getdate
+
+        from xuanhoa_app.monthly_movement import get_monthly_movement
         production_trend = []
+        
+        first_month = (today - relativedelta(months=5)).replace(day=1)
+        movement = get_monthly_movement(["Work Order"], first_month)
+        completed_by_month = {
+            getdate(row.period): row.count
+            for row in frappe.db.sql("""
+                SELECT DATE_FORMAT(modified, %s) as period, COUNT(*) as count
+                FROM `tabWork Order`
+                WHERE status = 'Completed'
+                AND modified >= %s
+                GROUP BY period
+            """, ("%Y-%m-01", first_month), as_dict=1)
+        }
+        
         for i in range(6):
             month_date = today - relativedelta(months=i)
             month_start = month_date.replace(day=1)
             next_month = month_start + relativedelta(months=1)
             month_end = next_month - timedelta(days=1)
             
-            created = frappe.db.count("Work Order", {
-                "creation": ("between", [month_start, month_end])
-            })
-            
-            completed = frappe.db.count("Work Order", {
-                "status": "Completed",
-                "modified": ("between", [month_start, month_end])
-            })
+            created = sum(
+                movement.get((month_start, "Work Order", "", doc_status), {}).get("doc_count", 0)
+                for doc_status in (0, 1, 2)
+            )
+            completed = completed_by_month.get(month_start, 0)
             
             month_label = f"T{month_date.month}/{month_date.year}"
             production_trend.insert(0, {
@@ -4623,6 +6255,14 @@ def get_production_dashboard():
 
 @frappe.whitelist()
 def get_inventory_dashboard():
+    """
+    Lấy thống kê tồn kho theo warehouse (có cache, xem xuanhoa_app.cache)
+    """
+    from xuanhoa_app.cache import get_cached_dashboard
+    return get_cached_dashboard("inventory", _compute_inventory_dashboard)
+
+
+def _compute_inventory_dashboard():
     """
     Lấy thống kê chi tiết hàng tồn kho theo warehouse
     
@@ -4669,6 +6309,14 @@ def get_inventory_dashboard():
 
 @frappe.whitelist()
 def get_sales_purchase_dashboard():
+    """
+    Lấy thống kê tổng quan mua bán (có cache, xem xuanhoa_app.cache)
+    """
+    from xuanhoa_app.cache import get_cached_dashboard
+    return get_cached_dashboard("sales_purchase", _compute_sales_purchase_dashboard)
+
+
+def _compute_sales_purchase_dashboard():
     """
     Lấy thống kê tổng quan cho mua bán (Purchase & Sales)
     
@@ -4681,11 +6329,12 @@ def get_sales_purchase_dashboard():
         month_ago = today - timedelta(days=30)
         this_month_start = today.replace(day=1)
         
-        # Thống kê hóa đơn mua
-        total_purchase = frappe.db.count("Purchase Invoice")
-        purchase_pending = frappe.db.count("Purchase Invoice", {"docstatus": 0})
-        purchase_submitted = frappe.db.count("Purchase Invoice", {"docstatus": 1})
-        purchase_cancelled = frappe.db.count("Purchase Invoice", {"docstatus": 2})
+        # Thống kê hóa đơn mua (1 query GROUP BY)
+        purchase_counts = _get_status_counts("Purchase Invoice")
+        total_purchase = _sum_status_counts(purchase_counts)
+        purchase_pending = _sum_status_counts(purchase_counts, docstatus=0)
+        purchase_submitted = _sum_status_counts(purchase_counts, docstatus=1)
+        purchase_cancelled = _sum_status_counts(purchase_counts, docstatus=2)
         
         # Tổng giá trị mua tháng này
         purchase_value_month = frappe.db.sql("""
@@ -4695,11 +6344,12 @@ def get_sales_purchase_dashboard():
             AND posting_date >= %s
         """, (this_month_start,), as_dict=1)[0].total or 0
         
-        # Thống kê hóa đơn bán
-        total_sales = frappe.db.count("Sales Invoice")
-        sales_pending = frappe.db.count("Sales Invoice", {"docstatus": 0})
-        sales_submitted = frappe.db.count("Sales Invoice", {"docstatus": 1})
-        sales_cancelled = frappe.db.count("Sales Invoice", {"docstatus": 2})
+        # Thống kê hóa đơn bán (1 query GROUP BY)
+        sales_counts = _get_status_counts("Sales Invoice")
+        total_sales = _sum_status_counts(sales_counts)
+        sales_pending = _sum_status_counts(sales_counts, docstatus=0)
+        sales_submitted = _sum_status_counts(sales_counts, docstatus=1)
+        sales_cancelled = _sum_status_counts(sales_counts, docstatus=2)
         
         # Tổng giá trị bán tháng này
         sales_value_month = frappe.db.sql("""
@@ -4709,38 +6359,28 @@ def get_sales_purchase_dashboard():
             AND posting_date >= %s
         """, (this_month_start,), as_dict=1)[0].total or 0
         
-        # Xu hướng mua bán 6 tháng
+        # Xu hướng mua bán 6 tháng (đọc từ bảng tổng hợp XH Monthly Movement)
         from dateutil.relativedelta import relativedelta
+
+        from xuanhoa_app.monthly_movement import get_monthly_movement
         purchase_sales_trend = []
+        
+        first_month = (today - relativedelta(months=5)).replace(day=1)
+        movement = get_monthly_movement(["Purchase Invoice", "Sales Invoice"], first_month)
+        
         for i in range(6):
             month_date = today - relativedelta(months=i)
             month_start = month_date.replace(day=1)
             next_month = month_start + relativedelta(months=1)
             month_end = next_month - timedelta(days=1)
             
-            purchase_count = frappe.db.count("Purchase Invoice", {
-                "docstatus": 1,
-                "posting_date": ("between", [month_start, month_end])
-            })
-            
-            purchase_value = frappe.db.sql("""
-                SELECT IFNULL(SUM(grand_total), 0) as total
-                FROM `tabPurchase Invoice`
-                WHERE docstatus = 1
-                AND posting_date BETWEEN %s AND %s
-            """, (month_start, month_end), as_dict=1)[0].total or 0
-            
-            sales_count = frappe.db.count("Sales Invoice", {
-                "docstatus": 1,
-                "posting_date": ("between", [month_start, month_end])
-            })
+            purchase_row = movement.get((month_start, "Purchase Invoice", "", 1), {})
+            purchase_count = purchase_row.get("doc_count", 0)
+            purchase_value = purchase_row.get("total_amount", 0)
             
-            sales_value = frappe.db.sql("""
-                SELECT IFNULL(SUM(grand_total), 0) as total
-                FROM `tabSales Invoice`
-                WHERE docstatus = 1
-                AND posting_date BETWEEN %s AND %s
-            """, (month_start, month_end), as_dict=1)[0].total or 0
+            sales_row = movement.get((month_start, "Sales Invoice", "", 1), {})
+            sales_count = sales_row.get("doc_count", 0)
+            sales_value = sales_row.get("total_amount", 0)
             
             month_label = f"T{month_date.month}/{month_date.year}"
             purchase_sales_trend.insert(0, {
@@ -4841,3 +6481,46 @@ def get_sales_purchase_dashboard():
         frappe.log_error(frappe.get_traceback(), "get_sales_purchase_dashboard Error")
         return {}
 
+
+
+DASHBOARD_BUNDLE_SECTIONS = ["kpi", "recent_activities", "stock", "production", "inventory", "sales_purchase"]
+
+
+@frappe.whitelist()
+def get_dashboard_bundle(sections=None, activity_limit=10):
+    """
+    Lấy nhiều phần dashboard trong 1 request (dùng chung session, kết nối DB và company)
+    
+    Args:
+        sections: Danh sách phần cần lấy (list hoặc JSON string), gồm:
+                  kpi, recent_activities, stock, production, inventory, sales_purchase
+                  Mặc định: ["kpi", "recent_activities"]
+        activity_limit: Số hoạt động gần đây (cho phần recent_activities)
+    
+    Returns:
+        dict: {section: dữ liệu của phần đó}
+    """
+    import json
+
+    from xuanhoa_app.cache import get_cached_dashboard, get_default_company
+    
+    if not sections:
+        sections = ["kpi", "recent_activities"]
+    elif isinstance(sections, str):
+        sections = json.loads(sections)
+    
+    invalid = [s for s in sections if s not in DASHBOARD_BUNDLE_SECTIONS]
+    if invalid:
+        frappe.throw(_("Phần dashboard không hợp lệ: {0}").format(", ".join(invalid)))
+    
+    company = get_default_company()
+    builders = {
+        "kpi": get_dashboard_kpi,
+        "recent_activities": lambda: get_recent_activities(limit=activity_limit),
+        "stock": lambda: get_cached_dashboard("stock", _compute_stock_dashboard, company),
+        "production": lambda: get_cached_dashboard("production", _compute_production_dashboard, company),
+        "inventory": lambda: get_cached_dashboard("inventory", _compute_inventory_dashboard, company),
+        "sales_purchase": lambda: get_cached_dashboard("sales_purchase", _compute_sales_purchase_dashboard, company),
+    }
+    
+    return {section: builders[section]() for section in dict.fromkeys(sections)}
@@ -0,0 +1,166 @@
+"""
+BOM Explosion - Triển khai BOM nhiều cấp xuống nguyên vật liệu lá
+
+- Giống ERPNext (BOM.get_exploded_items / Work Order use_multi_level_bom): chỉ dòng BOM Item có `bom_no`
+  mới được triển khai tiếp, dòng để trống `bom_no` được coi là nguyên vật liệu lá
+- Dữ liệu được đọc theo từng cấp (mỗi cấp 2 query cho tất cả BOM cùng cấp), không load từng BOM doc
+- Phát hiện BOM lặp vòng (A -> B -> A) và báo lỗi kèm đường đi
+- Kết quả (định mức cho 1 đơn vị thành phẩm) được cache trong Redis theo (version, bom_no);
+  version được tăng khi BOM thay đổi (doc_events + các API create/update/set_default/delete BOM)
+"""
+
+import frappe
+from frappe import _
+from frappe.utils import cint, flt
+
+BOM_EXPLOSION_CACHE_PREFIX = "xuanhoa_bom_explosion_items"
+BOM_VERSION_KEY = "xuanhoa_bom_version"
+# Key của version cũ không còn được đọc, để tự hết hạn
+BOM_EXPLOSION_CACHE_TTL = 24 * 60 * 60
+
+
+def get_exploded_items(bom_no, qty=1):
+    """
+    Danh sách nguyên vật liệu lá để sản xuất qty đơn vị thành phẩm của BOM
+
+    Returns:
+        list: [{item_code, item_name, stock_uom, source_warehouse, qty}] - qty theo stock_uom
+    """
+    qty = flt(qty)
+    return [
+        dict(item, qty=item["qty"] * qty)
+        for item in explode_boms([bom_no])[bom_no]
+    ]
+
+
+def explode_boms(bom_nos):
+    """
+    Triển khai nhiều BOM cùng lúc (BOM chưa có trong cache được load chung 1 lượt theo cấp)
+
+    Returns:
+        dict: {bom_no: [{item_code, item_name, stock_uom, source_warehouse, qty}]}
+              - qty là định mức cho 1 đơn vị thành phẩm
+    """
+    bom_nos = list(dict.fromkeys(bom_no for bom_no in bom_nos if bom_no))
+    version = _get_bom_version()
+
+    result = {}
+    missing = []
+    for bom_no in bom_nos:
+        data = frappe.cache().get_value(_cache_key(version, bom_no))
+        if data is None:
+            missing.append(bom_no)
+        else:
+            result[bom_no] = data
+
+    if missing:
+        graph = load_bom_graph(missing)
+        memo = {}
+        for bom_no in missing:
+            if bom_no not in graph:
+                frappe.throw(_("Không tìm thấy BOM {0}").format(bom_no), frappe.DoesNotExistError)
+            result[bom_no] = _explode(bom_no, graph, memo, [])
+            frappe.cache().set_value(
+                _cache_key(version, bom_no), result[bom_no], expires_in_sec=BOM_EXPLOSION_CACHE_TTL
+            )
+
+    return result
+
+
+def clear_bom_explosion_cache(doc=None, method=None, *args, **kwargs):
+    """Hook doc_events của BOM / gọi từ API: tăng version để bỏ toàn bộ kết quả đã cache (ngay và sau commit)"""
+    _bump_bom_version()
+    frappe.db.after_commit.add(_bump_bom_version)
+
+
+def _bump_bom_version():
+    frappe.cache().incr(frappe.cache().make_key(BOM_VERSION_KEY))
+
+
+def _get_bom_version():
+    return cint(frappe.safe_decode(frappe.cache().get(frappe.cache().make_key(BOM_VERSION_KEY)) or 0))
+
+
+def _cache_key(version, bom_no):
+    return f"{BOM_EXPLOSION_CACHE_PREFIX}|{version}|{bom_no}"
+
+
+def load_bom_graph(bom_nos):
+    """
+    Load cây BOM theo từng cấp bắt đầu từ bom_nos (dùng chung cho triển khai BOM và MRP)
+
+    Returns:
+        dict: {bom_no: {"quantity": float, "items": [dòng BOM Item + child_bom]}}
+    """
+    graph = {}
+    frontier = set(bom_nos)
+
+    while frontier:
+        for row in frappe.db.sql("""
+            SELECT name, quantity
+            FROM `tabBOM`
+            WHERE name IN %(boms)s
+        """, {"boms": list(frontier)}, as_dict=True):
+            graph[row.name] = {"quantity": flt(row.quantity) or 1, "items": []}
+
+        rows = frappe.db.sql("""
+            SELECT parent, item_code, item_name, stock_uom, stock_qty, bom_no, source_warehouse
+            FROM `tabBOM Item`
+            WHERE parent IN %(boms)s
+            AND parenttype = 'BOM'
+            ORDER BY parent, idx
+        """, {"boms": list(frontier)}, as_dict=True)
+
+        next_frontier = set()
+        for row in rows:
+            if row.parent not in graph:
+                continue
+            row.child_bom = row.bom_no
+            graph[row.parent]["items"].append(row)
+            if row.child_bom and row.child_bom not in graph:
+                next_frontier.add(row.child_bom)
+
+        frontier = next_frontier
+
+    return graph
+
+
+def _explode(bom_no, graph, memo, path):
+    """Định mức NVL lá cho 1 đơn vị thành phẩm của bom_no (memo theo BOM, path để phát hiện lặp vòng)"""
+    if bom_no in memo:
+        return memo[bom_no]
+
+    if bom_no in path:
+        cycle = [*path[path.index(bom_no):], bom_no]
+        frappe.throw(_("BOM bị lặp vòng: {0}").format(" → ".join(cycle)))
+
+    bom = graph[bom_no]
+    path.append(bom_no)
+
+    leaves = {}
+    for row in bom["items"]:
+        qty_per_unit = flt(row.stock_qty) / bom["quantity"]
+        if row.child_bom and row.child_bom in graph:
+            for leaf in _explode(row.child_bom, graph, memo, path):
+                _add_leaf(leaves, leaf, qty_per_unit * leaf["qty"])
+        else:
+            _add_leaf(leaves, row, qty_per_unit)
+
+    path.pop()
+    memo[bom_no] = list(leaves.values())
+    return memo[bom_no]
+
+
+def _add_leaf(leaves, row, qty):
+    leaf = leaves.get(row["item_code"])
+    if leaf:
+        leaf["qty"] += qty
+        return
+
+    leaves[row["item_code"]] = {
+        "item_code": row["item_code"],
+        "item_name": row["item_name"],
+        "stock_uom": row["stock_uom"],
+        "source_warehouse": row["source_warehouse"],
+        "qty": qty,
+    }
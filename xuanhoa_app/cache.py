@@ -0,0 +1,235 @@
+"""
+Cache - Các lớp cache dùng chung cho API
+
+1. Cache dashboard (Redis - frappe.cache())
+   - Key theo dạng: xuanhoa_dashboard|<company>|<endpoint>
+   - TTL cấu hình trong site_config.json: "xuanhoa_dashboard_cache_ttl" (giây, mặc định 60, 0 = tắt cache)
+   - Tự động xóa khi Stock Entry / Work Order / Sales Invoice / Purchase Invoice được submit/cancel (xem hooks.py)
+
+2. Cache tên người dùng (LRU trong process + TTL)
+   - get_user_full_names() trả full_name cho nhiều user, chỉ query các user chưa có trong cache
+   - Khi User được cập nhật/xóa, version trong Redis được tăng để mọi worker tự xóa cache cục bộ
+
+3. Cache cây Item Group (Redis, không hết hạn)
+   - Lưu danh sách node (lft/rgt, số item) và tập sub-groups của từng group
+   - Xóa khi Item Group / Item thay đổi (doc_events) hoặc qua các API create/update/delete_item_group
+
+4. Cache kho mặc định của Work Order theo company (Redis, không hết hạn)
+   - Kho nguồn / WIP / thành phẩm dùng chung cho create/submit/start Work Order
+   - Xóa khi Warehouse / Company / Stock Settings thay đổi (doc_events)
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import frappe
+from frappe.utils import cint
+
+DASHBOARD_CACHE_PREFIX = "xuanhoa_dashboard"
+DEFAULT_DASHBOARD_CACHE_TTL = 60
+
+
+def get_dashboard_cache_ttl():
+    """TTL (giây) của cache dashboard, đọc từ site_config"""
+    ttl = frappe.conf.get("xuanhoa_dashboard_cache_ttl")
+    return DEFAULT_DASHBOARD_CACHE_TTL if ttl is None else cint(ttl)
+
+
+def get_default_company():
+    """Company mặc định của user hiện tại"""
+    return frappe.defaults.get_user_default("Company") or "XUÂN HÒA THÁI BÌNH"
+
+
+def get_cached_dashboard(endpoint, compute, company=None):
+    """
+    Lấy dữ liệu dashboard từ cache, tính lại bằng compute() nếu chưa có hoặc đã hết hạn
+
+    Args:
+        endpoint: Tên dashboard (stock, production, ...)
+        compute: Hàm không tham số trả về dữ liệu dashboard
+        company: Company dùng làm key (mặc định: company của user)
+    """
+    ttl = get_dashboard_cache_ttl()
+    if ttl <= 0:
+        return compute()
+
+    key = f"{DASHBOARD_CACHE_PREFIX}|{company or get_default_company()}|{endpoint}"
+    data = frappe.cache().get_value(key)
+    if data is not None:
+        return data
+
+    data = compute()
+    # Không cache kết quả rỗng (dashboard trả {} khi lỗi)
+    if data:
+        frappe.cache().set_value(key, data, expires_in_sec=ttl)
+
+    return data
+
+
+def clear_dashboard_cache(doc=None, method=None):
+    """Hook doc_events: xóa toàn bộ cache dashboard khi có chứng từ submit/cancel"""
+    _delete_dashboard_keys()
+    # Xóa lại sau commit để request chạy song song không ghi đè dữ liệu cũ vào cache
+    frappe.db.after_commit.add(_delete_dashboard_keys)
+
+
+def _delete_dashboard_keys():
+    frappe.cache().delete_keys(DASHBOARD_CACHE_PREFIX)
+
+
+# ============================================
+# USER FULL NAME CACHE
+# ============================================
+
+USER_NAME_CACHE_SIZE = 4096
+USER_NAME_CACHE_TTL = 300
+USER_NAME_VERSION_KEY = "xuanhoa_user_name_version"
+
+_user_name_cache = OrderedDict()  # {(site, user): (full_name, expires_at)}
+_user_name_versions = {}  # {site: version đã đồng bộ}
+_user_name_lock = threading.Lock()
+
+
+def get_user_full_names(users):
+    """
+    Lấy full_name của nhiều user, dùng cache LRU trong process (chỉ query user chưa có trong cache)
+
+    Args:
+        users: Danh sách user id (có thể trùng, có thể None)
+
+    Returns:
+        dict: {user_id: full_name} - fallback về user_id nếu không có full_name
+    """
+    user_ids = list({u for u in users if u})
+    if not user_ids:
+        return {}
+
+    site = frappe.local.site
+    _sync_user_name_version(site)
+
+    result = {}
+    missing = []
+    now = time.monotonic()
+    with _user_name_lock:
+        for user in user_ids:
+            cached = _user_name_cache.get((site, user))
+            if cached and cached[1] > now:
+                _user_name_cache.move_to_end((site, user))
+                result[user] = cached[0]
+            else:
+                missing.append(user)
+
+    if missing:
+        rows = frappe.get_all(
+            "User",
+            filters={"name": ["in", missing]},
+            fields=["name", "full_name"]
+        )
+        names = {row.name: row.full_name or row.name for row in rows}
+
+        expires_at = now + USER_NAME_CACHE_TTL
+        with _user_name_lock:
+            for user in missing:
+                result[user] = names.get(user) or user
+                _user_name_cache[(site, user)] = (result[user], expires_at)
+                _user_name_cache.move_to_end((site, user))
+            while len(_user_name_cache) > USER_NAME_CACHE_SIZE:
+                _user_name_cache.popitem(last=False)
+
+    return result
+
+
+def get_user_full_name(user):
+    """Lấy full_name của 1 user (qua cache)"""
+    if not user:
+        return user
+    return get_user_full_names([user]).get(user) or user
+
+
+def clear_user_name_cache(doc=None, method=None):
+    """
+    Hook doc_events của User: tăng version trong Redis để mọi worker xóa cache tên người dùng
+    (ngay và sau commit - request chạy song song có thể đã cache lại tên cũ trước khi commit)
+    """
+    _bump_user_name_version()
+    frappe.db.after_commit.add(_bump_user_name_version)
+
+
+def _bump_user_name_version():
+    frappe.cache().incr(frappe.cache().make_key(USER_NAME_VERSION_KEY))
+    _sync_user_name_version(frappe.local.site)
+
+
+def _sync_user_name_version(site):
+    """Xóa cache cục bộ của site nếu version trong Redis đã thay đổi"""
+    version = frappe.cache().get(frappe.cache().make_key(USER_NAME_VERSION_KEY))
+    with _user_name_lock:
+        if _user_name_versions.get(site) == version:
+            return
+        _user_name_versions[site] = version
+        for key in [key for key in _user_name_cache if key[0] == site]:
+            del _user_name_cache[key]
+
+
+# ============================================
+# ITEM GROUP TREE CACHE
+# ============================================
+
+ITEM_GROUP_TREE_KEY = "xuanhoa_item_group_tree"
+
+
+def get_cached_item_group_tree(build):
+    """
+    Lấy cấu trúc cây Item Group từ Redis, build lại bằng build() nếu chưa có
+
+    Returns:
+        dict: {"nodes": [...], "descendants": {group: [group và các sub-groups]}}
+    """
+    data = frappe.cache().get_value(ITEM_GROUP_TREE_KEY)
+    if data is None:
+        data = build()
+        frappe.cache().set_value(ITEM_GROUP_TREE_KEY, data)
+    return data
+
+
+def clear_item_group_cache(doc=None, method=None, *args, **kwargs):
+    """Hook doc_events của Item Group / Item: xóa cache cây Item Group (ngay và sau commit)"""
+    _delete_item_group_tree()
+    frappe.db.after_commit.add(_delete_item_group_tree)
+
+
+def _delete_item_group_tree():
+    frappe.cache().delete_value(ITEM_GROUP_TREE_KEY)
+
+
+# ============================================
+# WORK ORDER DEFAULT WAREHOUSE CACHE
+# ============================================
+
+WORK_ORDER_WAREHOUSE_PREFIX = "xuanhoa_work_order_warehouses"
+
+
+def get_cached_work_order_warehouses(company, build):
+    """
+    Lấy kho mặc định của Work Order cho company từ Redis, tính lại bằng build(company) nếu chưa có
+
+    Returns:
+        dict: {source_warehouse, wip_warehouse, fg_warehouse}
+    """
+    key = f"{WORK_ORDER_WAREHOUSE_PREFIX}|{company}"
+    data = frappe.cache().get_value(key)
+    if data is None:
+        data = build(company)
+        frappe.cache().set_value(key, data)
+    return data
+
+
+def clear_work_order_warehouse_cache(doc=None, method=None, *args, **kwargs):
+    """Hook doc_events của Warehouse / Company / Stock Settings: xóa cache kho mặc định (ngay và sau commit)"""
+    _delete_work_order_warehouse_keys()
+    frappe.db.after_commit.add(_delete_work_order_warehouse_keys)
+
+
+def _delete_work_order_warehouse_keys():
+    frappe.cache().delete_keys(WORK_ORDER_WAREHOUSE_PREFIX)
@@ -139,12 +139,148 @@ website_route_rules = [
 doc_events = {
 	"Stock Entry": {
 		"before_insert": "xuanhoa_app.stock_entry_hooks.set_naming_series",
-	}
+		"on_submit": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_cancel": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_trash": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.search.on_document_change",
+		],
+		"on_update": "xuanhoa_app.search.on_document_change",
+		"on_update_after_submit": "xuanhoa_app.search.on_document_change",
+		"after_rename": "xuanhoa_app.search.on_document_change",
+	},
+	"Purchase Invoice": {
+		"on_submit": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_cancel": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_trash": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.search.on_document_change",
+		],
+		"on_update": "xuanhoa_app.search.on_document_change",
+		"on_update_after_submit": "xuanhoa_app.search.on_document_change",
+		"after_rename": "xuanhoa_app.search.on_document_change",
+	},
+	"Sales Invoice": {
+		"on_submit": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_cancel": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_trash": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.search.on_document_change",
+		],
+		"on_update": "xuanhoa_app.search.on_document_change",
+		"on_update_after_submit": "xuanhoa_app.search.on_document_change",
+		"after_rename": "xuanhoa_app.search.on_document_change",
+	},
+	"Item": {
+		"after_insert": [
+			"xuanhoa_app.search.on_item_change",
+			"xuanhoa_app.cache.clear_item_group_cache",
+		],
+		"on_update": [
+			"xuanhoa_app.search.on_item_change",
+			"xuanhoa_app.cache.clear_item_group_cache",
+		],
+		"on_trash": [
+			"xuanhoa_app.search.on_item_change",
+			"xuanhoa_app.cache.clear_item_group_cache",
+		],
+		"after_rename": [
+			"xuanhoa_app.search.on_item_change",
+			"xuanhoa_app.cache.clear_item_group_cache",
+		],
+	},
+	"Item Group": {
+		"on_update": "xuanhoa_app.cache.clear_item_group_cache",
+		"on_trash": "xuanhoa_app.cache.clear_item_group_cache",
+		"after_rename": "xuanhoa_app.cache.clear_item_group_cache",
+	},
+	"BOM": {
+		"on_update": "xuanhoa_app.bom_explosion.clear_bom_explosion_cache",
+		"on_submit": "xuanhoa_app.bom_explosion.clear_bom_explosion_cache",
+		"on_cancel": "xuanhoa_app.bom_explosion.clear_bom_explosion_cache",
+		"on_update_after_submit": "xuanhoa_app.bom_explosion.clear_bom_explosion_cache",
+		"on_trash": "xuanhoa_app.bom_explosion.clear_bom_explosion_cache",
+	},
+	"Warehouse": {
+		"on_update": "xuanhoa_app.cache.clear_work_order_warehouse_cache",
+		"on_trash": "xuanhoa_app.cache.clear_work_order_warehouse_cache",
+		"after_rename": "xuanhoa_app.cache.clear_work_order_warehouse_cache",
+	},
+	"Company": {
+		"on_update": "xuanhoa_app.cache.clear_work_order_warehouse_cache",
+		"on_trash": "xuanhoa_app.cache.clear_work_order_warehouse_cache",
+		"after_rename": "xuanhoa_app.cache.clear_work_order_warehouse_cache",
+	},
+	"Stock Settings": {
+		"on_update": "xuanhoa_app.cache.clear_work_order_warehouse_cache",
+	},
+	"Supplier": {
+		"on_update": "xuanhoa_app.search.on_document_change",
+		"on_trash": "xuanhoa_app.search.on_document_change",
+		"after_rename": "xuanhoa_app.search.on_document_change",
+	},
+	"Customer": {
+		"on_update": "xuanhoa_app.search.on_document_change",
+		"on_trash": "xuanhoa_app.search.on_document_change",
+		"after_rename": "xuanhoa_app.search.on_document_change",
+	},
+	"Stock Ledger Entry": {
+		"on_submit": "xuanhoa_app.stock_summary.on_stock_ledger_entry",
+		"on_cancel": "xuanhoa_app.stock_summary.on_stock_ledger_entry",
+	},
+	"User": {
+		"on_update": "xuanhoa_app.cache.clear_user_name_cache",
+		"on_trash": "xuanhoa_app.cache.clear_user_name_cache",
+	},
+	"Work Order": {
+		"after_insert": "xuanhoa_app.monthly_movement.update_monthly_movement",
+		"on_submit": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_cancel": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.cache.clear_dashboard_cache",
+		],
+		"on_trash": [
+			"xuanhoa_app.monthly_movement.update_monthly_movement",
+			"xuanhoa_app.search.on_document_change",
+		],
+		"on_update": "xuanhoa_app.search.on_document_change",
+		"on_update_after_submit": "xuanhoa_app.search.on_document_change",
+		"after_rename": "xuanhoa_app.search.on_document_change",
+	},
 }
 
 # Scheduled Tasks
 # ---------------
 
+scheduler_events = {
+	"cron": {
+		"*/10 * * * *": [
+			"xuanhoa_app.stock_summary.reconcile_item_stock_summary",
+		],
+	},
+}
+
 # scheduler_events = {
 # 	"all": [
 # 		"xuanhoa_app.tasks.all"
@@ -0,0 +1,175 @@
+"""
+Monthly Movement - Bảng tổng hợp chứng từ theo tháng cho biểu đồ xu hướng dashboard
+
+Mỗi dòng trong `tabXH Monthly Movement` ứng với 1 bộ (tháng, loại chứng từ, mục đích, docstatus)
+và lưu số chứng từ + tổng giá trị. Bảng được cập nhật cộng dồn qua doc_events (xem hooks.py),
+nên dashboard chỉ cần 1 truy vấn để lấy xu hướng 6 tháng.
+
+Rebuild toàn bộ từ dữ liệu lịch sử:
+    bench --site erpnext.localhost execute xuanhoa_app.monthly_movement.rebuild_monthly_movement
+"""
+
+import frappe
+from frappe.utils import flt, getdate, now
+
+# Cấu hình cho từng loại chứng từ được tổng hợp
+# - date_field: trường ngày dùng để xác định tháng
+# - purpose_field: trường phân loại (None nếu không có)
+# - amount_field: trường giá trị cộng dồn
+# - track_draft: có tính cả bản nháp (docstatus = 0) hay không
+MOVEMENT_DOCTYPES = {
+    "Stock Entry": {
+        "date_field": "posting_date",
+        "purpose_field": "purpose",
+        "amount_field": "total_amount",
+        "track_draft": False,
+    },
+    "Purchase Invoice": {
+        "date_field": "posting_date",
+        "purpose_field": None,
+        "amount_field": "grand_total",
+        "track_draft": False,
+    },
+    "Sales Invoice": {
+        "date_field": "posting_date",
+        "purpose_field": None,
+        "amount_field": "grand_total",
+        "track_draft": False,
+    },
+    "Work Order": {
+        "date_field": "creation",
+        "purpose_field": None,
+        "amount_field": "qty",
+        "track_draft": True,
+    },
+}
+
+
+def update_monthly_movement(doc, method=None):
+    """
+    Hook doc_events: cập nhật bảng tổng hợp khi chứng từ được tạo/submit/cancel/xóa
+    """
+    config = MOVEMENT_DOCTYPES.get(doc.doctype)
+    if not config:
+        return
+
+    track_draft = config["track_draft"]
+
+    if method == "after_insert":
+        if track_draft:
+            _apply_movement(doc, 0, 1)
+    elif method == "on_submit":
+        if track_draft:
+            _apply_movement(doc, 0, -1)
+        _apply_movement(doc, 1, 1)
+    elif method == "on_cancel":
+        _apply_movement(doc, 1, -1)
+        _apply_movement(doc, 2, 1)
+    elif method == "on_trash":
+        if doc.docstatus or track_draft:
+            _apply_movement(doc, doc.docstatus, -1)
+
+
+def _apply_movement(doc, doc_status, sign):
+    """Cộng (sign=1) hoặc trừ (sign=-1) 1 chứng từ vào dòng tổng hợp tương ứng"""
+    config = MOVEMENT_DOCTYPES[doc.doctype]
+    date_value = doc.get(config["date_field"]) or now()
+    purpose = doc.get(config["purpose_field"]) if config["purpose_field"] else ""
+
+    _upsert_movement(
+        period=getdate(date_value).replace(day=1),
+        reference_doctype=doc.doctype,
+        purpose=purpose or "",
+        doc_status=doc_status,
+        doc_count=sign,
+        total_amount=sign * flt(doc.get(config["amount_field"])),
+    )
+
+
+def _upsert_movement(period, reference_doctype, purpose, doc_status, doc_count, total_amount):
+    """
+    Cộng dồn vào dòng tổng hợp bằng INSERT ... ON DUPLICATE KEY UPDATE.
+    Tên dòng được sinh cố định từ khóa nên không cần đọc trước khi ghi.
+    """
+    timestamp = now()
+    frappe.db.sql("""
+        INSERT INTO `tabXH Monthly Movement`
+            (name, creation, modified, owner, modified_by, docstatus, idx,
+             period, reference_doctype, purpose, doc_status, doc_count, total_amount)
+        VALUES
+            (%(name)s, %(timestamp)s, %(timestamp)s, %(user)s, %(user)s, 0, 0,
+             %(period)s, %(reference_doctype)s, %(purpose)s, %(doc_status)s, %(doc_count)s, %(total_amount)s)
+        ON DUPLICATE KEY UPDATE
+            doc_count = doc_count + VALUES(doc_count),
+            total_amount = total_amount + VALUES(total_amount),
+            modified = VALUES(modified)
+    """, {
+        "name": f"{period}-{reference_doctype}-{purpose}-{doc_status}",
+        "timestamp": timestamp,
+        "user": frappe.session.user if frappe.session else "Administrator",
+        "period": period,
+        "reference_doctype": reference_doctype,
+        "purpose": purpose,
+        "doc_status": doc_status,
+        "doc_count": doc_count,
+        "total_amount": total_amount,
+    })
+
+
+def rebuild_monthly_movement():
+    """
+    Xóa và tính lại toàn bộ bảng tổng hợp từ dữ liệu lịch sử (mỗi loại chứng từ 1 truy vấn GROUP BY)
+    """
+    frappe.db.sql("DELETE FROM `tabXH Monthly Movement`")
+
+    total_rows = 0
+    for doctype, config in MOVEMENT_DOCTYPES.items():
+        purpose_expr = f"IFNULL(`{config['purpose_field']}`, '')" if config["purpose_field"] else "''"
+        status_condition = "" if config["track_draft"] else "WHERE docstatus > 0"
+
+        rows = frappe.db.sql(f"""
+            SELECT
+                DATE_FORMAT(`{config['date_field']}`, %s) as period,
+                {purpose_expr} as purpose,
+                docstatus,
+                COUNT(*) as doc_count,
+                IFNULL(SUM(`{config['amount_field']}`), 0) as total_amount
+            FROM `tab{doctype}`
+            {status_condition}
+            GROUP BY period, purpose, docstatus
+        """, ("%Y-%m-01",), as_dict=1)
+
+        for row in rows:
+            _upsert_movement(
+                period=getdate(row.period),
+                reference_doctype=doctype,
+                purpose=row.purpose,
+                doc_status=row.docstatus,
+                doc_count=row.doc_count,
+                total_amount=flt(row.total_amount),
+            )
+        total_rows += len(rows)
+
+    frappe.db.commit()
+    frappe.logger("xuanhoa_app").info(f"Đã rebuild XH Monthly Movement: {total_rows} dòng")
+    return total_rows
+
+
+def get_monthly_movement(doctypes, from_period):
+    """
+    Đọc bảng tổng hợp cho các loại chứng từ từ tháng from_period trở đi (1 truy vấn)
+
+    Returns:
+        dict: {(period, reference_doctype, purpose, doc_status): {"doc_count", "total_amount"}}
+    """
+    rows = frappe.db.sql("""
+        SELECT period, reference_doctype, purpose, doc_status, doc_count, total_amount
+        FROM `tabXH Monthly Movement`
+        WHERE reference_doctype IN %(doctypes)s
+        AND period >= %(from_period)s
+    """, {"doctypes": tuple(doctypes), "from_period": from_period}, as_dict=1)
+
+    return {
+        (getdate(row.period), row.reference_doctype, row.purpose or "", row.doc_status): row
+        for row in rows
+    }
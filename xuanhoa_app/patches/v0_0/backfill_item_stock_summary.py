@@ -0,0 +1,6 @@
+from xuanhoa_app.stock_summary import rebuild_item_stock_summary
+
+
+def execute():
+    """Tính bảng XH Item Stock Summary lần đầu từ Bin và Stock Ledger Entry"""
+    rebuild_item_stock_summary()
@@ -0,0 +1,6 @@
+from xuanhoa_app.monthly_movement import rebuild_monthly_movement
+
+
+def execute():
+    """Tính lại bảng XH Monthly Movement từ dữ liệu lịch sử sau khi tạo DocType"""
+    rebuild_monthly_movement()
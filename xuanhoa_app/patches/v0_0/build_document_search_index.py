@@ -0,0 +1,6 @@
+from xuanhoa_app.search import rebuild_document_index
+
+
+def execute():
+    """Build index tìm kiếm chứng từ (SQLite FTS5) lần đầu từ dữ liệu hiện có"""
+    rebuild_document_index()
@@ -0,0 +1,418 @@
+"""
+Search - Chỉ mục tìm kiếm Item trong bộ nhớ (trigram, bỏ dấu tiếng Việt)
+
+- fold_text(): chuẩn hóa chuỗi để so khớp không dấu ("Ống thép" -> "ong thep")
+- Index được build lazily ở mỗi process (mỗi site 1 index), lần đầu search sẽ load toàn bộ Item
+- Item after_insert/on_update tăng version trong Redis -> các process đồng bộ lại các Item
+  có modified mới (chỉ query phần thay đổi)
+- Item on_trash/after_rename tăng generation -> các process build lại toàn bộ index
+- search_item_codes() trả danh sách item_code ứng viên để endpoint lọc tiếp bằng DB
+
+Tìm kiếm chứng từ (SQLite FTS5 sidecar, file sites/<site>/private/xuanhoa_document_search.sqlite3)
+- Lưu nội dung đã bỏ dấu của Stock Entry, Purchase/Sales Invoice, Work Order, Supplier, Customer
+  (mã chứng từ, tên đối tác, tên hàng, ghi chú)
+- Cập nhật qua doc_events sau khi commit; rebuild toàn bộ:
+    bench --site erpnext.localhost execute xuanhoa_app.search.rebuild_document_index
+- search_documents() trả kết quả xếp hạng (bm25) trên tất cả loại chứng từ trong 1 query
+"""
+
+import re
+import sqlite3
+import threading
+import unicodedata
+
+import frappe
+from frappe.utils import add_to_date, get_datetime
+
+# Số ứng viên tối đa khi endpoint lọc bằng IN (...); nhiều hơn thì quay về LIKE
+MAX_ITEM_CANDIDATES = 1000
+
+ITEM_SEARCH_VERSION_KEY = "xuanhoa_item_search_version"
+ITEM_SEARCH_GENERATION_KEY = "xuanhoa_item_search_generation"
+
+# Lùi mốc đồng bộ để không bỏ sót Item commit chậm hơn Item có modified lớn hơn
+SYNC_OVERLAP_MINUTES = 10
+
+_indexes = {}  # {site: _ItemIndex}
+_lock = threading.Lock()
+
+
+def fold_text(text):
+    """
+    Chuẩn hóa chuỗi để tìm kiếm: chữ thường, bỏ dấu tiếng Việt, gộp khoảng trắng
+    """
+    if not text:
+        return ""
+    text = str(text).lower().replace("đ", "d")
+    text = unicodedata.normalize("NFD", text)
+    text = "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+    return " ".join(text.split())
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class _ItemIndex:
+    """Trigram index của 1 site: item_code -> chuỗi đã chuẩn hóa (mã + tên)"""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.version = None
+        self.synced_until = None
+        self.texts = {}
+        self.postings = {}
+
+    def upsert(self, item_code, item_name):
+        self.remove(item_code)
+        text = fold_text(f"{item_code} {item_name or ''}")
+        self.texts[item_code] = text
+        for gram in _trigrams(text):
+            self.postings.setdefault(gram, set()).add(item_code)
+
+    def remove(self, item_code):
+        text = self.texts.pop(item_code, None)
+        if text is None:
+            return
+        for gram in _trigrams(text):
+            codes = self.postings.get(gram)
+            if codes:
+                codes.discard(item_code)
+                if not codes:
+                    del self.postings[gram]
+
+    def load(self, since=None):
+        """Nạp Item từ DB (toàn bộ hoặc chỉ các Item có modified >= since)"""
+        filters = {}
+        if since:
+            filters["modified"] = [">=", add_to_date(since, minutes=-SYNC_OVERLAP_MINUTES)]
+
+        rows = frappe.get_all(
+            "Item",
+            filters=filters,
+            fields=["name", "item_name", "modified"],
+            order_by="modified asc"
+        )
+        for row in rows:
+            self.upsert(row.name, row.item_name)
+            modified = get_datetime(row.modified)
+            if not self.synced_until or modified > self.synced_until:
+                self.synced_until = modified
+
+    def search(self, query):
+        """Trả item_code có chứa tất cả từ khóa (đã bỏ dấu), xếp mã/tên bắt đầu bằng từ khóa lên trước"""
+        tokens = fold_text(query).split()
+        if not tokens:
+            return []
+
+        candidates = None
+        for token in tokens:
+            if len(token) < 3:
+                continue
+            for gram in _trigrams(token):
+                codes = self.postings.get(gram, set())
+                candidates = set(codes) if candidates is None else candidates & codes
+                if not candidates:
+                    return []
+
+        pool = self.texts.keys() if candidates is None else candidates
+        folded_query = " ".join(tokens)
+        matches = [
+            code for code in pool
+            if all(token in self.texts[code] for token in tokens)
+        ]
+        matches.sort(key=lambda code: (not self.texts[code].startswith(folded_query), self.texts[code]))
+        return matches
+
+
+def _get_index():
+    """Lấy index của site hiện tại, build lần đầu hoặc đồng bộ nếu version/generation trong Redis thay đổi"""
+    site = frappe.local.site
+    cache = frappe.cache()
+    version = cache.get(cache.make_key(ITEM_SEARCH_VERSION_KEY))
+    generation = cache.get(cache.make_key(ITEM_SEARCH_GENERATION_KEY))
+
+    with _lock:
+        index = _indexes.get(site)
+        if index is None or index.generation != generation:
+            index = _ItemIndex(generation)
+            index.load()
+            index.version = version
+            _indexes[site] = index
+        elif index.version != version:
+            index.load(since=index.synced_until)
+            index.version = version
+        return index
+
+
+def search_item_codes(query, max_results=None):
+    """
+    Tìm item_code khớp với từ khóa (không phân biệt dấu, hoa thường)
+
+    Args:
+        max_results: Số ứng viên tối đa (vd: MAX_ITEM_CANDIDATES khi endpoint lọc bằng IN (...));
+                     từ khóa quá ngắn khớp nhiều hơn thì trả None để endpoint dùng LIKE
+
+    Returns:
+        list | None: Danh sách item_code ứng viên; None nếu từ khóa rỗng, index lỗi
+                     hoặc vượt max_results (endpoint sẽ quay về tìm bằng LIKE)
+    """
+    if not fold_text(query):
+        return None
+
+    try:
+        codes = _get_index().search(query)
+    except Exception:
+        frappe.log_error(frappe.get_traceback(), "search_item_codes Error")
+        return None
+
+    if max_results and len(codes) > max_results:
+        return None
+    return codes
+
+
+def on_item_change(doc=None, method=None, *args, **kwargs):
+    """
+    Hook doc_events của Item
+    - after_insert/on_update: tăng version -> các process đồng bộ phần thay đổi
+    - on_trash/after_rename: tăng generation -> các process build lại toàn bộ
+    """
+    key = ITEM_SEARCH_GENERATION_KEY if method in ("on_trash", "after_rename") else ITEM_SEARCH_VERSION_KEY
+
+    def bump():
+        cache = frappe.cache()
+        cache.incr(cache.make_key(key))
+
+    # Tăng sau commit để process khác đồng bộ thấy được dữ liệu mới
+    frappe.db.after_commit.add(bump)
+
+
+# ============================================
+# DOCUMENT SEARCH (SQLite FTS5)
+# ============================================
+
+# Cấu hình nội dung được index cho từng loại chứng từ
+# - title: trường hiển thị kèm kết quả
+# - fields: các trường đưa vào nội dung tìm kiếm
+# - child: (tên bảng con trên doc, DocType bảng con) để lấy mã/tên hàng
+DOCUMENT_SEARCH_SOURCES = {
+    "Stock Entry": {
+        "title": "stock_entry_type",
+        "fields": ["purpose", "stock_entry_type", "remarks"],
+        "child": ("items", "Stock Entry Detail"),
+    },
+    "Purchase Invoice": {
+        "title": "supplier_name",
+        "fields": ["supplier", "supplier_name", "remarks"],
+        "child": ("items", "Purchase Invoice Item"),
+    },
+    "Sales Invoice": {
+        "title": "customer_name",
+        "fields": ["customer", "customer_name", "remarks"],
+        "child": ("items", "Sales Invoice Item"),
+    },
+    "Work Order": {
+        "title": "item_name",
+        "fields": ["production_item", "item_name", "description"],
+        "child": ("required_items", "Work Order Item"),
+    },
+    "Supplier": {
+        "title": "supplier_name",
+        "fields": ["supplier_name", "supplier_group"],
+        "child": None,
+    },
+    "Customer": {
+        "title": "customer_name",
+        "fields": ["customer_name", "customer_group"],
+        "child": None,
+    },
+}
+
+DOCUMENT_INDEX_FILE = "xuanhoa_document_search.sqlite3"
+
+
+def _connect_document_index():
+    """Mở (và khởi tạo nếu chưa có) file SQLite FTS5 của site hiện tại"""
+    conn = sqlite3.connect(frappe.get_site_path("private", DOCUMENT_INDEX_FILE), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS document_keys (
+            doctype TEXT NOT NULL,
+            docname TEXT NOT NULL,
+            PRIMARY KEY (doctype, docname)
+        )
+    """)
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+            doctype UNINDEXED, docname UNINDEXED, title UNINDEXED, name_text, content
+        )
+    """)
+    return conn
+
+
+def _build_document_entry(doctype, doc, child_rows):
+    """Tạo (doctype, docname, title, name_text, content) từ doc/dict và các dòng bảng con"""
+    config = DOCUMENT_SEARCH_SOURCES[doctype]
+    parts = [doc.get(field) for field in config["fields"]]
+    for row in child_rows:
+        parts.extend([row.get("item_code"), row.get("item_name")])
+
+    content = fold_text(" ".join(str(part) for part in parts if part))
+    return (doctype, doc.get("name"), doc.get(config["title"]) or "", fold_text(doc.get("name")), content)
+
+
+def _write_document_entries(conn, entries):
+    for doctype, docname, title, name_text, content in entries:
+        conn.execute(
+            "INSERT OR IGNORE INTO document_keys (doctype, docname) VALUES (?, ?)", (doctype, docname)
+        )
+        rowid = conn.execute(
+            "SELECT rowid FROM document_keys WHERE doctype = ? AND docname = ?", (doctype, docname)
+        ).fetchone()[0]
+        conn.execute("DELETE FROM documents WHERE rowid = ?", (rowid,))
+        conn.execute(
+            "INSERT INTO documents (rowid, doctype, docname, title, name_text, content) VALUES (?, ?, ?, ?, ?, ?)",
+            (rowid, doctype, docname, title, name_text, content)
+        )
+
+
+def _delete_document_entry(conn, doctype, docname):
+    row = conn.execute(
+        "SELECT rowid FROM document_keys WHERE doctype = ? AND docname = ?", (doctype, docname)
+    ).fetchone()
+    if row:
+        conn.execute("DELETE FROM documents WHERE rowid = ?", (row[0],))
+        conn.execute("DELETE FROM document_keys WHERE rowid = ?", (row[0],))
+
+
+def on_document_change(doc, method=None, *args, **kwargs):
+    """
+    Hook doc_events: cập nhật index chứng từ sau khi commit
+    - on_update/on_update_after_submit: ghi lại nội dung
+    - on_trash: xóa khỏi index
+    - after_rename(doc, method, old, new, merge): xóa tên cũ, ghi tên mới
+    """
+    doctype = doc.doctype
+    config = DOCUMENT_SEARCH_SOURCES.get(doctype)
+    if not config:
+        return
+
+    old_name = args[0] if method == "after_rename" and args else None
+    entry = None
+    if method != "on_trash":
+        child_rows = (doc.get(config["child"][0]) or []) if config["child"] else []
+        entry = _build_document_entry(doctype, doc, child_rows)
+    docname = doc.name
+
+    def apply():
+        try:
+            conn = _connect_document_index()
+            with conn:
+                if old_name:
+                    _delete_document_entry(conn, doctype, old_name)
+                if entry:
+                    _write_document_entries(conn, [entry])
+                else:
+                    _delete_document_entry(conn, doctype, docname)
+            conn.close()
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), "on_document_change Error")
+
+    frappe.db.after_commit.add(apply)
+
+
+def rebuild_document_index():
+    """Xóa và build lại toàn bộ index chứng từ từ DB"""
+    conn = _connect_document_index()
+    total = 0
+    with conn:
+        conn.execute("DELETE FROM documents")
+        conn.execute("DELETE FROM document_keys")
+
+        for doctype, config in DOCUMENT_SEARCH_SOURCES.items():
+            fields = list(dict.fromkeys(["name", config["title"]] + config["fields"]))
+            docs = frappe.get_all(doctype, fields=fields)
+
+            children = {}
+            if config["child"]:
+                for row in frappe.get_all(
+                    config["child"][1],
+                    filters={"parenttype": doctype},
+                    fields=["parent", "item_code", "item_name"]
+                ):
+                    children.setdefault(row.parent, []).append(row)
+
+            _write_document_entries(conn, [
+                _build_document_entry(doctype, doc, children.get(doc.name, []))
+                for doc in docs
+            ])
+            total += len(docs)
+    conn.close()
+
+    frappe.logger("xuanhoa_app").info(f"Đã rebuild index tìm kiếm chứng từ: {total} chứng từ")
+    return total
+
+
+def search_documents(query, doctypes=None, limit=20):
+    """
+    Tìm chứng từ theo từ khóa (không dấu, khớp tiền tố từng từ), xếp hạng bm25
+    Mã chứng từ được ưu tiên hơn nội dung.
+    Chỉ trả chứng từ user được đọc (User Permissions, if_owner... qua frappe.get_list).
+
+    Returns:
+        list: [{doctype, name, title, score}]
+    """
+    tokens = re.findall(r"\w+", fold_text(query))
+    if not tokens:
+        return []
+
+    match_query = " AND ".join(f'"{token}"*' for token in tokens)
+    doctypes = [d for d in (doctypes or DOCUMENT_SEARCH_SOURCES) if d in DOCUMENT_SEARCH_SOURCES]
+    if not doctypes:
+        return []
+
+    limit = int(limit)
+    # Lấy dư kết quả mỗi lượt vì một phần có thể bị loại do không có quyền
+    batch_size = max(limit * 5, 50)
+    results = []
+    offset = 0
+
+    conn = _connect_document_index()
+    try:
+        while len(results) < limit:
+            rows = conn.execute(f"""
+                SELECT doctype, docname, title, bm25(documents, 0, 0, 0, 10.0, 1.0) as score
+                FROM documents
+                WHERE documents MATCH ?
+                AND doctype IN ({", ".join("?" for _ in doctypes)})
+                ORDER BY score
+                LIMIT ? OFFSET ?
+            """, [match_query, *doctypes, batch_size, offset]).fetchall()
+
+            results.extend(_filter_permitted_documents(rows))
+            if len(rows) < batch_size:
+                break
+            offset += batch_size
+    finally:
+        conn.close()
+
+    return [
+        {"doctype": doctype, "name": docname, "title": title, "score": -score}
+        for doctype, docname, title, score in results[:limit]
+    ]
+
+
+def _filter_permitted_documents(rows):
+    """Giữ các kết quả user được đọc (mỗi loại chứng từ 1 query get_list), giữ nguyên thứ tự"""
+    names_by_doctype = {}
+    for row in rows:
+        names_by_doctype.setdefault(row[0], []).append(row[1])
+
+    permitted = set()
+    for doctype, names in names_by_doctype.items():
+        permitted.update(
+            (doctype, name)
+            for name in frappe.get_list(doctype, filters={"name": ["in", names]}, pluck="name", limit=len(names))
+        )
+
+    return [row for row in rows if (row[0], row[1]) in permitted]
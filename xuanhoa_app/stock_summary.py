@@ -0,0 +1,198 @@
+"""
+Item Stock Summary - Bảng tổng hợp tồn kho theo mã hàng (`tabXH Item Stock Summary`)
+
+Mỗi dòng (name = item_code) lưu tổng tồn kho, tổng giá trị, đơn giá lớn nhất, số kho có tồn
+và ngày phát sinh cuối, để các API đọc số liệu theo mã hàng bằng 1 lần đọc theo khóa
+thay vì gom lại `tabBin`.
+
+- Stock Ledger Entry on_submit/on_cancel gom mã hàng của transaction, sau commit đưa vào 1 job nền
+  (Bin được cập nhật sau khi bút toán sổ kho được tạo nên không tính ngay trong hook)
+- Scheduler (10 phút/lần) đối soát các mã hàng có Bin thay đổi sau lần tổng hợp cuối:
+  bù cho job bị mất (worker dừng) và Repost Item Valuation (cập nhật Bin không qua SLE submit,
+  trạng thái repost ghi bằng db_set nên không có doc_events để hook)
+- Rebuild toàn bộ:
+    bench --site erpnext.localhost execute xuanhoa_app.stock_summary.rebuild_item_stock_summary
+"""
+
+import frappe
+from frappe.utils import now
+
+BATCH_SIZE = 500
+PENDING_FLAG = "xh_item_stock_summary_pending"
+
+
+def on_stock_ledger_entry(doc, method=None):
+    """
+    Hook doc_events của Stock Ledger Entry: gom mã hàng trong transaction hiện tại,
+    sau khi commit đưa vào 1 job nền để tính lại tổng hợp
+    """
+    pending = frappe.flags.get(PENDING_FLAG)
+    if pending is None:
+        pending = frappe.flags[PENDING_FLAG] = set()
+        frappe.db.after_commit.add(_enqueue_pending_refresh)
+        frappe.db.after_rollback.add(_discard_pending_refresh)
+    pending.add(doc.item_code)
+
+
+def _enqueue_pending_refresh():
+    item_codes = sorted(frappe.flags.pop(PENDING_FLAG, None) or [])
+    if item_codes:
+        frappe.enqueue(
+            "xuanhoa_app.stock_summary.refresh_item_stock_summary",
+            queue="short",
+            item_codes=item_codes
+        )
+
+
+def _discard_pending_refresh():
+    frappe.flags.pop(PENDING_FLAG, None)
+
+
+def refresh_item_stock_summary(item_codes):
+    """
+    Tính lại tổng hợp cho danh sách mã hàng (mỗi lô 2 query: Bin + Stock Ledger Entry)
+    """
+    item_codes = list(dict.fromkeys(code for code in item_codes if code))
+
+    for start in range(0, len(item_codes), BATCH_SIZE):
+        batch = item_codes[start:start + BATCH_SIZE]
+        # Mốc thời gian lấy trước khi đọc Bin: Bin đổi trong lúc tính vẫn mới hơn dòng tổng hợp
+        # nên lần đối soát sau sẽ tính lại
+        timestamp = now()
+
+        bins = {
+            row.item_code: row
+            for row in frappe.db.sql("""
+                SELECT
+                    item_code,
+                    SUM(actual_qty) as total_qty,
+                    SUM(stock_value) as total_value,
+                    MAX(valuation_rate) as max_valuation_rate,
+                    COUNT(CASE WHEN actual_qty != 0 THEN 1 END) as warehouse_count
+                FROM `tabBin`
+                WHERE item_code IN %(item_codes)s
+                GROUP BY item_code
+            """, {"item_codes": batch}, as_dict=True)
+        }
+        last_movements = dict(frappe.db.sql("""
+            SELECT item_code, MAX(posting_date)
+            FROM `tabStock Ledger Entry`
+            WHERE item_code IN %(item_codes)s
+            AND is_cancelled = 0
+            GROUP BY item_code
+        """, {"item_codes": batch}))
+
+        _upsert_summaries([
+            _summary_row(code, bins.get(code), last_movements.get(code)) for code in batch
+        ], timestamp)
+
+    frappe.db.commit()
+
+
+def reconcile_item_stock_summary():
+    """
+    Scheduler: tính lại các mã hàng có Bin thay đổi sau lần tổng hợp cuối (hoặc chưa có dòng tổng hợp)
+    """
+    item_codes = [row[0] for row in frappe.db.sql("""
+        SELECT DISTINCT b.item_code
+        FROM `tabBin` b
+        LEFT JOIN `tabXH Item Stock Summary` s ON s.name = b.item_code
+        WHERE s.name IS NULL OR b.modified > s.modified
+    """)]
+
+    if item_codes:
+        refresh_item_stock_summary(item_codes)
+    return len(item_codes)
+
+
+def rebuild_item_stock_summary():
+    """Xóa và tính lại toàn bộ bảng tổng hợp (2 query GROUP BY trên toàn bộ dữ liệu)"""
+    frappe.db.sql("DELETE FROM `tabXH Item Stock Summary`")
+
+    bins = frappe.db.sql("""
+        SELECT
+            item_code,
+            SUM(actual_qty) as total_qty,
+            SUM(stock_value) as total_value,
+            MAX(valuation_rate) as max_valuation_rate,
+            COUNT(CASE WHEN actual_qty != 0 THEN 1 END) as warehouse_count
+        FROM `tabBin`
+        GROUP BY item_code
+    """, as_dict=True)
+    last_movements = dict(frappe.db.sql("""
+        SELECT item_code, MAX(posting_date)
+        FROM `tabStock Ledger Entry`
+        WHERE is_cancelled = 0
+        GROUP BY item_code
+    """))
+
+    rows = [_summary_row(row.item_code, row, last_movements.get(row.item_code)) for row in bins]
+    for start in range(0, len(rows), BATCH_SIZE):
+        _upsert_summaries(rows[start:start + BATCH_SIZE])
+
+    frappe.db.commit()
+    frappe.logger("xuanhoa_app").info(f"Đã rebuild XH Item Stock Summary: {len(rows)} mã hàng")
+    return len(rows)
+
+
+def get_item_stock_summaries(item_codes):
+    """
+    Đọc tổng hợp tồn kho của nhiều mã hàng (1 query theo khóa chính)
+
+    Returns:
+        dict: {item_code: {total_qty, total_value, max_valuation_rate, warehouse_count, last_movement_date}}
+    """
+    item_codes = [code for code in item_codes if code]
+    if not item_codes:
+        return {}
+
+    return {
+        row.name: row
+        for row in frappe.db.sql("""
+            SELECT name, total_qty, total_value, max_valuation_rate, warehouse_count, last_movement_date
+            FROM `tabXH Item Stock Summary`
+            WHERE name IN %(item_codes)s
+        """, {"item_codes": item_codes}, as_dict=True)
+    }
+
+
+def _summary_row(item_code, bin_row, last_movement_date):
+    return (
+        item_code,
+        (bin_row.total_qty if bin_row else 0) or 0,
+        (bin_row.total_value if bin_row else 0) or 0,
+        (bin_row.max_valuation_rate if bin_row else 0) or 0,
+        (bin_row.warehouse_count if bin_row else 0) or 0,
+        last_movement_date,
+    )
+
+
+def _upsert_summaries(rows, timestamp=None):
+    """Ghi nhiều dòng tổng hợp bằng 1 câu INSERT ... ON DUPLICATE KEY UPDATE"""
+    if not rows:
+        return
+
+    timestamp = timestamp or now()
+    user = frappe.session.user if frappe.session else "Administrator"
+    values = []
+    params = []
+    for item_code, total_qty, total_value, max_valuation_rate, warehouse_count, last_movement_date in rows:
+        values.append("(%s, %s, %s, %s, %s, 0, 0, %s, %s, %s, %s, %s, %s)")
+        params.extend([
+            item_code, timestamp, timestamp, user, user,
+            item_code, total_qty, total_value, max_valuation_rate, warehouse_count, last_movement_date
+        ])
+
+    frappe.db.sql(f"""
+        INSERT INTO `tabXH Item Stock Summary`
+            (name, creation, modified, owner, modified_by, docstatus, idx,
+             item_code, total_qty, total_value, max_valuation_rate, warehouse_count, last_movement_date)
+        VALUES {", ".join(values)}
+        ON DUPLICATE KEY UPDATE
+            total_qty = VALUES(total_qty),
+            total_value = VALUES(total_value),
+            max_valuation_rate = VALUES(max_valuation_rate),
+            warehouse_count = VALUES(warehouse_count),
+            last_movement_date = VALUES(last_movement_date),
+            modified = VALUES(modified)
+    """, params)
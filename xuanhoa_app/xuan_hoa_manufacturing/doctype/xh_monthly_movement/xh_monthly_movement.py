@@ -0,0 +1,14 @@
+# Copyright (c) 2026, Xuan Hoa and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class XHMonthlyMovement(Document):
+	pass
+
+
+def on_doctype_update():
+	"""Index phục vụ truy vấn xu hướng của dashboard (lọc theo loại chứng từ + tháng)"""
+	frappe.db.add_index("XH Monthly Movement", ["reference_doctype", "period"])